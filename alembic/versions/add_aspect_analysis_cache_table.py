@@ -0,0 +1,33 @@
+"""add aspect_analysis_cache table
+
+Revision ID: aspect_analysis_cache_001
+Revises: media_blobs_001
+Create Date: 2026-10-19 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'aspect_analysis_cache_001'
+down_revision = 'media_blobs_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'aspect_analysis_cache',
+        sa.Column('cache_key', sa.String(length=64), nullable=False),
+        sa.Column('prompt_version', sa.String(length=32), nullable=False),
+        sa.Column('model', sa.String(length=100), nullable=False),
+        sa.Column('aspects', sa.JSON(), nullable=False),
+        sa.Column('hits', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.Column('last_hit_at', sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint('cache_key')
+    )
+
+
+def downgrade():
+    op.drop_table('aspect_analysis_cache')
@@ -0,0 +1,44 @@
+"""add feedback_daily_rollups table
+
+Revision ID: feedback_daily_rollups_001
+Revises: product_reviews_keyset_001
+Create Date: 2026-10-19 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'feedback_daily_rollups_001'
+down_revision = 'product_reviews_keyset_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'feedback_daily_rollups',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('brand', sa.String(), nullable=False),
+        sa.Column('vendor_code', sa.String(), nullable=False, server_default=''),
+        sa.Column('day', sa.Date(), nullable=False),
+        sa.Column('total', sa.Integer(), nullable=True),
+        sa.Column('negative', sa.Integer(), nullable=True),
+        sa.Column('deleted', sa.Integer(), nullable=True),
+        sa.Column('rating_1', sa.Integer(), nullable=True),
+        sa.Column('rating_2', sa.Integer(), nullable=True),
+        sa.Column('rating_3', sa.Integer(), nullable=True),
+        sa.Column('rating_4', sa.Integer(), nullable=True),
+        sa.Column('rating_5', sa.Integer(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('brand', 'vendor_code', 'day', name='uq_feedback_daily_rollups_brand_vendor_day')
+    )
+    op.create_index(op.f('ix_feedback_daily_rollups_id'), 'feedback_daily_rollups', ['id'], unique=False)
+    op.create_index('idx_feedback_daily_rollups_brand_day', 'feedback_daily_rollups', ['brand', 'day'], unique=False)
+
+
+def downgrade():
+    op.drop_index('idx_feedback_daily_rollups_brand_day', table_name='feedback_daily_rollups')
+    op.drop_index(op.f('ix_feedback_daily_rollups_id'), table_name='feedback_daily_rollups')
+    op.drop_table('feedback_daily_rollups')
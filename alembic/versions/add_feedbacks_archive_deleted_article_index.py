@@ -0,0 +1,27 @@
+"""add partial index for deleted reviews in feedbacks_archive by article
+
+Revision ID: feedbacks_archive_deleted_001
+Revises: feedbacks_sentiment_pending_001
+Create Date: 2026-10-20 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'feedbacks_archive_deleted_001'
+down_revision = 'feedbacks_sentiment_pending_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Удалённые отзывы из архива попадают в выдачу отзывов товара (фильтр только по article)
+    op.create_index(
+        'idx_feedbacks_archive_deleted_article', 'feedbacks_archive', ['article'],
+        postgresql_where=sa.text("archive_reason = 'deleted'")
+    )
+
+
+def downgrade():
+    op.drop_index('idx_feedbacks_archive_deleted_article', table_name='feedbacks_archive')
@@ -0,0 +1,80 @@
+"""add feedbacks_archive table and feedbacks_all view
+
+Revision ID: feedbacks_archive_001
+Revises: feedback_daily_rollups_001
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'feedbacks_archive_001'
+down_revision = 'feedback_daily_rollups_001'
+branch_labels = None
+depends_on = None
+
+# Общие колонки feedbacks и feedbacks_archive (см. crud.feedback_archive.ARCHIVED_COLUMNS)
+COMMON_COLUMNS = (
+    'id, article, brand, vendor_code, author, rating, date, status, "text", main_text, pros_text, cons_text, '
+    'sentiment_score, is_negative, is_processed, processing_notes, created_at, updated_at, user_id, history_id, '
+    'is_deleted, deleted_at, wb_id, aspects, bables_resolved, wb_updated_at, global_user_id, wb_user_id, '
+    'content_hash, suspected_deleted_at, superseded_by_wb_id'
+)
+
+
+def upgrade():
+    op.create_table(
+        'feedbacks_archive',
+        sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('article', sa.String(length=32), nullable=False),
+        sa.Column('brand', sa.String(), nullable=False),
+        sa.Column('vendor_code', sa.String(), nullable=True),
+        sa.Column('author', sa.String(), nullable=True),
+        sa.Column('rating', sa.Integer(), nullable=False),
+        sa.Column('date', sa.DateTime(), nullable=True),
+        sa.Column('status', sa.String(), nullable=True),
+        sa.Column('text', sa.Text(), nullable=True),
+        sa.Column('main_text', sa.Text(), nullable=True),
+        sa.Column('pros_text', sa.Text(), nullable=True),
+        sa.Column('cons_text', sa.Text(), nullable=True),
+        sa.Column('sentiment_score', sa.Float(), nullable=True),
+        sa.Column('is_negative', sa.Integer(), nullable=True),
+        sa.Column('is_processed', sa.Integer(), nullable=True),
+        sa.Column('processing_notes', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('updated_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('user_id', sa.Integer(), nullable=True),
+        sa.Column('history_id', sa.Integer(), nullable=True),
+        sa.Column('is_deleted', sa.Boolean(), nullable=True),
+        sa.Column('deleted_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('wb_id', sa.String(), nullable=False),
+        sa.Column('aspects', sa.JSON(), nullable=True),
+        sa.Column('bables_resolved', sa.JSON(), nullable=True),
+        sa.Column('wb_updated_at', sa.DateTime(), nullable=True),
+        sa.Column('global_user_id', sa.String(), nullable=True),
+        sa.Column('wb_user_id', sa.Integer(), nullable=True),
+        sa.Column('content_hash', sa.String(), nullable=True),
+        sa.Column('suspected_deleted_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('superseded_by_wb_id', sa.String(), nullable=True),
+        sa.Column('top_tracking', sa.JSON(), nullable=True),
+        sa.Column('archive_reason', sa.String(length=20), nullable=False),
+        sa.Column('archived_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('idx_feedbacks_archive_brand_article', 'feedbacks_archive', ['brand', 'article'], unique=False)
+    op.create_index('idx_feedbacks_archive_wb_id_article_brand', 'feedbacks_archive', ['wb_id', 'article', 'brand'], unique=False)
+
+    op.execute(
+        f"CREATE VIEW feedbacks_all AS "
+        f"SELECT {COMMON_COLUMNS}, false AS is_archived FROM feedbacks "
+        f"UNION ALL "
+        f"SELECT {COMMON_COLUMNS}, true AS is_archived FROM feedbacks_archive"
+    )
+
+
+def downgrade():
+    op.execute('DROP VIEW IF EXISTS feedbacks_all')
+    op.drop_index('idx_feedbacks_archive_wb_id_article_brand', table_name='feedbacks_archive')
+    op.drop_index('idx_feedbacks_archive_brand_article', table_name='feedbacks_archive')
+    op.drop_table('feedbacks_archive')
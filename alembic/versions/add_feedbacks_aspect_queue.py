@@ -0,0 +1,59 @@
+"""add aspect analysis queue fields to feedbacks
+
+Revision ID: feedbacks_aspect_queue_001
+Revises: aspect_analysis_cache_001
+Create Date: 2026-10-19 22:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'feedbacks_aspect_queue_001'
+down_revision = 'aspect_analysis_cache_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('feedbacks', sa.Column('aspect_status', sa.String(length=16), nullable=False, server_default='pending'))
+    op.add_column('feedbacks', sa.Column('aspect_attempts', sa.Integer(), nullable=False, server_default='0'))
+    op.add_column('feedbacks', sa.Column('aspect_prompt_version', sa.String(length=32), nullable=True))
+    op.add_column('feedbacks', sa.Column('aspect_claimed_at', postgresql.TIMESTAMP(timezone=True), nullable=True))
+
+    op.add_column('feedbacks_archive', sa.Column('aspect_status', sa.String(length=16), nullable=True))
+    op.add_column('feedbacks_archive', sa.Column('aspect_attempts', sa.Integer(), nullable=True))
+    op.add_column('feedbacks_archive', sa.Column('aspect_prompt_version', sa.String(length=32), nullable=True))
+
+    # Уже проанализированные отзывы и отзывы без текста в очередь не попадают
+    op.execute("""
+        UPDATE feedbacks SET aspect_status = 'done'
+        WHERE aspects IS NOT NULL AND aspects::text NOT IN ('null', '[]', '{}', '[""]')
+    """)
+    op.execute("""
+        UPDATE feedbacks SET aspect_status = 'skipped'
+        WHERE aspect_status = 'pending'
+          AND btrim(coalesce("text", '') || coalesce(main_text, '') || coalesce(pros_text, '') || coalesce(cons_text, '')) = ''
+    """)
+
+    op.create_index(
+        'idx_feedbacks_aspect_pending', 'feedbacks', ['id'],
+        postgresql_where=sa.text("aspect_status = 'pending'")
+    )
+    op.create_index(
+        'idx_feedbacks_aspect_processing', 'feedbacks', ['aspect_claimed_at'],
+        postgresql_where=sa.text("aspect_status = 'processing'")
+    )
+
+
+def downgrade():
+    op.drop_index('idx_feedbacks_aspect_processing', table_name='feedbacks')
+    op.drop_index('idx_feedbacks_aspect_pending', table_name='feedbacks')
+    op.drop_column('feedbacks_archive', 'aspect_prompt_version')
+    op.drop_column('feedbacks_archive', 'aspect_attempts')
+    op.drop_column('feedbacks_archive', 'aspect_status')
+    op.drop_column('feedbacks', 'aspect_claimed_at')
+    op.drop_column('feedbacks', 'aspect_prompt_version')
+    op.drop_column('feedbacks', 'aspect_attempts')
+    op.drop_column('feedbacks', 'aspect_status')
@@ -0,0 +1,43 @@
+"""add fulltext search vector and author trigram index to feedbacks
+
+Revision ID: feedbacks_fts_001
+Revises: review_keyset_001
+Create Date: 2026-10-19 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'feedbacks_fts_001'
+down_revision = 'review_keyset_001'
+branch_labels = None
+depends_on = None
+
+# Должно совпадать с models.feedback.FEEDBACK_SEARCH_VECTOR_SQL
+SEARCH_VECTOR_SQL = (
+    "setweight(to_tsvector('russian', coalesce(main_text, '')), 'A') || "
+    "setweight(to_tsvector('russian', coalesce(pros_text, '')), 'B') || "
+    "setweight(to_tsvector('russian', coalesce(cons_text, '')), 'B') || "
+    "setweight(to_tsvector('russian', coalesce(\"text\", '')), 'D')"
+)
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.add_column(
+        'feedbacks',
+        sa.Column('search_vector', postgresql.TSVECTOR(), sa.Computed(SEARCH_VECTOR_SQL, persisted=True))
+    )
+    op.create_index('idx_feedbacks_search_vector', 'feedbacks', ['search_vector'], unique=False, postgresql_using='gin')
+    op.create_index(
+        'idx_feedbacks_author_trgm', 'feedbacks', ['author'], unique=False,
+        postgresql_using='gin', postgresql_ops={'author': 'gin_trgm_ops'}
+    )
+
+
+def downgrade():
+    op.drop_index('idx_feedbacks_author_trgm', table_name='feedbacks')
+    op.drop_index('idx_feedbacks_search_vector', table_name='feedbacks')
+    op.drop_column('feedbacks', 'search_vector')
@@ -0,0 +1,27 @@
+"""add partial index for feedbacks without sentiment score
+
+Revision ID: feedbacks_sentiment_pending_001
+Revises: feedbacks_aspect_queue_001
+Create Date: 2026-10-19 23:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'feedbacks_sentiment_pending_001'
+down_revision = 'feedbacks_aspect_queue_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Отзывы без оценки тональности: их выбирает crud/sentiment после синхронизации
+    op.create_index(
+        'idx_feedbacks_sentiment_pending', 'feedbacks', ['id'],
+        postgresql_where=sa.text("sentiment_score IS NULL")
+    )
+
+
+def downgrade():
+    op.drop_index('idx_feedbacks_sentiment_pending', table_name='feedbacks')
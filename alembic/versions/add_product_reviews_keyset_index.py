@@ -0,0 +1,28 @@
+"""add keyset index for product reviews tab
+
+Revision ID: product_reviews_keyset_001
+Revises: feedbacks_fts_001
+Create Date: 2026-10-19 14:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'product_reviews_keyset_001'
+down_revision = 'feedbacks_fts_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        'idx_feedbacks_article_date_id',
+        'feedbacks',
+        ['article', sa.text('date DESC'), sa.text('id DESC')],
+        unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('idx_feedbacks_article_date_id', table_name='feedbacks')
@@ -0,0 +1,38 @@
+"""add keyset indexes for review list
+
+Revision ID: review_keyset_001
+Revises: add_bables_resolved_001
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'review_keyset_001'
+down_revision = 'add_bables_resolved_001'
+branch_labels = None
+depends_on = None
+
+# Должно совпадать с выражением сортировки в crud/analytics.review_date_expr
+REVIEW_DATE_SQL = "coalesce(date, timezone('Europe/Moscow', created_at)) DESC"
+
+
+def upgrade():
+    op.create_index(
+        'idx_feedbacks_review_date_id',
+        'feedbacks',
+        [sa.text(REVIEW_DATE_SQL), sa.text('id DESC')],
+        unique=False
+    )
+    op.create_index(
+        'idx_feedbacks_brand_review_date_id',
+        'feedbacks',
+        ['brand', sa.text(REVIEW_DATE_SQL), sa.text('id DESC')],
+        unique=False
+    )
+
+
+def downgrade():
+    op.drop_index('idx_feedbacks_brand_review_date_id', table_name='feedbacks')
+    op.drop_index('idx_feedbacks_review_date_id', table_name='feedbacks')
@@ -0,0 +1,26 @@
+"""add claim fields to scheduled_tasks
+
+Revision ID: scheduled_tasks_claim_001
+Revises: wb_card_index_001
+Create Date: 2026-10-19 19:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = 'scheduled_tasks_claim_001'
+down_revision = 'wb_card_index_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('scheduled_tasks', sa.Column('claimed_at', postgresql.TIMESTAMP(timezone=True), nullable=True))
+    op.add_column('scheduled_tasks', sa.Column('duration_ms', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('scheduled_tasks', 'duration_ms')
+    op.drop_column('scheduled_tasks', 'claimed_at')
@@ -0,0 +1,51 @@
+"""add scheduled_tasks (status, scheduled_at) index and NOTIFY trigger
+
+Revision ID: scheduled_tasks_notify_001
+Revises: scheduled_tasks_claim_001
+Create Date: 2026-10-19 19:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'scheduled_tasks_notify_001'
+down_revision = 'scheduled_tasks_claim_001'
+branch_labels = None
+depends_on = None
+
+# Должно совпадать с models/task.py (SCHEDULED_TASKS_NOTIFY_*_SQL)
+NOTIFY_FUNCTION_SQL = """
+CREATE OR REPLACE FUNCTION notify_scheduled_tasks() RETURNS trigger AS $$
+BEGIN
+    IF NEW.status = 'pending' THEN
+        PERFORM pg_notify('scheduled_tasks', NEW.id::text);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+NOTIFY_TRIGGER_SQL = """
+CREATE TRIGGER scheduled_tasks_notify
+AFTER INSERT OR UPDATE OF status, scheduled_at ON scheduled_tasks
+FOR EACH ROW EXECUTE FUNCTION notify_scheduled_tasks()
+"""
+
+
+def upgrade():
+    op.create_index(
+        'idx_scheduled_tasks_status_scheduled_at',
+        'scheduled_tasks',
+        ['status', 'scheduled_at'],
+        unique=False
+    )
+    op.execute(NOTIFY_FUNCTION_SQL)
+    op.execute("DROP TRIGGER IF EXISTS scheduled_tasks_notify ON scheduled_tasks")
+    op.execute(NOTIFY_TRIGGER_SQL)
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS scheduled_tasks_notify ON scheduled_tasks")
+    op.execute("DROP FUNCTION IF EXISTS notify_scheduled_tasks()")
+    op.drop_index('idx_scheduled_tasks_status_scheduled_at', table_name='scheduled_tasks')
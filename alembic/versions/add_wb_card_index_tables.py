@@ -0,0 +1,63 @@
+"""add wb_card_index tables
+
+Revision ID: wb_card_index_001
+Revises: feedbacks_archive_001
+Create Date: 2026-10-19 18:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'wb_card_index_001'
+down_revision = 'feedbacks_archive_001'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'wb_card_index',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('brand', sa.String(), nullable=False),
+        sa.Column('nm_id', sa.BigInteger(), nullable=False),
+        sa.Column('vendor_code', sa.String(), nullable=True),
+        sa.Column('card', sa.JSON(), nullable=False),
+        sa.Column('wb_updated_at', sa.String(length=64), nullable=True),
+        sa.Column('synced_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'brand', 'nm_id', name='uq_wb_card_index_user_brand_nm')
+    )
+    op.create_index(op.f('ix_wb_card_index_id'), 'wb_card_index', ['id'], unique=False)
+    op.create_index(
+        'idx_wb_card_index_user_brand_vendor',
+        'wb_card_index',
+        ['user_id', 'brand', sa.text('lower(vendor_code)')],
+        unique=False
+    )
+
+    op.create_table(
+        'wb_card_index_state',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('user_id', sa.Integer(), nullable=False),
+        sa.Column('brand', sa.String(), nullable=False),
+        sa.Column('cursor_updated_at', sa.String(length=64), nullable=True),
+        sa.Column('cursor_nm_id', sa.BigInteger(), nullable=True),
+        sa.Column('is_stale', sa.Boolean(), nullable=False, server_default=sa.false()),
+        sa.Column('synced_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('full_synced_at', sa.DateTime(timezone=True), nullable=True),
+        sa.ForeignKeyConstraint(['user_id'], ['users.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('user_id', 'brand', name='uq_wb_card_index_state_user_brand')
+    )
+    op.create_index(op.f('ix_wb_card_index_state_id'), 'wb_card_index_state', ['id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_wb_card_index_state_id'), table_name='wb_card_index_state')
+    op.drop_table('wb_card_index_state')
+    op.drop_index('idx_wb_card_index_user_brand_vendor', table_name='wb_card_index')
+    op.drop_index(op.f('ix_wb_card_index_id'), table_name='wb_card_index')
+    op.drop_table('wb_card_index')
@@ -27,6 +27,51 @@ class Settings:
     DEEPSEEK_TOKEN: Optional[str] = os.getenv("DEEPSEEK_TOKEN", "")
     OPENROUTER_API_KEY: Optional[str] = os.getenv("OPENROUTER_API_KEY", "")
     AI_MODEL_NAME: str = os.getenv("AI_MODEL_NAME", "deepseek")
+    # Таймауты запросов к OpenRouter (секунды): весь ответ и установка соединения
+    AI_REQUEST_TIMEOUT_SECONDS: float = float(os.getenv("AI_REQUEST_TIMEOUT_SECONDS", "180"))
+    AI_CONNECT_TIMEOUT_SECONDS: float = float(os.getenv("AI_CONNECT_TIMEOUT_SECONDS", "10"))
+    # Каскад анализа аспектов: локальная разметка уверенных отзывов до ИИ, порог уверенности
+    # и доля размеченных локально отзывов, которые всё равно отправляются в ИИ для оценки согласия
+    ASPECT_TRIAGE_ENABLED: bool = os.getenv("ASPECT_TRIAGE_ENABLED", "true").lower() == "true"
+    ASPECT_TRIAGE_MIN_CONFIDENCE: float = float(os.getenv("ASPECT_TRIAGE_MIN_CONFIDENCE", "0.8"))
+    ASPECT_TRIAGE_AUDIT_RATE: float = float(os.getenv("ASPECT_TRIAGE_AUDIT_RATE", "0.05"))
+    # Очередь анализа аспектов: попыток на отзыв и аренда взятых в работу отзывов (минуты)
+    ASPECT_MAX_ATTEMPTS: int = int(os.getenv("ASPECT_MAX_ATTEMPTS", "3"))
+    ASPECT_LEASE_MINUTES: int = int(os.getenv("ASPECT_LEASE_MINUTES", "30"))
+    # Локальная оценка тональности отзывов (utils/sentiment_scorer): модель, длина текста в токенах,
+    # батч (штук и токенов с паддингом), потоки torch (0 - по умолчанию torch) и int8-квантование
+    SENTIMENT_ENABLED: bool = os.getenv("SENTIMENT_ENABLED", "true").lower() == "true"
+    SENTIMENT_MODEL_NAME: str = os.getenv("SENTIMENT_MODEL_NAME", "seara/rubert-tiny2-russian-sentiment")
+    SENTIMENT_MAX_LENGTH: int = int(os.getenv("SENTIMENT_MAX_LENGTH", "256"))
+    SENTIMENT_BATCH_SIZE: int = int(os.getenv("SENTIMENT_BATCH_SIZE", "64"))
+    SENTIMENT_BATCH_TOKENS: int = int(os.getenv("SENTIMENT_BATCH_TOKENS", "8192"))
+    SENTIMENT_NUM_THREADS: int = int(os.getenv("SENTIMENT_NUM_THREADS", "4"))
+    SENTIMENT_QUANTIZE: bool = os.getenv("SENTIMENT_QUANTIZE", "true").lower() == "true"
+    # Сколько отзывов выбирать из БД за один проход оценки и сколько оценивать за цикл планировщика на бренд
+    SENTIMENT_DB_CHUNK: int = int(os.getenv("SENTIMENT_DB_CHUNK", "1000"))
+    SENTIMENT_CYCLE_LIMIT: int = int(os.getenv("SENTIMENT_CYCLE_LIMIT", "5000"))
+    # Пауза (минуты) перед повторной загрузкой модели после ошибки; 0 - не повторять до перезапуска
+    SENTIMENT_LOAD_RETRY_MINUTES: int = int(os.getenv("SENTIMENT_LOAD_RETRY_MINUTES", "60"))
+
+    # Архив отзывов: горизонт аналитики и задержка архивации удалённых (в днях)
+    FEEDBACK_ARCHIVE_HORIZON_DAYS: int = int(os.getenv("FEEDBACK_ARCHIVE_HORIZON_DAYS", "730"))
+    FEEDBACK_ARCHIVE_DELETED_AFTER_DAYS: int = int(os.getenv("FEEDBACK_ARCHIVE_DELETED_AFTER_DAYS", "30"))
+
+    # Локальный индекс карточек WB: TTL инкрементальной досинхронизации и период полного прохода
+    CARD_INDEX_TTL_SECONDS: int = int(os.getenv("CARD_INDEX_TTL_SECONDS", "120"))
+    CARD_INDEX_FULL_REFRESH_HOURS: int = int(os.getenv("CARD_INDEX_FULL_REFRESH_HOURS", "24"))
+
+    # Воркеры запланированных задач: параллельность в процессе, на бренд и аренда задачи (минуты)
+    TASK_WORKER_CONCURRENCY: int = int(os.getenv("TASK_WORKER_CONCURRENCY", "8"))
+    TASK_WORKER_BRAND_CONCURRENCY: int = int(os.getenv("TASK_WORKER_BRAND_CONCURRENCY", "2"))
+    TASK_LEASE_MINUTES: int = int(os.getenv("TASK_LEASE_MINUTES", "15"))
+
+    # Хранилище медиафайлов запланированных загрузок (файлы по sha256)
+    BLOB_STORE_DIR: str = os.getenv("BLOB_STORE_DIR", str(Path(__file__).parent / "media_blobs"))
+
+    # Кеш расшифрованных API-ключей: время жизни (секунды) и максимум записей
+    API_KEY_CACHE_TTL_SECONDS: int = int(os.getenv("API_KEY_CACHE_TTL_SECONDS", "300"))
+    API_KEY_CACHE_MAX_ENTRIES: int = int(os.getenv("API_KEY_CACHE_MAX_ENTRIES", "1024"))
 
 
 settings = Settings()
\ No newline at end of file
@@ -6,7 +6,7 @@ from typing import Dict
 
 from sqlalchemy.orm.attributes import flag_modified
 
-from crud.user import get_user_by_email
+from crud.user import get_user_by_email, invalidate_decrypted_wb_keys
 from models import User
 from schemas import BrandCreate, BrandUpdate, UserCreate
 from utils.password import verify_password, get_password_hash, encrypt_api_dict, decrypt_api_dict, encrypt_api_key
@@ -49,6 +49,7 @@ async def create_brand(
         flag_modified(user, "wb_api_key")
 
         await db.commit()
+        invalidate_decrypted_wb_keys(user_id, brand_data.name)
         await db.refresh(user)
         return user.wb_api_key
 
@@ -96,6 +97,9 @@ async def update_brand(
         flag_modified(user, "imagebb_key")
 
         await db.commit()
+        # Старое и новое имя бренда
+        invalidate_decrypted_wb_keys(user_id, brand_name)
+        invalidate_decrypted_wb_keys(user_id, brand_data.name)
         await db.refresh(user)
         return {
             "wb_api_key": user.wb_api_key,
@@ -139,6 +143,7 @@ async def delete_brand(
 
         # Сохраняем изменения
         await db.commit()
+        invalidate_decrypted_wb_keys(user_id, brand_name)
         await db.refresh(user)
 
         return user.wb_api_key
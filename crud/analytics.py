@@ -1,10 +1,13 @@
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 from datetime import datetime, date, timedelta
-from sqlalchemy import select, func, and_, or_, desc, asc, case, literal_column, text
+from fastapi import HTTPException
+from sqlalchemy import select, func, and_, or_, desc, asc, case, literal_column, text, tuple_
 from models.feedback import Feedback, FeedbackTopTracking
 from database import AsyncSessionLocal
 import asyncio
+import base64
+import re
 
 import logging
 logger = logging.getLogger(__name__)
@@ -85,6 +88,90 @@ async def get_user_shopsList_crud(
     return shops
 
 
+def review_date_expr(source=Feedback):
+    """Дата отзыва для сортировки/фильтрации ленты (совпадает с индексом idx_feedbacks_review_date_id).
+
+    source - Feedback, FeedbackArchive или алиас feedbacks_with_archived_deleted().
+    """
+    # Часовой пояс литералом: с bind-параметром планировщик не сопоставит выражение с индексом
+    return func.coalesce(source.date, func.timezone(literal_column("'Europe/Moscow'"), source.created_at))
+
+
+def encode_review_cursor(review_date: Optional[datetime], review_id: int) -> str:
+    """Курсор keyset-пагинации: позиция последнего отзыва страницы"""
+    raw = f"{review_date.isoformat() if review_date else ''}|{review_id}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_review_cursor(cursor: str) -> Tuple[Optional[datetime], int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        date_part, id_part = raw.rsplit('|', 1)
+        return (datetime.fromisoformat(date_part) if date_part else None), int(id_part)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Некорректный курсор пагинации")
+
+
+def review_cursor_condition(sort_expr, cursor: str, id_column=Feedback.id):
+    """Условие "после курсора" для сортировки (sort_expr DESC, id_column DESC)"""
+    cursor_date, cursor_id = decode_review_cursor(cursor)
+    if cursor_date is not None:
+        # Сравнение кортежей обслуживается индексом (дата, id) напрямую
+        return tuple_(sort_expr, id_column) < tuple_(cursor_date, cursor_id)
+    # Отзывы без даты идут первыми (NULLS FIRST при DESC): добираем их по id, затем все датированные
+    return or_(
+        and_(sort_expr.is_(None), id_column < cursor_id),
+        sort_expr.isnot(None)
+    )
+
+
+def build_review_tsquery(search: str):
+    """Строит tsquery (russian) из строки поиска.
+
+    "фраза в кавычках" -> phraseto_tsquery, слово* -> префиксный поиск, остальные слова -> plainto_tsquery.
+    Все части объединяются через AND. Возвращает None, если в строке нет слов.
+    """
+    parts = []
+
+    for phrase in re.findall(r'"([^"]+)"', search):
+        if re.search(r'\w', phrase):
+            parts.append(func.phraseto_tsquery('russian', phrase))
+    rest = re.sub(r'"[^"]*"', ' ', search)
+
+    plain_words = []
+    for token in rest.split():
+        words = re.findall(r'\w+', token)
+        if not words:
+            continue
+        if token.endswith('*'):
+            # В to_tsquery передаём только буквенно-цифровые фрагменты, синтаксис собираем сами
+            parts.append(func.to_tsquery('russian', ' & '.join(f"{w}:*" for w in words)))
+        else:
+            plain_words.extend(words)
+    if plain_words:
+        parts.append(func.plainto_tsquery('russian', ' '.join(plain_words)))
+
+    if not parts:
+        return None
+    tsquery = parts[0]
+    for part in parts[1:]:
+        tsquery = tsquery.op('&&')(part)
+    return tsquery
+
+
+async def estimate_feedbacks_count(db: AsyncSession) -> int:
+    """Оценка числа строк feedbacks по статистике планировщика (pg_class.reltuples)"""
+    result = await db.execute(
+        text("SELECT reltuples::bigint FROM pg_class WHERE oid = 'feedbacks'::regclass")
+    )
+    estimate = result.scalar() or 0
+    # reltuples = -1, пока таблица ни разу не анализировалась
+    if estimate < 0:
+        result = await db.execute(select(func.count(Feedback.id)))
+        estimate = result.scalar() or 0
+    return int(estimate)
+
+
 async def get_reviews_with_filters_crud(
         db: AsyncSession,
         user_id: int,
@@ -97,30 +184,60 @@ async def get_reviews_with_filters_crud(
         date_from: Optional[date] = None,
         date_to: Optional[date] = None,
         negative: Optional[bool] = None,
-        deleted: Optional[bool] = None
+        deleted: Optional[bool] = None,
+        cursor: Optional[str] = None,
+        count_mode: str = "exact",
+        search_mode: str = "substring"
 ) -> Dict[str, Any]:
-    """Получение отзывов с расширенной фильтрацией"""
-    offset = (page - 1) * per_page
+    """Получение отзывов с расширенной фильтрацией
 
-    # Базовый запрос - убираем фильтр по user_id, чтобы все отзывы были доступны всем
-    query = select(Feedback)
-
-    # Применяем фильтры
-    if search:
-        search_filter = or_(
-            Feedback.text.ilike(f"%{search}%"),
-            Feedback.main_text.ilike(f"%{search}%"),
-            Feedback.pros_text.ilike(f"%{search}%"),
-            Feedback.cons_text.ilike(f"%{search}%"),
-            Feedback.author.ilike(f"%{search}%")
-        )
-        query = query.where(search_filter)
+    Если передан cursor (next_cursor предыдущей страницы), используется keyset-пагинация
+    по (дата отзыва, id) вместо OFFSET. count_mode="estimated" для выборки без фильтров
+    берёт total из статистики pg_class вместо count(*).
+
+    search_mode="substring" (по умолчанию) - ILIKE по всем полям, порядок по дате.
+    search_mode="fulltext" ищет по search_vector (GIN) и автору (триграммы), сортируя по ts_rank;
+    поддерживаются "фразы" и префиксы слово*.
+
+    deleted=True читает и удалённые отзывы, уже перенесённые в архив (feedbacks_with_archived_deleted).
+    """
+    offset = (page - 1) * per_page
+    source = Feedback
+    if deleted:
+        # Удалённые отзывы через FEEDBACK_ARCHIVE_DELETED_AFTER_DAYS уходят в архив - читаем и его
+        from crud.feedback_archive import feedbacks_with_archived_deleted
+        source = feedbacks_with_archived_deleted()
+    review_date = review_date_expr(source)
+    rank = None
+
+    # Условия фильтрации - без фильтра по user_id, чтобы все отзывы были доступны всем
+    conditions = []
+
+    if search and search_mode == "fulltext":
+        tsquery = build_review_tsquery(search)
+        author_term = search.strip().strip('"').rstrip('*')
+        if tsquery is not None:
+            conditions.append(or_(
+                source.search_vector.op('@@')(tsquery),
+                source.author.ilike(f"%{author_term}%")
+            ))
+            rank = func.ts_rank(source.search_vector, tsquery)
+        else:
+            conditions.append(source.author.ilike(f"%{author_term}%"))
+    elif search:
+        conditions.append(or_(
+            source.text.ilike(f"%{search}%"),
+            source.main_text.ilike(f"%{search}%"),
+            source.pros_text.ilike(f"%{search}%"),
+            source.cons_text.ilike(f"%{search}%"),
+            source.author.ilike(f"%{search}%")
+        ))
 
     if rating:
-        query = query.where(Feedback.rating == rating)
+        conditions.append(source.rating == rating)
 
     if shop:
-        query = query.where(Feedback.brand == shop)
+        conditions.append(source.brand == shop)
 
     if product:
         logger.debug(f"[DEBUG] ===== ФИЛЬТР ПО ТОВАРУ =====")
@@ -136,11 +253,11 @@ async def get_reviews_with_filters_crud(
 
         if product_values and len(product_values) > 1:
             logger.debug(f"[DEBUG] Применяем фильтр по множеству vendor_code: {product_values}")
-            query = query.where(Feedback.vendor_code.in_(product_values))
+            conditions.append(source.vendor_code.in_(product_values))
         elif product_values:
             single = product_values[0]
             logger.debug(f"[DEBUG] Применяем фильтр по одному vendor_code: {single}")
-            query = query.where(Feedback.vendor_code == single)
+            conditions.append(source.vendor_code == single)
         else:
             # на случай пустой строки после split — фильтр не применяем
             logger.debug(f"[DEBUG] Пустой фильтр product после парсинга — пропускаем")
@@ -148,92 +265,119 @@ async def get_reviews_with_filters_crud(
         logger.debug(f"[DEBUG] Фильтр по товару не применяется (product = {product})")
 
     if date_from:
-        query = query.where(func.coalesce(Feedback.date, Feedback.created_at) >= date_from)
+        conditions.append(review_date >= date_from)
 
     if date_to:
-        query = query.where(func.coalesce(Feedback.date, Feedback.created_at) <= date_to)
+        conditions.append(review_date <= date_to)
 
     if negative is not None:
-        query = query.where(Feedback.is_negative == (1 if negative else 0))
+        conditions.append(source.is_negative == (1 if negative else 0))
 
     # Фильтрация по удалённости
     if deleted is not None:
-        query = query.where(Feedback.is_deleted == deleted)
+        conditions.append(source.is_deleted == deleted)
 
-    # Получаем общее количество
-    count_query = select(func.count()).select_from(query.subquery())
-    logger.debug(f"[DEBUG] Запрос для подсчета: {count_query}")
-    total_result = await db.execute(count_query)
-    total = total_result.scalar()
+    # Получаем общее количество: count(*) по условиям, без подзапроса с полными строками
+    total_is_estimate = False
+    if count_mode == "estimated" and not conditions:
+        total = await estimate_feedbacks_count(db)
+        total_is_estimate = True
+    else:
+        count_query = select(func.count(source.id)).where(*conditions)
+        logger.debug(f"[DEBUG] Запрос для подсчета: {count_query}")
+        total_result = await db.execute(count_query)
+        total = total_result.scalar() or 0
     logger.debug(f"[DEBUG] Общее количество записей: {total}")
 
-    # Получаем отзывы с пагинацией
-    final_query = query.order_by(desc(func.coalesce(Feedback.date, Feedback.created_at)), desc(Feedback.id)).offset(offset).limit(per_page)
+    # Выбираем только поля, которые реально уходят в ответ
+    query = select(
+        source.id,
+        source.article,
+        source.brand,
+        source.author,
+        source.rating,
+        source.main_text,
+        source.pros_text,
+        source.cons_text,
+        source.is_processed,
+        source.is_deleted,
+        review_date.label('review_date')
+    ).where(*conditions)
+
+    order_by = [desc(review_date), desc(source.id)]
+    if rank is not None:
+        # Ранжированная выдача: keyset по дате неприменим, листаем через OFFSET
+        query = query.offset(offset)
+        order_by.insert(0, desc(rank))
+    elif cursor:
+        query = query.where(review_cursor_condition(review_date, cursor, source.id))
+    else:
+        query = query.offset(offset)
+
+    final_query = query.order_by(*order_by).limit(per_page)
     logger.debug(f"[DEBUG] Финальный запрос с пагинацией: {final_query}")
     result = await db.execute(final_query)
-    feedbacks = result.scalars().all()
-    logger.debug(f"[DEBUG] Получено отзывов: {len(feedbacks)}")
+    rows = result.fetchall()
+    logger.debug(f"[DEBUG] Получено отзывов: {len(rows)}")
 
-    # Формируем ответ
-    reviews = []
-    
-    # Получаем vendor_code для всех товаров
-    article_ids = [f.article for f in feedbacks if f.article]
+    # Получаем vendor_code для всех товаров страницы одним запросом
+    article_ids = {str(row.article) for row in rows if row.article}
     vendor_codes = {}
     if article_ids:
-        # Получаем vendor_code из feedbacks по nm_id (article)
-        for article_id in article_ids:
-            article_str = str(article_id)
-            # Ищем vendor_code в feedbacks - убираем фильтр по user_id
-            vendor_code_query = select(Feedback.vendor_code).where(
-                Feedback.article == article_str
-            ).limit(1)
-            vendor_code_result = await db.execute(vendor_code_query)
-            vendor_code = vendor_code_result.scalar()
-            vendor_codes[article_str] = vendor_code or article_str
-    
+        vendor_code_query = select(
+            Feedback.article, func.max(Feedback.vendor_code)
+        ).where(
+            Feedback.article.in_(article_ids)
+        ).group_by(Feedback.article)
+        vendor_code_result = await db.execute(vendor_code_query)
+        for article_id, vendor_code in vendor_code_result.fetchall():
+            vendor_codes[str(article_id)] = vendor_code or str(article_id)
 
-    
-    for feedback in feedbacks:
+    # Формируем ответ
+    reviews = []
+    for row in rows:
         # Определяем sentiment на основе рейтинга
-        if feedback.rating >= 4:
+        if row.rating >= 4:
             sentiment = "positive"
-        elif feedback.rating <= 2:
+        elif row.rating <= 2:
             sentiment = "negative"
         else:
             sentiment = "neutral"
 
-        dt = feedback.date if feedback.date else feedback.created_at
-        
+        dt = row.review_date
+
         # Получаем vendor_code для товара
-        article_str = str(feedback.article) if feedback.article else ""
+        article_str = str(row.article) if row.article else ""
         vendor_code = vendor_codes.get(article_str, article_str)
-        
-        # Логируем данные для отладки
-        logger.debug(f"[DEBUG] Отзыв {feedback.id}: pros_text='{feedback.pros_text}', cons_text='{feedback.cons_text}', main_text='{feedback.main_text}'")
-        
+
         reviews.append({
-            "id": feedback.id,
-            "main_text": feedback.main_text or "",
-            "pros_text": feedback.pros_text or "",
-            "cons_text": feedback.cons_text or "",
-            "rating": feedback.rating,
-            "author_name": feedback.author or "Аноним",
+            "id": row.id,
+            "main_text": row.main_text or "",
+            "pros_text": row.pros_text or "",
+            "cons_text": row.cons_text or "",
+            "rating": row.rating,
+            "author_name": row.author or "Аноним",
             "product_name": f"товар {vendor_code}",
-            "shop_name": feedback.brand,
+            "shop_name": row.brand,
             "created_at": dt.isoformat() if dt else None,
             "photos": [],  # Пока нет фото в модели
             "sentiment": sentiment,
-            "is_processed": bool(feedback.is_processed),
-            "is_deleted": bool(getattr(feedback, "is_deleted", False))
+            "is_processed": bool(row.is_processed),
+            "is_deleted": bool(row.is_deleted)
         })
 
+    next_cursor = None
+    if len(rows) == per_page and rank is None:
+        next_cursor = encode_review_cursor(rows[-1].review_date, rows[-1].id)
+
     return {
         "reviews": reviews,
         "total": total,
+        "total_is_estimate": total_is_estimate,
         "page": page,
         "per_page": per_page,
-        "total_pages": (total + per_page - 1) // per_page
+        "total_pages": (total + per_page - 1) // per_page,
+        "next_cursor": next_cursor
     }
 
 
@@ -1837,36 +1981,21 @@ async def parse_shop_feedbacks_crud(
             end_date_str = datetime.now().strftime('%Y-%m-%d')
             start_date_str = (datetime.now() - timedelta(days=90)).strftime('%Y-%m-%d')
 
-            stocks_resp = await wb_client.get_stocks_report_products(nm_ids=nm_ids, start_date=start_date_str, end_date=end_date_str)
-            if stocks_resp.success and isinstance(stocks_resp.data, dict):
-                # Ожидаем структуру с данными по товарам; оставляем только nmID со stockCount > 0
+            # Карта остатков кешируется на цикл парсинга и доступна другим потребителям через get_stock_map
+            stock_map = await wb_client.get_stock_map(nm_ids=nm_ids, start_date=start_date_str, end_date=end_date_str)
+            if stock_map is not None:
+                # Оставляем только nmID со stockCount > 3
                 in_stock_nm_ids = set()
-                # Актуальная схема: data.items — массив TableProductItemSt
-                data_obj = stocks_resp.data.get('data') if isinstance(stocks_resp.data.get('data'), dict) else None
-                items_arr = (data_obj or {}).get('items') if data_obj else None
-                if isinstance(items_arr, list):
-                    # Дополнительный подробный лог per nmID для диагностики остатков
-                    details_logger = get_stock_filter_logger()
-                    logger.info(f"[PARSE] stocks-report вернул items: {len(items_arr)}")
-                    for p in items_arr:
-                        try:
-                            nm = p.get('nmID')
-                            if nm is None:
-                                continue
-                            metrics = p.get('metrics') or {}
-                            stock_count = metrics.get('stockCount', 0) or 0
-                            try:
-                                stock_int = int(stock_count)
-                            except Exception:
-                                stock_int = 0
-                            try:
-                                details_logger.info(f"[STOCK_DETAIL] nmID={nm} stockCount={stock_int} included={'YES' if stock_int>3 else 'NO'}")
-                            except Exception:
-                                pass
-                            if stock_int > 3:
-                                in_stock_nm_ids.add(int(nm))
-                        except Exception:
-                            continue
+                # Дополнительный подробный лог per nmID для диагностики остатков
+                details_logger = get_stock_filter_logger()
+                logger.info(f"[PARSE] stocks-report вернул items: {len(stock_map)}")
+                for nm, stock_int in stock_map.items():
+                    try:
+                        details_logger.info(f"[STOCK_DETAIL] nmID={nm} stockCount={stock_int} included={'YES' if stock_int>3 else 'NO'}")
+                    except Exception:
+                        pass
+                    if stock_int > 3:
+                        in_stock_nm_ids.add(nm)
                 # Применяем фильтр ВСЕГДА: если мн-во пусто — парсинг не запустится (items станет пустым)
                 before = len(items)
                 items = [it for it in items if int(it.get('nmID', 0)) in in_stock_nm_ids]
@@ -1877,7 +2006,7 @@ async def parse_shop_feedbacks_crud(
                 except Exception:
                     pass
             else:
-                logger.warning(f"[PARSE] Не удалось получить stocks-report: {stocks_resp.error}; продолжаем без фильтрации")
+                logger.warning(f"[PARSE] Не удалось получить stocks-report; продолжаем без фильтрации")
         except Exception as e:
             logger.warning(f"[PARSE] Ошибка при фильтрации остатков: {e}; продолжаем без фильтрации")
 
@@ -0,0 +1,68 @@
+from typing import Dict, Any, Iterable
+from datetime import datetime
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+import hashlib
+import logging
+import re
+
+from models.aspect import AspectAnalysisCache
+from zoneinfo import ZoneInfo
+
+
+def moscow_now():
+    return datetime.now(ZoneInfo("Europe/Moscow"))
+
+logger = logging.getLogger(__name__)
+
+_NON_WORD_RE = re.compile(r'[^\w\s]+')
+_SPACES_RE = re.compile(r'\s+')
+
+
+def normalize_review_text(text: str) -> str:
+    """Текст отзыва для ключа кеша: регистр, ё/е, пунктуация и эмодзи, лишние пробелы не различаются"""
+    text = (text or "").lower().replace('ё', 'е')
+    text = _NON_WORD_RE.sub(' ', text)
+    return _SPACES_RE.sub(' ', text).strip()
+
+
+def make_cache_key(text: str, rating: int, prompt_version: str, model: str) -> str:
+    raw = "\x1f".join([normalize_review_text(text), str(rating or 0), prompt_version, model])
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+async def get_cached_analyses(db: AsyncSession, cache_keys: Iterable[str]) -> Dict[str, Dict[str, Any]]:
+    """Аспекты из кеша по ключам (без commit - в транзакции обработки батча)"""
+    cache_keys = list(set(cache_keys))
+    if not cache_keys:
+        return {}
+    result = await db.execute(
+        select(AspectAnalysisCache.cache_key, AspectAnalysisCache.aspects)
+        .where(AspectAnalysisCache.cache_key.in_(cache_keys))
+    )
+    cached = {cache_key: aspects for cache_key, aspects in result}
+    if cached:
+        await db.execute(
+            update(AspectAnalysisCache)
+            .where(AspectAnalysisCache.cache_key.in_(list(cached)))
+            .values(hits=AspectAnalysisCache.hits + 1, last_hit_at=moscow_now())
+        )
+    return cached
+
+
+async def store_analyses(db: AsyncSession, analyses: Dict[str, Dict[str, Any]], prompt_version: str, model: str) -> None:
+    """Сохраняет аспекты новых анализов; параллельный воркер мог записать тот же ключ - он не перезаписывается"""
+    if not analyses:
+        return
+    stmt = pg_insert(AspectAnalysisCache).values([
+        {
+            "cache_key": cache_key,
+            "prompt_version": prompt_version,
+            "model": model,
+            "aspects": aspects,
+            "hits": 0,
+        }
+        for cache_key, aspects in analyses.items()
+    ]).on_conflict_do_nothing(index_elements=[AspectAnalysisCache.cache_key])
+    await db.execute(stmt)
@@ -0,0 +1,80 @@
+from typing import List, Optional
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, and_, or_, func
+from sqlalchemy.ext.asyncio import AsyncSession
+import logging
+
+from models.feedback import Feedback
+from zoneinfo import ZoneInfo
+
+
+def moscow_now():
+    return datetime.now(ZoneInfo("Europe/Moscow"))
+
+logger = logging.getLogger(__name__)
+
+ASPECT_STATUS_PENDING = 'pending'
+ASPECT_STATUS_PROCESSING = 'processing'
+ASPECT_STATUS_DONE = 'done'
+ASPECT_STATUS_FAILED = 'failed'
+ASPECT_STATUS_SKIPPED = 'skipped'
+
+
+async def claim_feedbacks_for_aspects(
+    db: AsyncSession,
+    limit: int,
+    brand: Optional[str] = None,
+    lease_minutes: int = 30
+) -> List[int]:
+    """Атомарно забирает до limit отзывов на анализ аспектов: pending -> processing, attempts + 1.
+
+    FOR UPDATE SKIP LOCKED позволяет нескольким воркерам разбирать очередь параллельно без дублей.
+    Отзывы, зависшие в processing дольше lease_minutes (упавший воркер), забираются повторно.
+    """
+    now = moscow_now()
+    queued = or_(
+        Feedback.aspect_status == ASPECT_STATUS_PENDING,
+        and_(
+            Feedback.aspect_status == ASPECT_STATUS_PROCESSING,
+            Feedback.aspect_claimed_at < now - timedelta(minutes=lease_minutes)
+        )
+    )
+    claim_ids = select(Feedback.id).where(queued)
+    if brand:
+        claim_ids = claim_ids.where(Feedback.brand == brand)
+    claim_ids = claim_ids.order_by(Feedback.id).limit(limit).with_for_update(skip_locked=True)
+
+    result = await db.execute(
+        update(Feedback)
+        .where(Feedback.id.in_(claim_ids.scalar_subquery()))
+        .values(
+            aspect_status=ASPECT_STATUS_PROCESSING,
+            aspect_claimed_at=now,
+            aspect_attempts=Feedback.aspect_attempts + 1
+        )
+        .returning(Feedback.id)
+        .execution_options(synchronize_session=False)
+    )
+    ids = sorted(row.id for row in result)
+    await db.commit()
+    return ids
+
+
+async def release_feedbacks(db: AsyncSession, feedback_ids: List[int], refund_attempt: bool = True) -> None:
+    """Возвращает взятые отзывы в очередь (ошибка всего батча).
+
+    refund_attempt=True - временный сбой (недоступность БД): попытка, засчитанная при взятии, возвращается.
+    При прочих ошибках попытка остается потраченной, и после ASPECT_MAX_ATTEMPTS отзыв уходит в failed.
+    """
+    if not feedback_ids:
+        return
+    values = {"aspect_status": ASPECT_STATUS_PENDING, "aspect_claimed_at": None}
+    if refund_attempt:
+        values["aspect_attempts"] = func.greatest(Feedback.aspect_attempts - 1, 0)
+    await db.execute(
+        update(Feedback)
+        .where(and_(Feedback.id.in_(feedback_ids), Feedback.aspect_status == ASPECT_STATUS_PROCESSING))
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    await db.commit()
@@ -0,0 +1,131 @@
+from typing import Dict, Any, List, Optional
+from collections import defaultdict
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+import json
+import logging
+
+from models.aspect import Aspect, FeedbackAspect
+
+logger = logging.getLogger(__name__)
+
+# Длины колонок aspects.name / aspects.category / feedback_aspects.sentiment
+ASPECT_NAME_MAX_LENGTH = 100
+ASPECT_CATEGORY_MAX_LENGTH = 50
+SENTIMENT_MAX_LENGTH = 20
+
+FEEDBACK_ASPECT_COPY_COLUMNS = ['feedback_id', 'aspect_name', 'sentiment', 'confidence', 'evidence_words']
+
+
+def normalize_aspect_name(name: str) -> str:
+    return str(name).strip()[:ASPECT_NAME_MAX_LENGTH]
+
+
+class AspectRegistry:
+    """Справочник аспектов на время прогона анализа.
+
+    Загружается одним запросом (name -> id/category), использования аспектов копятся в памяти
+    и записываются одним INSERT ... ON CONFLICT (name) DO UPDATE, связи с отзывами - через COPY.
+    Запись идет в транзакции вызывающего кода (без commit).
+    """
+
+    def __init__(self):
+        self.aspects: Dict[str, Dict[str, Any]] = {}  # name -> {"id", "category", "usage_count"}
+        self.loaded = False
+        self._usage: Dict[str, int] = defaultdict(int)
+        self._attributes: Dict[str, Dict[str, Any]] = {}
+        self._links: List[tuple] = []
+
+    async def load(self, db: AsyncSession) -> None:
+        if self.loaded:
+            return
+        result = await db.execute(select(Aspect.id, Aspect.name, Aspect.category, Aspect.usage_count))
+        self.aspects = {
+            name: {"id": aspect_id, "category": category, "usage_count": usage_count or 0}
+            for aspect_id, name, category, usage_count in result
+        }
+        self.loaded = True
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        return self.aspects.get(normalize_aspect_name(name))
+
+    def add_usage(self, name: str, aspect_data: Dict[str, Any]) -> Dict[str, Any]:
+        """+1 использование аспекта; новый аспект появляется в справочнике сразу, id - после flush"""
+        name = normalize_aspect_name(name)
+        entry = self.aspects.get(name)
+        if entry is None:
+            entry = {
+                "id": None,
+                "category": str(aspect_data.get("category") or "Общие")[:ASPECT_CATEGORY_MAX_LENGTH],
+                "usage_count": 0
+            }
+            self.aspects[name] = entry
+        entry["usage_count"] += 1
+        self._usage[name] += 1
+        self._attributes[name] = {
+            "category": entry["category"],
+            "description": aspect_data.get("description") or "",
+            "is_new_aspect": bool(aspect_data.get("is_new_aspect", False)),
+        }
+        return entry
+
+    @staticmethod
+    def build_link(feedback_id: int, name: str, aspect_data: Dict[str, Any]) -> tuple:
+        """Строка feedback_aspects; некорректные данные аспекта дают исключение до записи в буфер"""
+        return (
+            feedback_id,
+            normalize_aspect_name(name),
+            str(aspect_data["sentiment"])[:SENTIMENT_MAX_LENGTH],
+            int(float(aspect_data["confidence"]) * 100),  # Конвертируем в 0-100
+            json.dumps(aspect_data["evidence"], ensure_ascii=False),
+        )
+
+    def add_links(self, links: List[tuple]) -> None:
+        self._links.extend(links)
+
+    async def flush(self, db: AsyncSession) -> Dict[str, int]:
+        """Записывает накопленные счетчики и связи; возвращает число аспектов и связей"""
+        flushed = {"aspects": len(self._usage), "links": len(self._links)}
+        if self._usage:
+            new_names = [name for name in self._usage if self.aspects[name]["id"] is None]
+            # Сортировка по имени - одинаковый порядок блокировок у параллельных воркеров
+            rows = [
+                {
+                    "name": name,
+                    "category": self._attributes[name]["category"],
+                    "description": self._attributes[name]["description"],
+                    "is_base_aspect": False,
+                    "is_new_aspect": self._attributes[name]["is_new_aspect"],
+                    "usage_count": count,
+                }
+                for name, count in sorted(self._usage.items())
+            ]
+            stmt = pg_insert(Aspect).values(rows)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=[Aspect.name],
+                set_={
+                    "usage_count": Aspect.usage_count + stmt.excluded.usage_count,
+                    "description": func.coalesce(func.nullif(stmt.excluded.description, ''), Aspect.description),
+                    "last_used": func.now(),
+                }
+            ).returning(Aspect.id, Aspect.name)
+            result = await db.execute(stmt)
+            for aspect_id, name in result:
+                self.aspects[name]["id"] = aspect_id
+            if new_names:
+                logger.info(f"Новые аспекты ({len(new_names)}): {', '.join(new_names[:20])}")
+            self._usage.clear()
+            self._attributes.clear()
+
+        if self._links:
+            # COPY по соединению сессии - в той же транзакции, что и upsert выше
+            connection = await db.connection()
+            raw = await connection.get_raw_connection()
+            await raw.driver_connection.copy_records_to_table(
+                FeedbackAspect.__tablename__,
+                records=self._links,
+                columns=FEEDBACK_ASPECT_COPY_COLUMNS
+            )
+            self._links = []
+        return flushed
@@ -0,0 +1,212 @@
+from typing import Optional, Dict, Any, List
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, func, and_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+import logging
+
+from config import settings
+from database import AsyncSessionLocal
+from models.card_index import WBCardIndex, WBCardIndexState
+from zoneinfo import ZoneInfo
+
+
+def moscow_now():
+    return datetime.now(ZoneInfo("Europe/Moscow"))
+
+logger = logging.getLogger(__name__)
+
+# Максимальный limit курсора /content/v2/get/cards/list
+CARD_INDEX_PAGE_LIMIT = 100
+# Защита от бесконечного цикла курсора
+CARD_INDEX_MAX_PAGES = 1000
+
+
+async def _get_index_state(db: AsyncSession, user_id: int, brand: str) -> WBCardIndexState:
+    await db.execute(
+        pg_insert(WBCardIndexState).values(user_id=user_id, brand=brand, is_stale=False)
+        .on_conflict_do_nothing(constraint='uq_wb_card_index_state_user_brand')
+    )
+    result = await db.execute(
+        select(WBCardIndexState).where(
+            and_(WBCardIndexState.user_id == user_id, WBCardIndexState.brand == brand)
+        )
+    )
+    return result.scalar_one()
+
+
+async def _upsert_cards(db: AsyncSession, user_id: int, brand: str, cards: List[Dict[str, Any]], synced_at: datetime) -> None:
+    # Одна карточка не может попасть в ON CONFLICT дважды за запрос
+    rows = {}
+    for card in cards:
+        nm_id = card.get("nmID")
+        if nm_id is None:
+            continue
+        rows[int(nm_id)] = {
+            "user_id": user_id,
+            "brand": brand,
+            "nm_id": int(nm_id),
+            "vendor_code": card.get("vendorCode"),
+            "card": card,
+            "wb_updated_at": card.get("updatedAt"),
+            "synced_at": synced_at,
+        }
+    if not rows:
+        return
+    stmt = pg_insert(WBCardIndex).values(list(rows.values()))
+    stmt = stmt.on_conflict_do_update(
+        constraint='uq_wb_card_index_user_brand_nm',
+        set_={
+            "vendor_code": stmt.excluded.vendor_code,
+            "card": stmt.excluded.card,
+            "wb_updated_at": stmt.excluded.wb_updated_at,
+            "synced_at": stmt.excluded.synced_at,
+        }
+    )
+    await db.execute(stmt)
+
+
+async def refresh_card_index(db: AsyncSession, wb_client, user_id: int, brand: str, full: bool = False) -> int:
+    """Досинхронизирует индекс карточек по курсору updatedAt (сортировка по возрастанию).
+
+    Инкрементальный режим забирает только карточки, изменённые после сохранённого курсора.
+    Полный проход начинается с пустого курсора и удаляет из индекса карточки, которых больше нет в WB.
+    Каждая страница фиксируется отдельной транзакцией, поэтому прерванная синхронизация продолжается с места остановки.
+    """
+    state = await _get_index_state(db, user_id, brand)
+    started_at = moscow_now()
+    cursor = {"limit": CARD_INDEX_PAGE_LIMIT}
+    if not full and state.cursor_updated_at:
+        cursor.update({"updatedAt": state.cursor_updated_at, "nmID": state.cursor_nm_id})
+    # Запись в WB во время синхронизации снова пометит индекс устаревшим
+    state.is_stale = False
+    await db.commit()
+
+    fetched = 0
+    for page in range(1, CARD_INDEX_MAX_PAGES + 1):
+        response = await wb_client.get_cards_list({
+            "settings": {
+                "sort": {"ascending": True},
+                "cursor": cursor,
+                "filter": {"withPhoto": -1}
+            }
+        })
+        if not response.success or not isinstance(response.data, dict):
+            await db.rollback()
+            raise ValueError(f"Не удалось обновить индекс карточек: {response.error}")
+
+        cards = response.data.get("cards") or []
+        next_cursor = response.data.get("cursor") or {}
+        await _upsert_cards(db, user_id, brand, cards, started_at)
+        if next_cursor.get("updatedAt"):
+            state.cursor_updated_at = next_cursor["updatedAt"]
+            state.cursor_nm_id = next_cursor.get("nmID")
+        await db.commit()
+        fetched += len(cards)
+
+        if len(cards) < CARD_INDEX_PAGE_LIMIT or not next_cursor.get("updatedAt"):
+            break
+        cursor = {
+            "limit": CARD_INDEX_PAGE_LIMIT,
+            "updatedAt": next_cursor["updatedAt"],
+            "nmID": next_cursor.get("nmID")
+        }
+    else:
+        logger.warning(f"[CARD_INDEX] Достигнут лимит страниц ({CARD_INDEX_MAX_PAGES}) для user_id={user_id}, brand={brand}")
+
+    if full:
+        # Всё, что не встретилось в полном проходе, удалено или перенесено в корзину WB
+        await db.execute(
+            delete(WBCardIndex).where(
+                and_(
+                    WBCardIndex.user_id == user_id,
+                    WBCardIndex.brand == brand,
+                    WBCardIndex.synced_at < started_at
+                )
+            )
+        )
+        state.full_synced_at = started_at
+    state.synced_at = started_at
+    await db.commit()
+    logger.info(f"[CARD_INDEX] user_id={user_id}, brand={brand}: {'полная' if full else 'инкрементальная'} синхронизация, карточек: {fetched}")
+    return fetched
+
+
+async def invalidate_card_index(db: AsyncSession, user_id: int, brand: str) -> None:
+    """Помечает индекс устаревшим: следующее чтение сначала досинхронизирует его"""
+    await db.execute(
+        update(WBCardIndexState).where(
+            and_(WBCardIndexState.user_id == user_id, WBCardIndexState.brand == brand)
+        ).values(is_stale=True)
+    )
+    await db.commit()
+
+
+async def _find_indexed_card(
+    db: AsyncSession,
+    user_id: int,
+    brand: str,
+    nm_id: Optional[int] = None,
+    vendor_code: Optional[str] = None
+) -> Optional[Dict[str, Any]]:
+    conditions = [WBCardIndex.user_id == user_id, WBCardIndex.brand == brand]
+    if nm_id is not None:
+        conditions.append(WBCardIndex.nm_id == int(nm_id))
+    else:
+        # Сравниваем без учёта регистра, как прежний поиск по списку
+        conditions.append(func.lower(WBCardIndex.vendor_code) == str(vendor_code).lower())
+    result = await db.execute(select(WBCardIndex.card).where(*conditions).limit(1))
+    return result.scalar_one_or_none()
+
+
+async def get_indexed_card(
+    db: AsyncSession,
+    wb_client,
+    user_id: int,
+    brand: str,
+    nm_id: Optional[int] = None,
+    vendor_code: Optional[str] = None,
+    refresh: bool = False
+) -> Optional[Dict[str, Any]]:
+    """Карточка по nmID или vendorCode из индекса (user, brand).
+
+    Индекс досинхронизируется, если устарел (TTL, запись в WB) или если запрошен refresh;
+    при промахе - одна инкрементальная досинхронизация (карточка могла только что появиться).
+    """
+    state = await _get_index_state(db, user_id, brand)
+    now = moscow_now()
+    full = state.full_synced_at is None or now - state.full_synced_at > timedelta(hours=settings.CARD_INDEX_FULL_REFRESH_HOURS)
+    expired = state.synced_at is None or now - state.synced_at > timedelta(seconds=settings.CARD_INDEX_TTL_SECONDS)
+    await db.commit()
+
+    refreshed = False
+    if refresh or full or expired or state.is_stale:
+        await refresh_card_index(db, wb_client, user_id, brand, full=full)
+        refreshed = True
+
+    card = await _find_indexed_card(db, user_id, brand, nm_id, vendor_code)
+    if card is None and not refreshed:
+        await refresh_card_index(db, wb_client, user_id, brand)
+        card = await _find_indexed_card(db, user_id, brand, nm_id, vendor_code)
+    return card
+
+
+class CardIndex:
+    """Индекс карточек (user, brand) для WBAPIClient.
+
+    Работает в собственных сессиях, чтобы не вмешиваться в транзакции вызывающего кода
+    (планировщик и роутеры держат свои begin()-блоки).
+    """
+
+    def __init__(self, user_id: int, brand: str):
+        self.user_id = user_id
+        self.brand = brand
+
+    async def get_card(self, wb_client, nm_id: Optional[int] = None, vendor_code: Optional[str] = None,
+                       refresh: bool = False) -> Optional[Dict[str, Any]]:
+        async with AsyncSessionLocal() as db:
+            return await get_indexed_card(db, wb_client, self.user_id, self.brand, nm_id, vendor_code, refresh)
+
+    async def invalidate(self) -> None:
+        async with AsyncSessionLocal() as db:
+            await invalidate_card_index(db, self.user_id, self.brand)
@@ -9,6 +9,7 @@ import logging
 
 from models.feedback import Feedback, FeedbackAnalytics
 from models.user import User
+from crud.feedback_archive import get_archived_feedback_keys, restore_archived_feedbacks, ARCHIVE_REASON_DELETED
 from zoneinfo import ZoneInfo
 
 
@@ -585,6 +586,22 @@ async def sync_feedbacks_with_soft_delete_optimized(
     logger.info(f"  Восстановленных: {stats['restored_feedbacks']}")
     logger.info(f"  Без изменений: {stats['unchanged_feedbacks']}")
 
+    # 1.5 Отзывы из архива: удалённые и снова пришедшие с WB восстанавливаем, устаревшие повторно не вставляем
+    archived_keys = await get_archived_feedback_keys(db, brand, processed_articles)
+    to_restore_from_archive = []
+    for key in wb_feedback_keys - existing_feedback_keys:
+        archived = archived_keys.get(key)
+        if archived is None:
+            continue
+        archive_id, archive_reason = archived
+        if archive_reason == ARCHIVE_REASON_DELETED:
+            to_restore_from_archive.append(archive_id)
+        existing_feedback_keys.add(key)
+    if to_restore_from_archive:
+        await restore_archived_feedbacks(db, to_restore_from_archive)
+        stats['restored_feedbacks'] += len(to_restore_from_archive)
+        logger.info(f"Восстановлено из архива: {len(to_restore_from_archive)}")
+
     # 2. Добавляем новые отзывы
     logger.info("Добавляем новые отзывы...")
     
@@ -691,6 +708,8 @@ async def sync_feedbacks_with_soft_delete_optimized(
             db.add_all(batch)
             await db.commit()
             logger.info(f"Добавлен батч {i//BATCH_SIZE + 1}: {len(batch)} отзывов")
+    # Фиксируем soft delete и восстановления, даже если новых отзывов не было
+    await db.commit()
 
     stats['total_after_sync'] = len(existing_feedbacks_data) + len(new_feedbacks)
     logger.info(f"Статистика оптимизированной синхронизации для {brand}: {stats}")
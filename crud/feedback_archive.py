@@ -0,0 +1,159 @@
+from typing import List, Optional, Dict, Any, Iterable, Tuple
+from datetime import datetime, timedelta
+from sqlalchemy import select, insert, delete, func, and_, or_, case, literal, literal_column, union_all
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+import logging
+
+from config import settings
+from models.feedback import Feedback, FeedbackArchive, FeedbackTopTracking, FEEDBACK_SEARCH_VECTOR_SQL
+from crud.analytics import review_date_expr
+from zoneinfo import ZoneInfo
+
+
+def moscow_now():
+    return datetime.now(ZoneInfo("Europe/Moscow"))
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_REASON_DELETED = 'deleted'
+ARCHIVE_REASON_AGED_OUT = 'aged_out'
+
+# Общие колонки горячей таблицы и архива (search_vector в архиве не храним)
+ARCHIVED_COLUMNS = [
+    c.name for c in FeedbackArchive.__table__.columns
+    if c.name in Feedback.__table__.columns
+]
+
+
+def feedbacks_full_history(*column_names: str):
+    """UNION ALL горячей таблицы и архива (аналог представления feedbacks_all) для редких запросов по всей истории.
+
+    Возвращает подзапрос с запрошенными колонками (по умолчанию все общие) и флагом is_archived.
+    """
+    names = list(column_names) or ARCHIVED_COLUMNS
+    hot = select(*[getattr(Feedback, n) for n in names], literal(False).label('is_archived'))
+    archived = select(*[getattr(FeedbackArchive, n) for n in names], literal(True).label('is_archived'))
+    return union_all(hot, archived).subquery('feedbacks_all')
+
+
+def feedbacks_with_archived_deleted():
+    """Алиас Feedback над горячей таблицей и удалёнными отзывами архива в пределах горизонта аналитики.
+
+    Удалённые отзывы уходят в архив через FEEDBACK_ARCHIVE_DELETED_AFTER_DAYS, но метрики deleted,
+    дневные агрегаты и выборки удалённых должны их видеть: такие запросы строятся от этого алиаса
+    вместо Feedback. Доступны общие колонки и search_vector (для архивной части считается на лету).
+    """
+    horizon = moscow_now() - timedelta(days=settings.FEEDBACK_ARCHIVE_HORIZON_DAYS)
+    hot = select(*[getattr(Feedback, n) for n in ARCHIVED_COLUMNS], Feedback.search_vector)
+    archived = select(
+        *[getattr(FeedbackArchive, n) for n in ARCHIVED_COLUMNS],
+        literal_column(f"({FEEDBACK_SEARCH_VECTOR_SQL})", type_=TSVECTOR).label('search_vector')
+    ).where(
+        FeedbackArchive.archive_reason == ARCHIVE_REASON_DELETED,
+        review_date_expr(FeedbackArchive) >= horizon.replace(tzinfo=None)
+    )
+    return aliased(Feedback, union_all(hot, archived).subquery('feedbacks_with_deleted'))
+
+
+def _archive_candidates_condition(now: datetime):
+    horizon = now - timedelta(days=settings.FEEDBACK_ARCHIVE_HORIZON_DAYS)
+    deleted_before = now - timedelta(days=settings.FEEDBACK_ARCHIVE_DELETED_AFTER_DAYS)
+    return or_(
+        and_(
+            Feedback.is_deleted == True,
+            func.coalesce(Feedback.deleted_at, Feedback.updated_at, Feedback.created_at) < deleted_before
+        ),
+        # review_date_expr - московское время без tz, как и Feedback.date
+        review_date_expr() < horizon.replace(tzinfo=None)
+    )
+
+
+async def archive_feedbacks_batch(db: AsyncSession, batch_size: int = 1000) -> int:
+    """Переносит одну пачку отзывов в feedbacks_archive. Возвращает число перенесённых строк.
+
+    Строки захватываются FOR UPDATE SKIP LOCKED, перенос (архив + снимок топ-трекинга + удаление) -
+    одна транзакция, поэтому параллельные архиваторы и синхронизация не мешают друг другу.
+    """
+    ids_query = select(Feedback.id).where(
+        _archive_candidates_condition(moscow_now())
+    ).order_by(Feedback.id).limit(batch_size).with_for_update(skip_locked=True)
+    ids = (await db.execute(ids_query)).scalars().all()
+    if not ids:
+        await db.commit()
+        return 0
+
+    top_tracking_snapshot = select(
+        func.row_to_json(literal_column(FeedbackTopTracking.__tablename__))
+    ).where(
+        FeedbackTopTracking.feedback_id == Feedback.id
+    ).limit(1).scalar_subquery()
+
+    source = select(
+        *[getattr(Feedback, n) for n in ARCHIVED_COLUMNS],
+        top_tracking_snapshot,
+        case((Feedback.is_deleted == True, ARCHIVE_REASON_DELETED), else_=ARCHIVE_REASON_AGED_OUT)
+    ).where(Feedback.id.in_(ids))
+
+    await db.execute(
+        insert(FeedbackArchive).from_select(ARCHIVED_COLUMNS + ['top_tracking', 'archive_reason'], source)
+    )
+    await db.execute(delete(FeedbackTopTracking).where(FeedbackTopTracking.feedback_id.in_(ids)))
+    await db.execute(delete(Feedback).where(Feedback.id.in_(ids)))
+    await db.commit()
+    return len(ids)
+
+
+async def archive_feedbacks(db: AsyncSession, batch_size: int = 1000, max_batches: Optional[int] = None) -> Dict[str, Any]:
+    """Фоновая архивация: переносит пачки, пока есть кандидаты (или до max_batches)"""
+    archived = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        moved = await archive_feedbacks_batch(db, batch_size)
+        if not moved:
+            break
+        archived += moved
+        batches += 1
+        logger.info(f"[ARCHIVE] Пачка {batches}: перенесено {moved} отзывов")
+    return {"archived": archived, "batches": batches}
+
+
+async def get_archived_feedback_keys(
+    db: AsyncSession,
+    brand: str,
+    articles: Iterable[str]
+) -> Dict[str, Tuple[int, str]]:
+    """Ключи wb_id_article_brand архивных отзывов -> (id, archive_reason)"""
+    articles = list(articles)
+    if not articles:
+        return {}
+    result = await db.execute(
+        select(FeedbackArchive.id, FeedbackArchive.wb_id, FeedbackArchive.article, FeedbackArchive.archive_reason).where(
+            and_(FeedbackArchive.brand == brand, FeedbackArchive.article.in_(articles))
+        )
+    )
+    return {
+        f"{row.wb_id}_{row.article}_{brand}": (row.id, row.archive_reason)
+        for row in result.fetchall()
+    }
+
+
+async def restore_archived_feedbacks(db: AsyncSession, ids: List[int]) -> int:
+    """Возвращает отзывы из архива в горячую таблицу (без commit - в транзакции вызывающего кода).
+
+    Отзыв снова активен (is_deleted=False), топ-трекинг пересоздаётся обычным пересчётом.
+    """
+    if not ids:
+        return 0
+    overrides = {
+        'is_deleted': literal(False),
+        'deleted_at': literal(None, type_=Feedback.deleted_at.type),
+        'suspected_deleted_at': literal(None, type_=Feedback.suspected_deleted_at.type),
+    }
+    source = select(
+        *[overrides.get(n, getattr(FeedbackArchive, n)) for n in ARCHIVED_COLUMNS]
+    ).where(FeedbackArchive.id.in_(ids))
+    await db.execute(insert(Feedback).from_select(ARCHIVED_COLUMNS, source))
+    await db.execute(delete(FeedbackArchive).where(FeedbackArchive.id.in_(ids)))
+    return len(ids)
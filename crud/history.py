@@ -12,6 +12,7 @@ from io import BytesIO
 import requests
 
 from utils.wb_api import WBAPIClient
+from crud.card_index import CardIndex
 
 
 async def create_history(
@@ -207,7 +208,7 @@ async def revert_history_media(
     )
     task = result_task.scalars().first()
 
-    wb_client = WBAPIClient(api_key=wb_api_key)
+    wb_client = WBAPIClient(api_key=wb_api_key, card_index=CardIndex(history.user_id, history.brand))
     current_card_response = await wb_client.get_card_by_vendor(history.vendor_code)
     if not current_card_response.success:
         raise HTTPException(
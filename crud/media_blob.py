@@ -0,0 +1,79 @@
+from typing import Dict, Any
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, delete, and_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncSession
+import logging
+import os
+import time
+
+from models.media_blob import MediaBlob
+from utils import blob_store
+from zoneinfo import ZoneInfo
+
+
+def moscow_now():
+    return datetime.now(ZoneInfo("Europe/Moscow"))
+
+logger = logging.getLogger(__name__)
+
+# Файл без ссылок (или без записи в БД) удаляется не раньше чем через этот срок
+BLOB_GC_GRACE_HOURS = 1
+
+
+async def acquire_blob(db: AsyncSession, sha256: str, size: int) -> None:
+    """+1 ссылка на файл (без commit - в транзакции создания задачи).
+
+    Вызывается до blob_store.place_upload: блокировка строки до коммита не даёт gc_media_blobs
+    удалить уже положенный файл.
+    """
+    stmt = pg_insert(MediaBlob).values(sha256=sha256, size=size, refcount=1)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[MediaBlob.sha256],
+        set_={"refcount": MediaBlob.refcount + 1, "updated_at": moscow_now()}
+    )
+    await db.execute(stmt)
+
+
+async def release_blob(db: AsyncSession, sha256: str) -> None:
+    """-1 ссылка; сам файл удаляет сборщик мусора после grace-периода"""
+    await db.execute(
+        update(MediaBlob)
+        .where(and_(MediaBlob.sha256 == sha256, MediaBlob.refcount > 0))
+        .values(refcount=MediaBlob.refcount - 1, updated_at=moscow_now())
+    )
+
+
+async def gc_media_blobs(db: AsyncSession) -> Dict[str, Any]:
+    """Удаляет файлы без ссылок и файлы-сироты без записи в media_blobs"""
+    cutoff = moscow_now() - timedelta(hours=BLOB_GC_GRACE_HOURS)
+    candidates = (await db.execute(
+        select(MediaBlob.sha256).where(and_(MediaBlob.refcount <= 0, MediaBlob.updated_at < cutoff))
+    )).scalars().all()
+    await db.commit()
+    removed = 0
+    for sha256 in candidates:
+        # Файл стирается до коммита DELETE, пока строка заблокирована: acquire_blob того же хеша
+        # ждёт коммита и кладёт файл заново, а если успел раньше - refcount > 0 и строка не удаляется
+        result = await db.execute(
+            delete(MediaBlob)
+            .where(and_(MediaBlob.sha256 == sha256, MediaBlob.refcount <= 0, MediaBlob.updated_at < cutoff))
+            .returning(MediaBlob.sha256)
+        )
+        if result.scalars().first():
+            blob_store.remove_blob(sha256)
+            removed += 1
+        await db.commit()
+
+    known = set((await db.execute(select(MediaBlob.sha256))).scalars().all())
+    await db.commit()
+    orphan_cutoff = time.time() - BLOB_GC_GRACE_HOURS * 3600
+    orphans = 0
+    for sha256, path, mtime in list(blob_store.iter_blob_files()):
+        if sha256 not in known and mtime < orphan_cutoff:
+            try:
+                os.remove(path)
+                orphans += 1
+            except OSError:
+                pass
+    return {"removed": removed, "orphans": orphans}
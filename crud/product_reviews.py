@@ -1,9 +1,32 @@
-from sqlalchemy import select, and_, desc
+from sqlalchemy import select, and_, desc, func, case, cast, Date
 from sqlalchemy.ext.asyncio import AsyncSession
-from typing import Optional, Dict, Any, Tuple
+from typing import Optional, Dict, Any, Tuple, List
 from models.feedback import Feedback
+from crud.analytics import review_date_expr, review_cursor_condition, encode_review_cursor
+from crud.feedback_archive import feedbacks_with_archived_deleted
 from datetime import datetime, timedelta
 
+# Сколько последних отзывов участвует в расчёте рыночного рейтинга
+MARKET_RATING_WINDOW = 20000
+# Первые N отзывов учитываются без затухания
+MARKET_RATING_FRESH_COUNT = 15
+
+
+def _parse_period(date_from: Optional[str], date_to: Optional[str], source=Feedback) -> List:
+    conditions = []
+    if date_from:
+        try:
+            conditions.append(source.date >= datetime.fromisoformat(date_from))
+        except Exception:
+            pass
+    if date_to:
+        try:
+            conditions.append(source.date <= datetime.fromisoformat(date_to))
+        except Exception:
+            pass
+    return conditions
+
+
 async def get_product_reviews_crud(
     db: AsyncSession,
     user_id: int,
@@ -12,56 +35,111 @@ async def get_product_reviews_crud(
     per_page: int = 20,
     rating: Optional[int] = None,
     date_from: Optional[str] = None,
-    date_to: Optional[str] = None
+    date_to: Optional[str] = None,
+    cursor: Optional[str] = None
 ) -> Dict[str, Any]:
+    """Отзывы товара: total через count(*), страница - по курсору (date, id) или OFFSET"""
     # Защита от некорректного article
     try:
         article_int = int(article)
     except (ValueError, TypeError):
-        return {"items": [], "total": 0, "page": page, "per_page": per_page, "total_pages": 0}
+        return {"items": [], "total": 0, "page": page, "per_page": per_page, "total_pages": 0, "next_cursor": None}
     offset = (page - 1) * per_page
-    query = select(Feedback).where(
-        Feedback.article == str(article)
-    )
+    # Удалённые отзывы товара остаются в выдаче и после переноса в архив
+    source = feedbacks_with_archived_deleted()
+    conditions = [source.article == str(article)]
     if rating:
-        query = query.where(Feedback.rating == rating)
-    if date_from:
-        try:
-            date_from_dt = datetime.fromisoformat(date_from)
-            query = query.where(Feedback.date >= date_from_dt)
-        except Exception:
-            pass
-    if date_to:
-        try:
-            date_to_dt = datetime.fromisoformat(date_to)
-            query = query.where(Feedback.date <= date_to_dt)
-        except Exception:
-            pass
-    total_result = await db.execute(query)
-    total = len(total_result.scalars().all())
-    query = query.order_by(desc(Feedback.date)).offset(offset).limit(per_page)
+        conditions.append(source.rating == rating)
+    conditions.extend(_parse_period(date_from, date_to, source))
+
+    total_result = await db.execute(select(func.count(source.id)).where(*conditions))
+    total = total_result.scalar() or 0
+
+    # Только поля ответа: main/pros/cons, аспекты и служебные тексты не читаем
+    query = select(
+        source.id,
+        source.author,
+        source.rating,
+        source.text,
+        source.date,
+        source.is_negative,
+        source.is_processed,
+        source.is_deleted
+    ).where(*conditions)
+    if cursor:
+        query = query.where(review_cursor_condition(source.date, cursor, source.id))
+    else:
+        query = query.offset(offset)
+    query = query.order_by(desc(source.date), desc(source.id)).limit(per_page)
     result = await db.execute(query)
-    feedbacks = result.scalars().all()
+    rows = result.fetchall()
     items = []
-    for f in feedbacks:
+    for row in rows:
         items.append({
-            "id": f.id,
-            "author": getattr(f, 'author', None),
-            "rating": getattr(f, 'rating', None),
-            "text": getattr(f, 'text', None),
-            "date": getattr(f, 'date', None),
-            "is_negative": getattr(f, 'is_negative', None),
-            "is_processed": getattr(f, 'is_processed', None),
-            "is_deleted": bool(getattr(f, 'is_deleted', False))
+            "id": row.id,
+            "author": row.author,
+            "rating": row.rating,
+            "text": row.text,
+            "date": row.date,
+            "is_negative": row.is_negative,
+            "is_processed": row.is_processed,
+            "is_deleted": bool(row.is_deleted)
         })
+    next_cursor = None
+    if len(rows) == per_page:
+        next_cursor = encode_review_cursor(rows[-1].date, rows[-1].id)
     return {
         "items": items,
         "total": total,
         "page": page,
         "per_page": per_page,
-        "total_pages": (total + per_page - 1) // per_page
+        "total_pages": (total + per_page - 1) // per_page,
+        "next_cursor": next_cursor
     }
 
+
+async def _get_rating_stats(db: AsyncSession, conditions: List) -> Dict[str, Any]:
+    """Агрегаты по рейтингу одним запросом: количество, среднее, распределение, негатив, рыночный рейтинг"""
+    review_date = review_date_expr()
+    ranked = select(
+        Feedback.rating,
+        Feedback.is_negative,
+        review_date.label('review_date'),
+        func.row_number().over(
+            order_by=(desc(review_date).nulls_last(), desc(Feedback.id))
+        ).label('rn')
+    ).where(*conditions).subquery()
+
+    # Затухание веса: 100 ** (-(days - 182) / (730 * 1.5)), свежие отзывы и первые 15 - вес 1
+    days = func.current_date() - cast(ranked.c.review_date, Date)
+    decay = case(
+        (ranked.c.rn <= MARKET_RATING_FRESH_COUNT, 1.0),
+        (days <= 0, 1.0),
+        else_=func.power(100.0, (182 - days) / (730 * 1.5))
+    )
+    in_window = ranked.c.rn <= MARKET_RATING_WINDOW
+
+    stats_query = select(
+        func.count().label('total'),
+        func.avg(ranked.c.rating).label('avg_rating'),
+        func.count().filter(ranked.c.is_negative == 1).label('negative_count'),
+        *[func.count().filter(ranked.c.rating == r).label(f'rating_{r}') for r in range(1, 6)],
+        func.sum(ranked.c.rating * decay).filter(in_window).label('weighted_sum'),
+        func.sum(decay).filter(in_window).label('decay_sum')
+    )
+    row = (await db.execute(stats_query)).first()
+
+    total = row.total or 0
+    decay_sum = float(row.decay_sum or 0)
+    return {
+        "total": total,
+        "avg_rating": float(row.avg_rating or 0),
+        "negative_count": row.negative_count or 0,
+        "ratings_count": {str(r): getattr(row, f'rating_{r}') or 0 for r in range(5, 0, -1)},
+        "market_rating": (float(row.weighted_sum or 0) / decay_sum) if decay_sum > 0 else 0
+    }
+
+
 async def get_product_stats_crud(
     db: AsyncSession,
     user_id: int,
@@ -74,113 +152,34 @@ async def get_product_stats_crud(
         article_int = int(article)
     except (ValueError, TypeError):
         return None
-    query = select(Feedback).where(
-        Feedback.article == str(article)
-    )
-    # For period filter
-    period_query = query
-    if date_from:
-        try:
-            date_from_dt = datetime.fromisoformat(date_from)
-            period_query = period_query.where(Feedback.date >= date_from_dt)
-        except Exception:
-            pass
-    if date_to:
-        try:
-            date_to_dt = datetime.fromisoformat(date_to)
-            period_query = period_query.where(Feedback.date <= date_to_dt)
-        except Exception:
-            pass
-    # All-time feedbacks
-    result = await db.execute(query)
-    feedbacks = result.scalars().all()
-    # Period feedbacks
-    period_result = await db.execute(period_query)
-    period_feedbacks = period_result.scalars().all()
-    if not feedbacks:
+    conditions = [Feedback.article == str(article)]
+    # All-time
+    all_time = await _get_rating_stats(db, conditions)
+    if not all_time["total"]:
         return None
-    # --- All-time ratings ---
-    ratings = [f.rating for f in feedbacks if hasattr(f, 'rating') and isinstance(f.rating, (int, float))]
-    avg_rating = sum(ratings) / len(ratings) if ratings else 0
-    # All-time market_rating
-    def get_feedback_datetime(f):
-        dt = getattr(f, 'date', None)
-        if dt is None:
-            dt = getattr(f, 'created_at', None)
-        return dt if dt is not None else datetime.min
-    feedbacks_sorted = sorted(feedbacks, key=get_feedback_datetime, reverse=True)
-    valid_feedbacks = feedbacks_sorted[:20000]
-    now = datetime.now()
-    def get_decay(days):
-        if days <= 0:
-            return 1.0
-        return 100 ** (-(days - 182) / (730 * 1.5))
-    weighted_sum = 0.0
-    decay_sum = 0.0
-    for idx, f in enumerate(valid_feedbacks):
-        dt = get_feedback_datetime(f)
-        days = (now.date() - dt.date()).days
-        decay = 1.0 if idx < 15 else get_decay(days)
-        rating_val = getattr(f, 'rating', 0)
-        if not isinstance(rating_val, (int, float)):
-            rating_val = 0
-        weighted_sum += rating_val * decay
-        decay_sum += decay
-    market_rating = (weighted_sum / decay_sum) if decay_sum > 0 else 0
-    # --- Period ratings ---
-    period_ratings = [f.rating for f in period_feedbacks if hasattr(f, 'rating') and isinstance(f.rating, (int, float))]
-    period_avg_rating = sum(period_ratings) / len(period_ratings) if period_ratings else 0
-    # Period market_rating
-    period_feedbacks_sorted = sorted(period_feedbacks, key=get_feedback_datetime, reverse=True)
-    period_valid_feedbacks = period_feedbacks_sorted[:20000]
-    period_weighted_sum = 0.0
-    period_decay_sum = 0.0
-    for idx, f in enumerate(period_valid_feedbacks):
-        dt = get_feedback_datetime(f)
-        days = (now.date() - dt.date()).days
-        decay = 1.0 if idx < 15 else get_decay(days)
-        rating_val = getattr(f, 'rating', 0)
-        if not isinstance(rating_val, (int, float)):
-            rating_val = 0
-        period_weighted_sum += rating_val * decay
-        period_decay_sum += decay
-    period_market_rating = (period_weighted_sum / period_decay_sum) if period_decay_sum > 0 else 0
-    # Negative share (period)
-    period_negative_count = sum(1 for f in period_feedbacks if hasattr(f, 'is_negative') and f.is_negative is not None and int(f.is_negative) == 1)
-    period_total_reviews = len(period_ratings)
-    period_negative_share = round((period_negative_count / period_total_reviews) * 100, 1) if period_total_reviews > 0 else 0.0
-    # All-time negative share
-    negative_count = sum(1 for f in feedbacks if hasattr(f, 'is_negative') and f.is_negative is not None and int(f.is_negative) == 1)
-    total_reviews = len(ratings)
+    # For period filter
+    period = await _get_rating_stats(db, conditions + _parse_period(date_from, date_to))
+
+    total_reviews = all_time["total"]
+    negative_count = all_time["negative_count"]
     internal_negative_percentage = round((negative_count / total_reviews) * 100, 1) if total_reviews > 0 else 0.0
-    ratings_count = {
-        "5": sum(1 for r in ratings if r == 5),
-        "4": sum(1 for r in ratings if r == 4),
-        "3": sum(1 for r in ratings if r == 3),
-        "2": sum(1 for r in ratings if r == 2),
-        "1": sum(1 for r in ratings if r == 1)
-    }
-    period_ratings_count = {
-        "5": sum(1 for r in period_ratings if r == 5),
-        "4": sum(1 for r in period_ratings if r == 4),
-        "3": sum(1 for r in period_ratings if r == 3),
-        "2": sum(1 for r in period_ratings if r == 2),
-        "1": sum(1 for r in period_ratings if r == 1)
-    }
+    period_total_reviews = period["total"]
+    period_negative_count = period["negative_count"]
+    period_negative_share = round((period_negative_count / period_total_reviews) * 100, 1) if period_total_reviews > 0 else 0.0
     return {
         "article": article,
-        "average_rating": round(avg_rating, 2),
-        "market_rating": round(market_rating, 2),
+        "average_rating": round(all_time["avg_rating"], 2),
+        "market_rating": round(all_time["market_rating"], 2),
         "total_reviews": total_reviews,
         "negative_count": negative_count,
         "internal_negative_percentage": internal_negative_percentage,
-        "ratings_count": ratings_count,
+        "ratings_count": all_time["ratings_count"],
         "period": {
-            "average_rating": round(period_avg_rating, 2),
-            "market_rating": round(period_market_rating, 2),
+            "average_rating": round(period["avg_rating"], 2),
+            "market_rating": round(period["market_rating"], 2),
             "total_reviews": period_total_reviews,
             "negative_count": period_negative_count,
             "negative_share": period_negative_share,
-            "ratings_count": period_ratings_count
+            "ratings_count": period["ratings_count"]
         }
-    } 
\ No newline at end of file
+    }
@@ -0,0 +1,79 @@
+from typing import Dict, Optional
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+import logging
+
+from config import settings
+from models.feedback import Feedback
+from utils.sentiment_scorer import sentiment_scorer
+
+logger = logging.getLogger(__name__)
+
+
+def feedback_sentiment_text(text: Optional[str], main_text: Optional[str],
+                            pros_text: Optional[str], cons_text: Optional[str]) -> str:
+    """Текст для оценки тональности: основной текст, достоинства и недостатки (иначе исходный text)"""
+    parts = []
+    if main_text and main_text.strip():
+        parts.append(main_text.strip())
+    if pros_text and pros_text.strip():
+        parts.append(f"Достоинства: {pros_text.strip()}")
+    if cons_text and cons_text.strip():
+        parts.append(f"Недостатки: {cons_text.strip()}")
+    if not parts and text and text.strip():
+        parts.append(text.strip())
+    return " ".join(parts)
+
+
+def rating_sentiment(rating: Optional[int]) -> float:
+    """Тональность отзыва без текста по оценке: 1 звезда -> -1, 3 -> 0, 5 -> 1"""
+    return max(-1.0, min(1.0, ((rating or 3) - 3) / 2))
+
+
+async def score_pending_sentiment(db: AsyncSession, brand: Optional[str] = None, limit: Optional[int] = None) -> Dict[str, int]:
+    """Заполняет sentiment_score отзывов, у которых он ещё не посчитан (частичный индекс idx_feedbacks_sentiment_pending).
+
+    Отзывы выбираются пачками по SENTIMENT_DB_CHUNK, каждая пачка фиксируется отдельно.
+    Отзывы без текста получают оценку по звёздам, остальные - от локальной модели.
+    """
+    if not sentiment_scorer.available:
+        return {"scored": 0, "rated_only": 0}
+
+    scored = rated_only = 0
+    last_id = 0
+    while limit is None or scored + rated_only < limit:
+        chunk = settings.SENTIMENT_DB_CHUNK if limit is None else min(settings.SENTIMENT_DB_CHUNK, limit - scored - rated_only)
+        query = select(
+            Feedback.id, Feedback.rating, Feedback.text, Feedback.main_text, Feedback.pros_text, Feedback.cons_text
+        ).where(Feedback.sentiment_score.is_(None), Feedback.id > last_id)
+        if brand:
+            query = query.where(Feedback.brand == brand)
+        rows = (await db.execute(query.order_by(Feedback.id).limit(chunk))).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        updates = []
+        texts = []
+        text_ids = []
+        for row in rows:
+            text = feedback_sentiment_text(row.text, row.main_text, row.pros_text, row.cons_text)
+            if text:
+                texts.append(text)
+                text_ids.append(row.id)
+            else:
+                updates.append({"id": row.id, "sentiment_score": rating_sentiment(row.rating)})
+        rated_only += len(updates)
+
+        if texts:
+            scores = await sentiment_scorer.score(texts)
+            updates.extend({"id": feedback_id, "sentiment_score": score} for feedback_id, score in zip(text_ids, scores))
+            scored += len(texts)
+
+        # ORM bulk UPDATE по первичному ключу: один executemany на пачку
+        await db.execute(update(Feedback), updates)
+        await db.commit()
+
+    if scored or rated_only:
+        logger.info(f"[SENTIMENT] brand={brand}: оценено моделью {scored}, по звёздам {rated_only}")
+    return {"scored": scored, "rated_only": rated_only}
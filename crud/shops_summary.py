@@ -2,9 +2,12 @@ from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional, Dict, Any
 from crud.admin import get_brands
 from models import User
-from models.feedback import Feedback
-from sqlalchemy import select, and_, func, desc
-from datetime import date
+from models.feedback import Feedback, FeedbackDailyRollup
+from crud.feedback_archive import feedbacks_with_archived_deleted
+from sqlalchemy import select, delete, and_, or_, func, desc, cast, Date, literal_column
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from datetime import date, datetime
+import json
 
 async def get_brands_by_shop(db: AsyncSession, user_id: int, shop: str) -> List[Dict[str, str]]:
     """Получение брендов пользователя (WB-only, без фильтрации по магазину)"""
@@ -92,6 +95,81 @@ async def get_products_by_brand(db: AsyncSession, user_id: int, shop: str, brand
         
         return [{"id": str(vc), "name": f"товар {vc}"} for vc in vendor_codes if vc]
 
+def _parse_summary_filters(filters: Optional[str], source=Feedback) -> List:
+    """Условия из JSON-строки filters (is_negative, is_deleted, rating, rating_min, rating_max) по колонкам source"""
+    conditions = []
+    if not filters:
+        return conditions
+    try:
+        filter_data = json.loads(filters)
+        if 'is_negative' in filter_data:
+            conditions.append(source.is_negative == filter_data['is_negative'])
+        if 'is_deleted' in filter_data:
+            conditions.append(source.is_deleted == filter_data['is_deleted'])
+        if 'rating' in filter_data:
+            conditions.append(source.rating == filter_data['rating'])
+        if 'rating_min' in filter_data:
+            conditions.append(source.rating >= filter_data['rating_min'])
+        if 'rating_max' in filter_data:
+            conditions.append(source.rating <= filter_data['rating_max'])
+    except Exception:
+        pass
+    return conditions
+
+
+async def refresh_feedback_daily_rollups(db: AsyncSession, brand: str) -> int:
+    """Пересчёт дневных агрегатов бренда: удаление групп без отзывов и один INSERT ... SELECT ... ON CONFLICT DO UPDATE.
+
+    Источник - горячая таблица вместе с архивными удалёнными отзывами (feedbacks_with_archived_deleted),
+    иначе через FEEDBACK_ARCHIVE_DELETED_AFTER_DAYS счётчики deleted обнулялись бы архивацией.
+    """
+    reviews = feedbacks_with_archived_deleted()
+    # Литералы, а не bind-параметры: выражения должны совпадать в SELECT и GROUP BY
+    day = cast(func.date_trunc(literal_column("'day'"), reviews.date), Date)
+    vendor_code = func.coalesce(reviews.vendor_code, literal_column("''"))
+    source = select(
+        reviews.brand,
+        vendor_code,
+        day,
+        func.count(),
+        func.count().filter(reviews.is_negative == 1),
+        func.count().filter(reviews.is_deleted == True),
+        *[func.count().filter(reviews.rating == r) for r in range(1, 6)],
+        func.now()
+    ).where(
+        and_(reviews.brand == brand, reviews.date.isnot(None))
+    ).group_by(reviews.brand, vendor_code, day)
+
+    stmt = pg_insert(FeedbackDailyRollup).from_select(
+        ['brand', 'vendor_code', 'day', 'total', 'negative', 'deleted',
+         'rating_1', 'rating_2', 'rating_3', 'rating_4', 'rating_5', 'updated_at'],
+        source
+    )
+    stmt = stmt.on_conflict_do_update(
+        constraint='uq_feedback_daily_rollups_brand_vendor_day',
+        set_={
+            col: getattr(stmt.excluded, col)
+            for col in ('total', 'negative', 'deleted', 'rating_1', 'rating_2',
+                        'rating_3', 'rating_4', 'rating_5', 'updated_at')
+        }
+    )
+    # Группы, отзывов которых больше нет (архивация за горизонтом, перенос vendor_code), удаляются
+    # в той же транзакции: иначе агрегаты навсегда сохранили бы старые счётчики
+    stale = delete(FeedbackDailyRollup).where(
+        FeedbackDailyRollup.brand == brand,
+        ~select(reviews.id).where(
+            reviews.brand == FeedbackDailyRollup.brand,
+            func.coalesce(reviews.vendor_code, literal_column("''")) == FeedbackDailyRollup.vendor_code,
+            reviews.date >= FeedbackDailyRollup.day,
+            reviews.date < FeedbackDailyRollup.day + 1
+        ).exists()
+    )
+    await db.execute(stale)
+    result = await db.execute(stmt)
+    await db.commit()
+    return result.rowcount or 0
+
+
 async def get_shop_feedbacks_crud(
     db: AsyncSession,
     user_id: int,
@@ -100,105 +178,98 @@ async def get_shop_feedbacks_crud(
     date_from: Optional[date] = None,
     date_to: Optional[date] = None,
     filters: Optional[str] = None,
-    metrics: Optional[List[str]] = None
+    metrics: Optional[List[str]] = None,
+    use_rollups: bool = False
 ) -> Dict[str, Any]:
-    """Получение отзывов для магазина с фильтрацией"""
-    from models.feedback import Feedback
-    from sqlalchemy import select, func, and_, or_
-    
+    """Дневная статистика отзывов магазина для графика.
+
+    Агрегаты считаются в БД (GROUP BY по дню, count(*) FILTER для каждой запрошенной метрики,
+    накопительные доли - оконными суммами). use_rollups=True читает готовые дневные агрегаты
+    из feedback_daily_rollups; при заданных filters всегда используется живой запрос.
+    """
     if not metrics:
         metrics = ['total', 'negative', 'deleted']
-    
-    query = select(Feedback)  # Убираем фильтр по user_id - все отзывы доступны всем
-    if brand_id:
-        query = query.where(Feedback.brand == brand_id)
-    if product_id:
-        print(f"[DEBUG] Фильтруем по vendor_code: {product_id}")
-        # Простое сравнение по vendor_code в feedbacks
-        query = query.where(Feedback.vendor_code == product_id)
-    if date_from:
-        query = query.where(Feedback.date >= date_from)
-    if date_to:
-        query = query.where(Feedback.date <= date_to)
-    
-    # Обработка фильтров
-    if filters:
-        try:
-            import json
-            filter_data = json.loads(filters)
-            if 'is_negative' in filter_data:
-                query = query.where(Feedback.is_negative == filter_data['is_negative'])
-            if 'is_deleted' in filter_data:
-                query = query.where(Feedback.is_deleted == filter_data['is_deleted'])
-            if 'rating' in filter_data:
-                query = query.where(Feedback.rating == filter_data['rating'])
-            if 'rating_min' in filter_data:
-                query = query.where(Feedback.rating >= filter_data['rating_min'])
-            if 'rating_max' in filter_data:
-                query = query.where(Feedback.rating <= filter_data['rating_max'])
-        except:
-            pass
-    
+
+    filter_conditions = _parse_summary_filters(filters)
+
+    if use_rollups and not filter_conditions:
+        source = FeedbackDailyRollup
+        day = FeedbackDailyRollup.day
+        conditions = []
+        if brand_id:
+            conditions.append(FeedbackDailyRollup.brand == brand_id)
+        if product_id:
+            conditions.append(FeedbackDailyRollup.vendor_code == product_id)
+        if date_from:
+            conditions.append(day >= date_from)
+        if date_to:
+            # Живой запрос сравнивает date <= date_to (полночь), весь день date_to туда не попадает
+            conditions.append(day < date_to)
+        total_col = func.sum(FeedbackDailyRollup.total)
+        negative_col = func.sum(FeedbackDailyRollup.negative)
+        deleted_col = func.sum(FeedbackDailyRollup.deleted)
+        rating_cols = {str(r): func.sum(getattr(FeedbackDailyRollup, f'rating_{r}')) for r in range(1, 6)}
+    else:
+        # Как и агрегаты, живой запрос учитывает удалённые отзывы, уже перенесённые в архив
+        source = feedbacks_with_archived_deleted()
+        day = func.date_trunc(literal_column("'day'"), source.date)
+        conditions = _parse_summary_filters(filters, source)  # Без фильтра по user_id - все отзывы доступны всем
+        if brand_id:
+            conditions.append(source.brand == brand_id)
+        if product_id:
+            # Простое сравнение по vendor_code в feedbacks
+            conditions.append(source.vendor_code == product_id)
+        if date_from:
+            conditions.append(source.date >= date_from)
+        if date_to:
+            conditions.append(source.date <= date_to)
+        total_col = func.count()
+        negative_col = func.count().filter(source.is_negative == 1)
+        deleted_col = func.count().filter(source.is_deleted == True)
+        rating_cols = {str(r): func.count().filter(source.rating == r) for r in range(1, 6)}
+
+    # Считаем только то, что нужно для запрошенных метрик
+    columns = [day.label('day'), total_col.label('total')]
+    if 'negative' in metrics or 'negative_share' in metrics:
+        columns.append(negative_col.label('negative'))
+        columns.append(func.sum(negative_col).over(order_by=day).label('cum_negative'))
+    if 'deleted' in metrics or 'deleted_share' in metrics:
+        columns.append(deleted_col.label('deleted'))
+        columns.append(func.sum(deleted_col).over(order_by=day).label('cum_deleted'))
+    columns.append(func.sum(total_col).over(order_by=day).label('cum_total'))
+    for m in metrics:
+        if m in rating_cols:
+            columns.append(rating_cols[m].label(f'rating_{m}'))
+
+    query = select(*columns).select_from(source).where(*conditions).group_by(day).order_by(day)
     result = await db.execute(query)
-    feedbacks = result.scalars().all()
-    total_reviews = len(feedbacks)
-    
-    # Если нет отзывов, возвращаем пустой результат
+    rows = result.fetchall()
+
+    # Отзывы без даты (day IS NULL) входят в total_reviews, но не в ряд по дням
+    total_reviews = sum(int(row.total or 0) for row in rows)
     if total_reviews == 0:
         return {"total_reviews": 0, "by_day": []}
 
-    # Внутренние агрегаты, не зависящие от запрошенных метрик
-    day_aggregates: Dict[str, Dict[str, Any]] = {}
-    for f in feedbacks:
-        d = f.date.date().isoformat() if f.date else None
-        if not d:
-            continue
-        if d not in day_aggregates:
-            day_aggregates[d] = {
-                'total': 0,
-                'negative': 0,
-                'deleted': 0,
-                'ratings': {1: 0, 2: 0, 3: 0, 4: 0, 5: 0}
-            }
-        day_aggregates[d]['total'] += 1
-        if getattr(f, 'is_negative', False):
-            day_aggregates[d]['negative'] += 1
-        if getattr(f, 'is_deleted', False):
-            day_aggregates[d]['deleted'] += 1
-        try:
-            r = int(f.rating) if f.rating is not None else None
-            if r in (1, 2, 3, 4, 5):
-                day_aggregates[d]['ratings'][r] += 1
-        except Exception:
-            pass
-
     # Формируем ответ только с запрошенными метриками
     by_day_list: List[Dict[str, Any]] = []
-    sorted_dates = sorted(day_aggregates.keys())
-    
-    # Для накопительных расчётов (доли)
-    cumulative_total = 0
-    cumulative_negative = 0
-    cumulative_deleted = 0
-    
-    for d in sorted_dates:
-        counts = day_aggregates[d]
-        cumulative_total += counts['total']
-        cumulative_negative += counts['negative']
-        cumulative_deleted += counts['deleted']
-        
+    for row in rows:
+        if row.day is None:
+            continue
+        d = row.day.date().isoformat() if isinstance(row.day, datetime) else row.day.isoformat()
+        cumulative_total = int(row.cum_total or 0)
+
         entry: Dict[str, Any] = {"date": d}
         for m in metrics:
             if m == 'negative':
-                entry['negative'] = counts['negative']
+                entry['negative'] = int(row.negative or 0)
             elif m == 'deleted':
-                entry['deleted'] = counts['deleted']
+                entry['deleted'] = int(row.deleted or 0)
             elif m == 'negative_share':
-                entry['negative_share'] = round((cumulative_negative / cumulative_total) * 100, 1) if cumulative_total > 0 else 0.0
+                entry['negative_share'] = round((int(row.cum_negative or 0) / cumulative_total) * 100, 1) if cumulative_total > 0 else 0.0
             elif m == 'deleted_share':
-                entry['deleted_share'] = round((cumulative_deleted / cumulative_total) * 100, 1) if cumulative_total > 0 else 0.0
-            elif m in ('1', '2', '3', '4', '5'):
-                entry[m] = counts['ratings'].get(int(m), 0)
+                entry['deleted_share'] = round((int(row.cum_deleted or 0) / cumulative_total) * 100, 1) if cumulative_total > 0 else 0.0
+            elif m in rating_cols:
+                entry[m] = int(getattr(row, f'rating_{m}') or 0)
         by_day_list.append(entry)
 
     return {"total_reviews": total_reviews, "by_day": by_day_list}
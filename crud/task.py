@@ -1,12 +1,19 @@
-from typing import List
+from typing import List, Optional
 
+from sqlalchemy import update, or_, and_, func, literal
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy.orm import joinedload
+from sqlalchemy.orm import joinedload, aliased
 
 from models.task import ScheduledTask
+from crud.media_blob import release_blob
 from datetime import datetime
 
+# Ключ pg_advisory_xact_lock: выборки задач claim_due_tasks выполняются по одной
+SCHEDULED_TASKS_CLAIM_LOCK = 7_301_001
+# Через сколько секунд перепроверять задачи, ждущие освобождения своей карточки
+BUSY_CARD_RECHECK_SECONDS = 5.0
+
 
 async def create_scheduled_task(
     db: AsyncSession,
@@ -36,7 +43,7 @@ async def create_scheduled_task(
     return task
 
 
-from datetime import datetime
+from datetime import datetime, timedelta
 from dateutil import tz
 
 
@@ -53,6 +60,135 @@ async def get_pending_tasks(db: AsyncSession)->List[ScheduledTask]:
     return result.scalars().all()
 
 
+def _card_busy(lease_cutoff: datetime):
+    """У карточки задачи есть другая задача в processing с действующей арендой"""
+    running = aliased(ScheduledTask)
+    return select(running.id).where(
+        running.nm_id == ScheduledTask.nm_id,
+        running.status == 'processing',
+        running.claimed_at >= lease_cutoff
+    ).exists()
+
+
+async def claim_due_tasks(db: AsyncSession, limit: int, lease_minutes: int = 15) -> List:
+    """Атомарно забирает до limit наступивших задач: pending -> processing.
+
+    FOR UPDATE SKIP LOCKED позволяет нескольким процессам забирать задачи параллельно без дублей.
+    Задачи, зависшие в processing дольше lease_minutes (упавший воркер), забираются повторно.
+    Задачи одной карточки выполняются по очереди: за раз забирается не больше одной задачи на nm_id
+    и ни одной, пока у карточки есть задача в processing с действующей арендой.
+    Возвращает строки (id, action, user_id, brand, nm_id, scheduled_at, claimed_at); перед выполнением
+    задачи подтверждаются через start_claimed_tasks.
+    """
+    msk_tz = tz.gettz('Europe/Moscow')
+    now_msk = datetime.now(msk_tz)
+    lease_cutoff = now_msk - timedelta(minutes=lease_minutes)
+
+    # Проверка "карточка занята" согласована только если выборки не идут параллельно:
+    # иначе два процесса увидят одну карточку свободной до коммита друг друга
+    await db.execute(select(func.pg_advisory_xact_lock(SCHEDULED_TASKS_CLAIM_LOCK)))
+
+    card_busy = _card_busy(lease_cutoff)
+    first_per_card = select(ScheduledTask.id).where(
+        or_(
+            and_(
+                ScheduledTask.status == 'pending',
+                ScheduledTask.scheduled_at <= now_msk.replace(tzinfo=None)
+            ),
+            and_(
+                ScheduledTask.status == 'processing',
+                # claimed_at IS NULL - задачи, оставшиеся в processing от прежнего планировщика
+                or_(ScheduledTask.claimed_at.is_(None), ScheduledTask.claimed_at < lease_cutoff)
+            )
+        ),
+        ~card_busy
+    ).distinct(ScheduledTask.nm_id).order_by(
+        ScheduledTask.nm_id, ScheduledTask.scheduled_at, ScheduledTask.id
+    )
+    due_ids = select(ScheduledTask.id).where(
+        ScheduledTask.id.in_(first_per_card)
+    ).order_by(ScheduledTask.scheduled_at).limit(limit).with_for_update(skip_locked=True)
+
+    result = await db.execute(
+        update(ScheduledTask)
+        .where(ScheduledTask.id.in_(due_ids.scalar_subquery()))
+        .values(status='processing', claimed_at=now_msk)
+        .returning(
+            ScheduledTask.id,
+            ScheduledTask.action,
+            ScheduledTask.user_id,
+            ScheduledTask.brand,
+            ScheduledTask.nm_id,
+            ScheduledTask.scheduled_at,
+            ScheduledTask.claimed_at
+        )
+        .execution_options(synchronize_session=False)
+    )
+    rows = result.fetchall()
+    await db.commit()
+    return sorted(rows, key=lambda r: (r.scheduled_at, r.id))
+
+
+async def start_claimed_tasks(db: AsyncSession, task_ids: List[int], claimed_at: datetime) -> List[int]:
+    """Подтверждает запуск забранных задач: продлевает аренду (claimed_at = сейчас).
+
+    Пока задача ждала слота бренда в пуле, её аренда могла истечь и задачу мог забрать другой воркер.
+    Поэтому подтверждаются только задачи, которые всё ещё в processing с claimed_at из claim_due_tasks.
+    Возвращает id задач, которые можно выполнять.
+    """
+    if not task_ids:
+        return []
+    msk_tz = tz.gettz('Europe/Moscow')
+    result = await db.execute(
+        update(ScheduledTask)
+        .where(
+            ScheduledTask.id.in_(task_ids),
+            ScheduledTask.status == 'processing',
+            ScheduledTask.claimed_at == claimed_at
+        )
+        .values(claimed_at=datetime.now(msk_tz))
+        .returning(ScheduledTask.id)
+        .execution_options(synchronize_session=False)
+    )
+    started = [row.id for row in result.fetchall()]
+    await db.commit()
+    return started
+
+
+async def get_next_task_delay(db: AsyncSession, lease_minutes: int = 15) -> Optional[float]:
+    """Секунды до ближайшей задачи, которую заберёт claim_due_tasks (None - задач нет).
+
+    Сравнение с тем же значением "сейчас", что и в claim_due_tasks, чтобы диспетчер не просыпался впустую.
+    """
+    msk_tz = tz.gettz('Europe/Moscow')
+    now_msk = datetime.now(msk_tz)
+
+    card_busy = _card_busy(now_msk - timedelta(minutes=lease_minutes))
+    next_pending = select(
+        func.extract('epoch', func.min(ScheduledTask.scheduled_at) - literal(now_msk.replace(tzinfo=None)))
+    ).where(ScheduledTask.status == 'pending', ~card_busy).scalar_subquery()
+    # Наступившие задачи занятых карточек: завершение задачи в другом процессе не шлёт NOTIFY
+    blocked = select(ScheduledTask.id).where(
+        ScheduledTask.status == 'pending',
+        ScheduledTask.scheduled_at <= now_msk.replace(tzinfo=None),
+        card_busy
+    ).exists()
+    next_lease_expiry = select(
+        func.extract('epoch', func.min(
+            func.coalesce(ScheduledTask.claimed_at, literal(now_msk) - timedelta(minutes=lease_minutes))
+        ) + timedelta(minutes=lease_minutes) - literal(now_msk))
+    ).where(ScheduledTask.status == 'processing').scalar_subquery()
+
+    row = (await db.execute(select(
+        next_pending.label('pending'), next_lease_expiry.label('lease'), blocked.label('blocked')
+    ))).first()
+    await db.commit()
+    delays = [float(d) for d in (row.pending, row.lease) if d is not None]
+    if row.blocked:
+        delays.append(BUSY_CARD_RECHECK_SECONDS)
+    return min(delays) if delays else None
+
+
 async def get_tasks_with_pending(db: AsyncSession,user_id:int)->List[ScheduledTask]:
     result = await db.execute(
         select(ScheduledTask).where(
@@ -68,5 +204,8 @@ async def get_task_by_id(db: AsyncSession, task_id: int, )->ScheduledTask:
 
 async def delete_task(db: AsyncSession, task_id: int):
     task = await get_task_by_id(db, task_id)
+    blob_sha256 = (task.payload or {}).get("blob_sha256") if isinstance(task.payload, dict) else None
+    if blob_sha256 and task.status != 'completed':
+        await release_blob(db, blob_sha256)
     await db.delete(task)
     await db.commit()
\ No newline at end of file
@@ -1,9 +1,15 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
 from fastapi import HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 
 from utils.password import get_password_hash, verify_password, decrypt_api_dict
 from models.user import User
+from config import settings
 from schemas import UserCreate
 
 
@@ -46,6 +52,11 @@ async def authenticate_user(db: AsyncSession, email: str, password: str)-> User:
     return user
 
 
+# Расшифрованные WB-ключи: (user_id, бренд, sha256 шифртекста) -> (истекает, ключ).
+# Дайджест шифртекста в ключе делает кеш безопасным при смене ключа в другом процессе.
+_decrypted_key_cache: "OrderedDict[Tuple[int, str, str], Tuple[float, str]]" = OrderedDict()
+
+
 async def get_decrypted_wb_key(db: AsyncSession, user: User, brand: str) -> str:
     if not user.wb_api_key:
         raise HTTPException(
@@ -53,7 +64,15 @@ async def get_decrypted_wb_key(db: AsyncSession, user: User, brand: str) -> str:
             detail="У пользователя не настроены API-ключи"
         )
 
-    decrypted_keys = decrypt_api_dict(user.wb_api_key)
+    encrypted_key = user.wb_api_key.get(brand)
+    cache_key = (user.id, brand, hashlib.sha256((encrypted_key or "").encode()).hexdigest())
+    cached = _decrypted_key_cache.get(cache_key)
+    if cached and cached[0] > time.monotonic():
+        _decrypted_key_cache.move_to_end(cache_key)
+        return cached[1]
+
+    # Расшифровываем только нужный бренд, а не весь словарь ключей
+    decrypted_keys = decrypt_api_dict({brand: encrypted_key}) if encrypted_key else {}
 
     if brand not in decrypted_keys or not decrypted_keys[brand]:
         raise HTTPException(
@@ -61,9 +80,19 @@ async def get_decrypted_wb_key(db: AsyncSession, user: User, brand: str) -> str:
             detail=f"API-ключ для бренда '{brand}' не найден или не расшифрован"
         )
 
+    _decrypted_key_cache[cache_key] = (time.monotonic() + settings.API_KEY_CACHE_TTL_SECONDS, decrypted_keys[brand])
+    _decrypted_key_cache.move_to_end(cache_key)
+    while len(_decrypted_key_cache) > settings.API_KEY_CACHE_MAX_ENTRIES:
+        _decrypted_key_cache.popitem(last=False)
     return decrypted_keys[brand]
 
 
+def invalidate_decrypted_wb_keys(user_id: int, brand: Optional[str] = None) -> None:
+    """Сбрасывает кеш расшифрованных ключей пользователя (всех брендов или одного)"""
+    for key in [k for k in _decrypted_key_cache if k[0] == user_id and (brand is None or k[1] == brand)]:
+        _decrypted_key_cache.pop(key, None)
+
+
 async def get_all_users(db: AsyncSession):
     result = await db.execute(select(User))
     return result.scalars().all()
@@ -1,11 +1,11 @@
 from fastapi import FastAPI
-from sqlalchemy import select
+from sqlalchemy import select, text
 import asyncio
 
 from database import engine, Base, AsyncSessionLocal
 from routers import items, auth, tasks, admin, history, feedbacks, analytics, product_reviews, aspect_analysis
 from utils.password import get_password_hash
-from utils.scheduler import start_scheduler
+from utils.scheduler import start_scheduler, stop_scheduler
 from fastapi.middleware.cors import CORSMiddleware
 from routers.shops_summary import router as shops_summary_router
 
@@ -36,6 +36,8 @@ app.add_middleware(
 @app.on_event("startup")
 async def startup_event():
     async with engine.begin() as conn:
+        # Триграммный индекс по автору отзыва требует pg_trgm
+        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
         await conn.run_sync(Base.metadata.create_all)
 
     # Запускаем планировщик в фоновой задаче
@@ -43,6 +45,12 @@ async def startup_event():
     print("🚀 Планировщик запущен в фоновой задаче")
 
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Останавливаем планировщик и закрываем пул соединений к WB API
+    await stop_scheduler()
+
+
 async def start_scheduler_async():
     """Асинхронный запуск планировщика"""
     try:
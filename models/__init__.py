@@ -1,9 +1,11 @@
 from models.user import User
 from models.task import ScheduledTask
 from models.history import History
-from models.feedback import Feedback, FeedbackAnalytics
+from models.feedback import Feedback, FeedbackAnalytics, FeedbackDailyRollup, FeedbackArchive
 from models.shop import Shop, PriceHistory
 from models.product import Product
 from models.telegram_user import TelegramUser
 from models.price_change_history import PriceChangeHistory
-from models.aspect import Aspect, FeedbackAspect
+from models.aspect import Aspect, FeedbackAspect, AspectAnalysisCache
+from models.card_index import WBCardIndex, WBCardIndexState
+from models.media_blob import MediaBlob
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, Index, func
+from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean, Index, JSON, func
 from sqlalchemy.orm import relationship
 from database import Base
 
@@ -45,22 +45,15 @@ class FeedbackAspect(Base):
     )
 
 
+class AspectAnalysisCache(Base):
+    """Кеш результатов ИИ-анализа аспектов по нормализованному тексту отзыва (crud/aspect_cache)"""
+    __tablename__ = "aspect_analysis_cache"
 
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    # sha256(нормализованный текст, рейтинг, версия промпта, модель)
+    cache_key = Column(String(64), primary_key=True)
+    prompt_version = Column(String(32), nullable=False)
+    model = Column(String(100), nullable=False)
+    aspects = Column(JSON, nullable=False)  # {аспект: {sentiment, confidence, evidence, category, ...}}
+    hits = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    last_hit_at = Column(DateTime(timezone=True), nullable=True)
@@ -0,0 +1,39 @@
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, Boolean, JSON, ForeignKey, Index, UniqueConstraint, func
+from database import Base
+
+
+class WBCardIndex(Base):
+    """Локальная копия карточек WB для (user, brand): поиск по nmID/vendorCode без выгрузки каталога"""
+    __tablename__ = "wb_card_index"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    brand = Column(String, nullable=False)
+    nm_id = Column(BigInteger, nullable=False)
+    vendor_code = Column(String, nullable=True)
+    card = Column(JSON, nullable=False)
+    wb_updated_at = Column(String(64), nullable=True)  # updatedAt карточки как его вернул WB
+    synced_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'brand', 'nm_id', name='uq_wb_card_index_user_brand_nm'),
+        Index('idx_wb_card_index_user_brand_vendor', 'user_id', 'brand', func.lower(vendor_code)),
+    )
+
+
+class WBCardIndexState(Base):
+    """Курсор инкрементальной синхронизации индекса карточек для (user, brand)"""
+    __tablename__ = "wb_card_index_state"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    brand = Column(String, nullable=False)
+    cursor_updated_at = Column(String(64), nullable=True)
+    cursor_nm_id = Column(BigInteger, nullable=True)
+    is_stale = Column(Boolean, default=False, nullable=False)  # выставляется после записи в WB
+    synced_at = Column(DateTime(timezone=True), nullable=True)
+    full_synced_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        UniqueConstraint('user_id', 'brand', name='uq_wb_card_index_state_user_brand'),
+    )
@@ -1,9 +1,19 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, Float, ForeignKey, Boolean, Index, JSON
-from sqlalchemy.orm import relationship
+from sqlalchemy import Column, Integer, String, DateTime, Date, Text, Float, ForeignKey, Boolean, Index, JSON, Computed, UniqueConstraint, func, text as sa_text
+from sqlalchemy.dialects.postgresql import TSVECTOR
+from sqlalchemy.orm import relationship, deferred
 from database import Base
 # from utils.moscow_time import moscow_now  # если используется
 from datetime import datetime
 
+# Полнотекстовый вектор отзыва (русская морфология), веса: основной текст > плюсы/минусы > исходный text
+FEEDBACK_SEARCH_VECTOR_SQL = (
+    "setweight(to_tsvector('russian', coalesce(main_text, '')), 'A') || "
+    "setweight(to_tsvector('russian', coalesce(pros_text, '')), 'B') || "
+    "setweight(to_tsvector('russian', coalesce(cons_text, '')), 'B') || "
+    "setweight(to_tsvector('russian', coalesce(\"text\", '')), 'D')"
+)
+
+
 class Feedback(Base):
     __tablename__ = "feedbacks"
 
@@ -44,6 +54,13 @@ class Feedback(Base):
     content_hash = Column(String, nullable=True, index=True)
     suspected_deleted_at = Column(DateTime(timezone=True), nullable=True)
     superseded_by_wb_id = Column(String, nullable=True)
+    # Очередь анализа аспектов (crud/aspect_queue): pending -> processing -> done | failed | skipped
+    aspect_status = Column(String(16), nullable=False, default='pending', server_default='pending')
+    aspect_attempts = Column(Integer, nullable=False, default=0, server_default='0')
+    aspect_prompt_version = Column(String(32), nullable=True)  # версия промпта или 'local' для каскада
+    aspect_claimed_at = Column(DateTime(timezone=True), nullable=True)
+    # Генерируемая колонка для полнотекстового поиска (GIN-индекс ниже); в ORM-выборки не грузится
+    search_vector = deferred(Column(TSVECTOR, Computed(FEEDBACK_SEARCH_VECTOR_SQL, persisted=True)))
 
     # Составные индексы для оптимизации запросов
     __table_args__ = (
@@ -56,6 +73,83 @@ class Feedback(Base):
         # Добавляем составной уникальный индекс для wb_id + article + brand
         Index('idx_wb_id_article_brand_unique', 'wb_id', 'article', 'brand', unique=True),
         Index('idx_brand_article_global_user', 'brand', 'article', 'global_user_id'),
+        # Keyset-пагинация ленты отзывов по (coalesce(date, created_at), id).
+        # created_at приводим к московскому времени: выражение должно быть IMMUTABLE для индекса
+        Index(
+            'idx_feedbacks_review_date_id',
+            func.coalesce(date, func.timezone('Europe/Moscow', created_at)).desc(),
+            id.desc(),
+        ),
+        Index(
+            'idx_feedbacks_brand_review_date_id',
+            'brand',
+            func.coalesce(date, func.timezone('Europe/Moscow', created_at)).desc(),
+            id.desc(),
+        ),
+        # Вкладка отзывов товара: WHERE article = ? ORDER BY date DESC, id DESC
+        Index('idx_feedbacks_article_date_id', 'article', date.desc(), id.desc()),
+        Index('idx_feedbacks_search_vector', 'search_vector', postgresql_using='gin'),
+        # Поиск по автору через ILIKE '%...%' обслуживает триграммный индекс (расширение pg_trgm)
+        Index(
+            'idx_feedbacks_author_trgm', 'author',
+            postgresql_using='gin', postgresql_ops={'author': 'gin_trgm_ops'}
+        ),
+        # Очередь анализа аспектов: частичные индексы покрывают только ожидающие и взятые в работу
+        Index('idx_feedbacks_aspect_pending', 'id', postgresql_where=sa_text("aspect_status = 'pending'")),
+        Index('idx_feedbacks_aspect_processing', 'aspect_claimed_at', postgresql_where=sa_text("aspect_status = 'processing'")),
+        # Отзывы без оценки тональности (crud/sentiment)
+        Index('idx_feedbacks_sentiment_pending', 'id', postgresql_where=sa_text("sentiment_score IS NULL")),
+    )
+
+
+class FeedbackArchive(Base):
+    """Архив отзывов: удалённые и вышедшие за горизонт аналитики. id совпадает с feedbacks.id"""
+    __tablename__ = "feedbacks_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    article = Column(String(32), nullable=False)
+    brand = Column(String, nullable=False)
+    vendor_code = Column(String, nullable=True)
+    author = Column(String, nullable=True)
+    rating = Column(Integer, nullable=False)
+    date = Column(DateTime, nullable=True)
+    status = Column(String, nullable=True)
+    text = Column(Text, nullable=True)
+    main_text = Column(Text, nullable=True)
+    pros_text = Column(Text, nullable=True)
+    cons_text = Column(Text, nullable=True)
+    sentiment_score = Column(Float, nullable=True)
+    is_negative = Column(Integer, default=0)
+    is_processed = Column(Integer, default=0)
+    processing_notes = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True))
+    updated_at = Column(DateTime(timezone=True))
+    user_id = Column(Integer, nullable=True)
+    history_id = Column(Integer, nullable=True)
+    is_deleted = Column(Boolean, default=False)
+    deleted_at = Column(DateTime(timezone=True), nullable=True)
+    wb_id = Column(String, nullable=False)
+    aspects = Column(JSON, nullable=True)
+    bables_resolved = Column(JSON, nullable=True)
+    wb_updated_at = Column(DateTime, nullable=True)
+    global_user_id = Column(String, nullable=True)
+    wb_user_id = Column(Integer, nullable=True)
+    content_hash = Column(String, nullable=True)
+    suspected_deleted_at = Column(DateTime(timezone=True), nullable=True)
+    superseded_by_wb_id = Column(String, nullable=True)
+    aspect_status = Column(String(16), nullable=True)
+    aspect_attempts = Column(Integer, nullable=True)
+    aspect_prompt_version = Column(String(32), nullable=True)
+    # Снимок строки feedback_top_tracking на момент архивации
+    top_tracking = Column(JSON, nullable=True)
+    archive_reason = Column(String(20), nullable=False)  # deleted | aged_out
+    archived_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    __table_args__ = (
+        Index('idx_feedbacks_archive_brand_article', 'brand', 'article'),
+        Index('idx_feedbacks_archive_wb_id_article_brand', 'wb_id', 'article', 'brand'),
+        # Отзывы товара читают и архивные удалённые (crud.feedback_archive.feedbacks_with_archived_deleted)
+        Index('idx_feedbacks_archive_deleted_article', 'article', postgresql_where=sa_text("archive_reason = 'deleted'")),
     )
 
 
@@ -125,4 +219,28 @@ class FeedbackAnalytics(Base):
     unprocessed_negative_count = Column(Integer, default=0)
     avg_sentiment = Column(Float, default=0.0)
     created_at = Column(DateTime(timezone=True))
-    updated_at = Column(DateTime(timezone=True)) 
\ No newline at end of file
+    updated_at = Column(DateTime(timezone=True))
+
+
+class FeedbackDailyRollup(Base):
+    """Дневные агрегаты отзывов по бренду и товару (для графиков сводки магазинов)"""
+    __tablename__ = "feedback_daily_rollups"
+
+    id = Column(Integer, primary_key=True, index=True)
+    brand = Column(String, nullable=False)
+    vendor_code = Column(String, nullable=False, default='')  # '' - отзывы без vendor_code
+    day = Column(Date, nullable=False)
+    total = Column(Integer, default=0)
+    negative = Column(Integer, default=0)
+    deleted = Column(Integer, default=0)
+    rating_1 = Column(Integer, default=0)
+    rating_2 = Column(Integer, default=0)
+    rating_3 = Column(Integer, default=0)
+    rating_4 = Column(Integer, default=0)
+    rating_5 = Column(Integer, default=0)
+    updated_at = Column(DateTime(timezone=True), default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        UniqueConstraint('brand', 'vendor_code', 'day', name='uq_feedback_daily_rollups_brand_vendor_day'),
+        Index('idx_feedback_daily_rollups_brand_day', 'brand', 'day'),
+    )
@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import Column, Integer, String, DateTime, JSON, ForeignKey
+from sqlalchemy import Column, Integer, String, DateTime, JSON, ForeignKey, Index, DDL, event
 from sqlalchemy.orm import relationship
 from sqlalchemy.dialects.postgresql import TIMESTAMP
 from database import Base
@@ -23,6 +23,37 @@ class ScheduledTask(Base):
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     changes = Column(JSON, nullable=True)
     brand = Column(String, nullable=False)
+    claimed_at = Column(TIMESTAMP(timezone=True), nullable=True)  # когда воркер взял задачу (аренда)
+    duration_ms = Column(Integer, nullable=True)  # время выполнения последней попытки
 
     owner = relationship("User", back_populates="tasks")
 
+    __table_args__ = (
+        # Выбор наступивших задач и ближайшего scheduled_at диспетчером
+        Index('idx_scheduled_tasks_status_scheduled_at', 'status', 'scheduled_at'),
+    )
+
+
+# Канал LISTEN/NOTIFY: диспетчер задач просыпается сразу после появления/переноса pending-задачи
+SCHEDULED_TASKS_CHANNEL = 'scheduled_tasks'
+
+SCHEDULED_TASKS_NOTIFY_FUNCTION_SQL = f"""
+CREATE OR REPLACE FUNCTION notify_scheduled_tasks() RETURNS trigger AS $$
+BEGIN
+    IF NEW.status = 'pending' THEN
+        PERFORM pg_notify('{SCHEDULED_TASKS_CHANNEL}', NEW.id::text);
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+SCHEDULED_TASKS_NOTIFY_TRIGGER_SQL = """
+CREATE TRIGGER scheduled_tasks_notify
+AFTER INSERT OR UPDATE OF status, scheduled_at ON scheduled_tasks
+FOR EACH ROW EXECUTE FUNCTION notify_scheduled_tasks()
+"""
+
+event.listen(ScheduledTask.__table__, 'after_create', DDL(SCHEDULED_TASKS_NOTIFY_FUNCTION_SQL))
+event.listen(ScheduledTask.__table__, 'after_create', DDL(SCHEDULED_TASKS_NOTIFY_TRIGGER_SQL))
+
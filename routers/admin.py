@@ -15,6 +15,10 @@ from crud.admin import (
 )
 from models.user import User
 from utils.jwt import get_current_active_user
+from utils.rate_limiter import get_wb_api_counters
+from utils.task_worker import get_task_worker_stats
+from utils.aspect_processor import get_aspect_pipeline_stats
+from utils.sentiment_scorer import get_sentiment_stats
 
 router = APIRouter(tags=["brands"], prefix="/api/admin")
 
@@ -124,6 +128,46 @@ async def remove_brand(
     return await delete_brand(db, current_user.id, brand_name)
 #Астахов И.А.
 
+@router.get("/wb-api/counters", response_model=Dict[str, Dict[str, float]])
+async def read_wb_api_counters(
+        current_user: User = Depends(get_current_active_user)
+):
+    """Счётчики лимитера WB API текущего процесса по семействам эндпоинтов"""
+    if current_user.status != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return get_wb_api_counters()
+
+
+@router.get("/tasks/stats", response_model=Dict[str, float])
+async def read_task_worker_stats(
+        current_user: User = Depends(get_current_active_user)
+):
+    """Выполненные задачи, длительность (средняя и максимальная) и занятые слоты пула воркеров (текущий процесс)"""
+    if current_user.status != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return get_task_worker_stats()
+
+
+@router.get("/aspect-pipeline/stats", response_model=Dict[str, float])
+async def read_aspect_pipeline_stats(
+        current_user: User = Depends(get_current_active_user)
+):
+    """Доли этапов каскада анализа аспектов и согласие локальной разметки с ИИ (текущий процесс)"""
+    if current_user.status != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return get_aspect_pipeline_stats()
+
+
+@router.get("/sentiment/stats", response_model=Dict[str, float])
+async def read_sentiment_stats(
+        current_user: User = Depends(get_current_active_user)
+):
+    """Скорость и паддинг локальной оценки тональности (текущий процесс)"""
+    if current_user.status != "admin":
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return get_sentiment_stats()
+
+
 @router.get("/check-admin", response_model=IsAdminResponse)
 async def check_admin(
         current_user: User = Depends(get_current_active_user),
@@ -35,13 +35,17 @@ async def get_reviews_with_filters(
     date_to: Optional[date] = Query(None),
     negative: Optional[bool] = Query(None),
     deleted: Optional[bool] = Query(None),
+    cursor: Optional[str] = Query(None, description="next_cursor предыдущей страницы (keyset-пагинация)"),
+    count_mode: str = Query("exact", regex="^(exact|estimated)$", description="exact или estimated (оценка total без фильтров)"),
+    search_mode: str = Query("substring", regex="^(fulltext|substring)$", description="substring (ILIKE, по умолчанию) или fulltext (ранжирование, \"фраза\", слово*)"),
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user_with_wb_key)
 ):
     """Получение отзывов с расширенной фильтрацией"""
     return await get_reviews_with_filters_crud(
         db, current_user.id, page, per_page, search, 
-        rating, shop, product, date_from, date_to, negative, deleted
+        rating, shop, product, date_from, date_to, negative, deleted,
+        cursor=cursor, count_mode=count_mode, search_mode=search_mode
     )
 
 
@@ -11,6 +11,7 @@ from sqlalchemy import select
 import logging
 from utils.aspect_analyzer import aspect_analyzer
 from utils.ai_aspect_analyzer import ai_aspect_analyzer
+from crud.aspect_queue import ASPECT_STATUS_DONE
 
 router = APIRouter(prefix="/aspect-analysis", tags=["aspect-analysis"])
 
@@ -278,6 +279,7 @@ async def _save_aspects_to_feedbacks(db: AsyncSession, feedbacks: List[Feedback]
                         "all_aspects": all_aspects,
                         "analyzed_at": datetime.now().isoformat()
                     }
+                    feedback.aspect_status = ASPECT_STATUS_DONE
                     
                 except Exception as e:
                     logger.warning(f"Не удалось проанализировать отзыв {feedback.id}: {e}")
@@ -10,6 +10,9 @@ from crud.admin import get_imagebb_key
 from crud.history import create_history, upload_to_imgbb, convert_image_url_to_jpg_bytes
 from crud.task import create_scheduled_task
 from crud.user import get_decrypted_wb_key
+from crud.card_index import CardIndex
+from crud.media_blob import acquire_blob
+from utils.blob_store import stage_upload, place_upload, discard_upload
 from models import ScheduledTask
 from models.user import User
 from utils.wb_api import WBAPIClient
@@ -43,26 +46,25 @@ async def get_items(
 @router.get("/{nm_id}", response_model=WBApiResponse)
 async def get_item(
         nm_id: int,
+        brand: str = Query(..., description="Название бренда"),
         current_user: User = Depends(get_current_user_with_wb_key),
         wb_api_key: str = Depends(get_wb_api_key),
         db: AsyncSession = Depends(get_db)
 ):
-    wb_client = WBAPIClient(api_key=wb_api_key)
-    result = await wb_client.get_all_cards_with_pagination()
-    if not result.success or not result.data:
-        return WBApiResponse(success=False, error="Карточки не найдены")
-    cards = result.data.get("cards", [])
-    if not cards:
+    wb_client = WBAPIClient(api_key=wb_api_key, card_index=CardIndex(current_user.id, brand))
+    try:
+        card_response = await wb_client.get_card_by_nm(nm_id)
+    except Exception as e:
+        return WBApiResponse(success=False, error=f"Карточки не найдены: {e}")
+    if not card_response.success:
         return WBApiResponse(success=False, error="Карточка не найдена")
-    for card in cards:
-        if card.get("nmID") == nm_id:
-            # Гарантируем, что photos и video попадут в ответ
-            result = dict(card)
-            result["photos"] = card.get("photos", [])
-            if "video" in card:
-                result["video"] = card["video"]
-            return WBApiResponse(success=True, data=result)
-    return WBApiResponse(success=False, error="Карточка не найдена")
+    card = card_response.data
+    # Гарантируем, что photos и video попадут в ответ
+    result = dict(card)
+    result["photos"] = card.get("photos", [])
+    if "video" in card:
+        result["video"] = card["video"]
+    return WBApiResponse(success=True, data=result)
 
 
 @router.post("/{nm_id}/schedule", response_model=dict)
@@ -74,8 +76,12 @@ async def schedule_content_update(
         current_user: User = Depends(get_current_user_with_wb_key),
         wb_api_key: str = Depends(get_wb_api_key)
 ):
-    wb_client = WBAPIClient(api_key=wb_api_key)
-    current_card_response = await wb_client.get_card_by_nm(nm_id)
+    wb_client = WBAPIClient(api_key=wb_api_key, card_index=CardIndex(current_user.id, brand))
+    try:
+        current_card_response = await wb_client.get_card_by_nm(nm_id)
+    except ValueError as e:
+        # Индекс карточек не удалось досинхронизировать: ошибка WB, а не отсутствие карточки
+        raise HTTPException(status_code=502, detail=str(e))
     if not current_card_response.success:
         raise HTTPException(status_code=404, detail="Карточка не найдена")
 
@@ -177,8 +183,12 @@ async def schedule_media_update(
         current_user: User = Depends(get_current_user_with_wb_key),
         wb_api_key: str = Depends(get_wb_api_key)
 ):
-    wb_client = WBAPIClient(api_key=wb_api_key)
-    current_card_response = await wb_client.get_card_by_nm(nm_id)
+    wb_client = WBAPIClient(api_key=wb_api_key, card_index=CardIndex(current_user.id, brand))
+    try:
+        current_card_response = await wb_client.get_card_by_nm(nm_id)
+    except ValueError as e:
+        # Индекс карточек не удалось досинхронизировать: ошибка WB, а не отсутствие карточки
+        raise HTTPException(status_code=502, detail=str(e))
     if not current_card_response.success:
         raise HTTPException(status_code=404, detail="Карточка не найдена")
 
@@ -264,16 +274,24 @@ async def upload_media_file(
     except ValueError:
         raise HTTPException(status_code=422, detail="Некорректный формат времени")
 
-    file_data = await file.read()
+    # Файл кладём в хранилище по sha256, в задаче - только ссылка на него
+    blob_sha256, blob_size, tmp_path = await stage_upload(file)
 
     now = datetime.now(ZoneInfo("Europe/Moscow"))
 
+    try:
+        # Сначала ссылка, потом файл: сборка мусора удаляет файл под блокировкой строки media_blobs
+        await acquire_blob(db, blob_sha256, blob_size)
+        place_upload(tmp_path, blob_sha256)
+    except Exception:
+        discard_upload(tmp_path)
+        raise
     task = await create_scheduled_task(
         db=db,
         nm_id=nm_id,
         action="upload_media_file",
         payload={
-            "file_data": file_data.decode('latin1'),
+            "blob_sha256": blob_sha256,
             "photo_number": photo_number,
             "filename": file.filename,
             "media_type": media_type
@@ -294,27 +312,21 @@ async def upload_media_file(
 @router.get("/search/{vendor_code}", response_model=WBApiResponse)
 async def search_item(
         vendor_code: str,
+        brand: str = Query(..., description="Название бренда"),
         current_user: User = Depends(get_current_user_with_wb_key),
         wb_api_key: str = Depends(get_wb_api_key),
         db: AsyncSession = Depends(get_db)
 ):
-    wb_client = WBAPIClient(api_key=wb_api_key)
-    result = await wb_client.get_all_cards_with_pagination()
-    if not result.success or not result.data:
-        return WBApiResponse(success=False, error="Карточки не найдены")
-    cards = result.data.get("cards", [])
-    if not cards:
+    wb_client = WBAPIClient(api_key=wb_api_key, card_index=CardIndex(current_user.id, brand))
+    card_response = await wb_client.get_card_by_vendor(vendor_code)
+    if not card_response.success:
         return WBApiResponse(success=False, error="Карточка не найдена")
-    
-    for card in cards:
-        current_vc = str(card.get("vendorCode", "")).lower()
-        if current_vc == vendor_code.lower():
-            result = dict(card)
-            result["photos"] = card.get("photos", [])
-            if "video" in card:
-                result["video"] = card["video"]
-            return WBApiResponse(success=True, data=result)
-    return WBApiResponse(success=False, error="Карточка не найдена")
+    card = card_response.data
+    result = dict(card)
+    result["photos"] = card.get("photos", [])
+    if "video" in card:
+        result["video"] = card["video"]
+    return WBApiResponse(success=True, data=result)
 
 
 def compare_values(old, new):
@@ -15,10 +15,11 @@ async def get_product_reviews(
     rating: Optional[int] = Query(None, ge=1, le=5),
     date_from: Optional[str] = Query(None),
     date_to: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None, description="next_cursor предыдущей страницы (keyset-пагинация)"),
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user_with_wb_key)
 ):
-    return await get_product_reviews_crud(db, current_user.id, article, page, per_page, rating, date_from, date_to)
+    return await get_product_reviews_crud(db, current_user.id, article, page, per_page, rating, date_from, date_to, cursor)
 
 @router.get("/{article}/stats")
 async def get_product_stats(
@@ -29,13 +29,14 @@ async def get_reviews_summary(
     date_to: date = Query(...),
     metrics: str = Query(..., description="Метрика для отображения"),
     filters: Optional[str] = Query(None),
+    use_rollups: bool = Query(False, description="Читать дневные агрегаты из feedback_daily_rollups"),
     db: AsyncSession = Depends(get_db),
     current_user: User = Depends(get_current_user_with_wb_key)
 ):
     """Получение краткой статистики по отзывам (для графика)"""
     # Преобразуем строку в список для совместимости с CRUD
     metrics_list = [metrics]
-    summary = await get_shop_feedbacks_crud(db, current_user.id, brand_id, product_id, date_from, date_to, filters, metrics_list)
+    summary = await get_shop_feedbacks_crud(db, current_user.id, brand_id, product_id, date_from, date_to, filters, metrics_list, use_rollups)
     return summary
 
 @router.get("/reviews/tops")
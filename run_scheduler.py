@@ -15,7 +15,7 @@ import pytz
 # Добавляем корневую директорию в путь
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from utils.scheduler import start_scheduler
+from utils.scheduler import start_scheduler, stop_scheduler
 
 # Настройка логирования
 def setup_logging():
@@ -41,7 +41,7 @@ def setup_logging():
     
     return logging.getLogger(__name__)
 
-def main():
+async def main():
     """Главная функция запуска планировщика"""
     logger = setup_logging()
     
@@ -58,7 +58,7 @@ def main():
         logger.info("📋 НАСТРОЙКИ ПЛАНИРОВЩИКА:")
         logger.info("   📝 Парсер отзывов: каждые 30 минут")
         logger.info("   🤖 Анализатор аспектов: каждые 32 минуты")
-        logger.info("   ⚙️  Обработка задач: каждые 5 секунд")
+        logger.info("   ⚙️  Обработка задач: по scheduled_at и уведомлениям БД (LISTEN/NOTIFY)")
         logger.info("   ⏰ Следующий парсинг: через 30 минут")
         logger.info("   ⏰ Следующий анализ: через 32 минуты")
         logger.info("")
@@ -80,14 +80,13 @@ def main():
             while True:
                 await asyncio.sleep(60)  # Проверяем каждую минуту
                 
-        except KeyboardInterrupt:
+        except (KeyboardInterrupt, asyncio.CancelledError):
             logger.info("")
             logger.info("⏹️  Получен сигнал остановки (Ctrl+C)")
             logger.info("🔄 Останавливаем планировщик...")
             
-            # Останавливаем планировщик
-            from utils.scheduler import scheduler
-            scheduler.shutdown()
+            # Останавливаем планировщик и закрываем HTTP-клиенты
+            await stop_scheduler()
             
             logger.info("✅ Планировщик успешно остановлен")
             logger.info(f"📅 Время остановки: {datetime.now(moscow_tz).strftime('%d.%m.%Y %H:%M:%S')} (МСК)")
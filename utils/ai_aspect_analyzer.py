@@ -1,19 +1,44 @@
 import re
 import logging
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Callable, Set, Tuple
 import asyncio
+from collections import deque, defaultdict
+import math
 import httpx
-from openai import OpenAI
+from openai import (
+    AsyncOpenAI, APIError, APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+)
 import os
 from dotenv import load_dotenv
-from datetime import datetime, timedelta
+from datetime import datetime
 import time
 
+from config import settings
+from utils.http_clients import get_http_client
+from utils.aspect_analyzer import aspect_analyzer
+from utils.aspect_merger import AspectMerger
+from utils.json_salvage import salvage_json
+from utils.rate_limiter import retry_delay_from_headers
+
 # Загружаем переменные окружения
 load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+
+class AIUnavailableError(Exception):
+    """ИИ временно недоступен: исчерпаны лимиты ключей или все ключи ответили временной ошибкой"""
+
+
+def is_transient_ai_error(error: Exception) -> bool:
+    """Временная ошибка ИИ (лимит, таймаут, сеть, 5xx): повтор позже может пройти"""
+    if isinstance(error, (AIUnavailableError, RateLimitError, APITimeoutError, APIConnectionError,
+                          asyncio.TimeoutError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code >= 500
+
 class AIAspectAnalyzer:
     """Анализатор аспектов товаров с использованием ИИ через OpenRouter API с поддержкой динамических аспектов"""
     
@@ -34,23 +59,31 @@ class AIAspectAnalyzer:
             raise ValueError("Не найдены API ключи для OpenRouter")
         
         self.current_key_index = 0
-        self.client = None
+        # Таймаут httpx: read считается между чанками ответа, общий срок ограничивает asyncio.wait_for
+        self.timeout = httpx.Timeout(settings.AI_REQUEST_TIMEOUT_SECONDS, connect=settings.AI_CONNECT_TIMEOUT_SECONDS)
         
-        # Система контроля лимитов
-        self.request_timestamps = []  # Временные метки запросов для контроля минутных лимитов
+        # Система контроля лимитов: минутное окно и дневной счетчик у каждого ключа свои
+        self.request_timestamps = {i: deque() for i in range(len(self.api_keys))}  # Временные метки запросов по ключам
         self.daily_request_counts = {i: 0 for i in range(len(self.api_keys))}  # Счетчики дневных запросов по ключам
         self.last_request_dates = {i: None for i in range(len(self.api_keys))}  # Даты последних запросов по ключам
+        self.key_blocked_until = {i: 0.0 for i in range(len(self.api_keys))}  # Пауза ключа после 429
         
         # Лимиты API
-        self.MAX_REQUESTS_PER_MINUTE = 10  # Общий лимит запросов в минуту
-        self.MAX_REQUESTS_PER_DAY = 250     # Общий лимит запросов в день
+        self.MAX_REQUESTS_PER_MINUTE = 10  # Лимит запросов в минуту на ключ
+        self.MAX_REQUESTS_PER_DAY = 250     # Лимит запросов в день на ключ
         self.MINUTE_WINDOW = 60             # Окно в секундах для минутного лимита
         self.DAY_WINDOW = 86400             # Окно в секундах для дневного лимита
-        
-        # Константы для контроля размера промптов
-        self.MAX_REVIEWS_PER_PROMPT = 50  # Максимум отзывов в одном промпте (оптимизировано под лимиты API)
-        self.MAX_TOKENS_PER_REVIEW = 100   # Максимум токенов на отзыв
-        self.MAX_TOTAL_TOKENS = 6000       # Максимум токенов в промпте (увеличено под 50 отзывов)
+        self.KEY_COOLDOWN_SECONDS = 60      # Пауза ключа после 429 без Retry-After
+        self.MAX_CONCURRENT_PER_KEY = 2     # Одновременных запросов на ключ в analyze_batch
+        
+        # Константы для контроля размера промптов (токены оцениваются в _estimate_tokens)
+        self.MAX_TOKENS_PER_REVIEW = 300   # Максимум токенов на отзыв: более длинные отзывы обрезаются
+        self.MAX_TOTAL_TOKENS = 6000       # Максимум токенов в промпте вместе с инструкцией
+        self.RESPONSE_MAX_TOKENS = 6000    # max_tokens ответа модели
+        self.OUTPUT_TOKENS_PER_REVIEW = 90 # Оценка JSON ответа на один отзыв: ограничивает число отзывов в промпте
+        self.REVIEW_OVERHEAD_TOKENS = 4    # Номер отзыва и перенос строки
+        self.CHARS_PER_TOKEN = 2.5         # Кириллица в токенизаторах deepseek/qwen: ~2.5 символа на токен
+        self._packing_counters = defaultdict(int)
         
         # Доступные модели
         self.available_models = {
@@ -59,14 +92,20 @@ class AIAspectAnalyzer:
             "gemma": "google/gemma-7b-it"
         }
         
+        # Модель и версия промпта пакетного анализа; версия входит в ключ кеша результатов
+        # (crud/aspect_cache) - при изменении prompts["creative_batch_analysis"] ее нужно увеличить
+        self.BATCH_MODEL = "deepseek"
+        self.BATCH_PROMPT_VERSION = "batch-v2"
+        
         # Упрощенные промпты для стабильной работы
         self.prompts = {
-            "creative_batch_analysis": """Проанализируй до 30 отзывов и создай аспекты.
+            "creative_batch_analysis": """Проанализируй каждый отзыв из списка и создай аспекты.
 
 ПРАВИЛА:
 - Используй базовые аспекты: Цена, Качество, Эффективность, Упаковка, Запах
 - Создавай новые для уникальных случаев
 - Каждый аспект: название, тональность (positive/negative), уверенность (0.1-1.0), категория
+- review_index - номер отзыва в квадратных скобках
 - ВАЖНО: Всегда завершай JSON полностью, не обрезай ответ
 
 ФОРМАТ:
@@ -113,58 +152,57 @@ class AIAspectAnalyzer:
   }
 }```"""
         }
-        
-        self._init_client()
 
-    def _check_rate_limits(self) -> bool:
-        """Проверяет лимиты API и возвращает True если можно делать запрос"""
-        current_time = time.time()
-        
-        # Очищаем старые временные метки (старше 1 минуты)
-        self.request_timestamps = [ts for ts in self.request_timestamps 
-                                 if current_time - ts < self.MINUTE_WINDOW]
-        
-        # Проверяем минутный лимит
-        if len(self.request_timestamps) >= self.MAX_REQUESTS_PER_MINUTE:
-            logger.warning(f"Превышен минутный лимит: {len(self.request_timestamps)} запросов за минуту")
-            return False
-        
-        # Проверяем дневной лимит для текущего ключа
-        if self.daily_request_counts[self.current_key_index] >= self.MAX_REQUESTS_PER_DAY:
-            logger.warning(f"Превышен дневной лимит для ключа {self.current_key_index + 1}")
-            return False
-        
-        return True
-    
-    def _wait_for_rate_limit(self) -> float:
-        """Вычисляет время ожидания для соблюдения лимитов"""
-        current_time = time.time()
-        
-        # Ждем освобождения минутного слота
-        if len(self.request_timestamps) >= self.MAX_REQUESTS_PER_MINUTE:
-            oldest_request = min(self.request_timestamps)
-            wait_time = self.MINUTE_WINDOW - (current_time - oldest_request)
-            if wait_time > 0:
-                return wait_time
-        
-        # Ждем освобождения дневного слота
-        for i, daily_count in enumerate(self.daily_request_counts.items()):
-            if daily_count[1] >= self.MAX_REQUESTS_PER_DAY:
-                # Ждем до следующего дня
-                if self.last_request_dates[i]:
-                    next_day = self.last_request_dates[i] + timedelta(days=1)
-                    wait_time = (next_day - datetime.now()).total_seconds()
-                    if wait_time > 0:
-                        return wait_time
-        
-        return 0.0
+    def _minute_remaining(self, key_index: int, current_time: float) -> int:
+        """Свободные слоты ключа в текущем минутном окне"""
+        timestamps = self.request_timestamps[key_index]
+        while timestamps and current_time - timestamps[0] >= self.MINUTE_WINDOW:
+            timestamps.popleft()
+        return self.MAX_REQUESTS_PER_MINUTE - len(timestamps)
 
-    def _update_request_counters(self):
-        """Обновляет счетчики запросов"""
-        current_time = time.time()
-        self.request_timestamps.append(current_time)
-        self.daily_request_counts[self.current_key_index] += 1
-        self.last_request_dates[self.current_key_index] = datetime.now()
+    async def _acquire_key(self, exclude: Optional[Set[int]] = None) -> int:
+        """Выбирает ключ с наибольшим свободным бюджетом и сразу резервирует под него запрос.
+
+        Резервирование до await исключает гонку параллельных запросов за один слот.
+        Ключи из exclude (уже ошибившиеся в этом вызове) берутся только если других нет.
+        Если свободных слотов нет - ждет ближайшего; если исчерпан дневной лимит всех ключей - ошибка.
+        """
+        exclude = exclude or set()
+        while True:
+            self._reset_daily_counters_if_needed()
+            current_time = time.time()
+            candidates = []
+            wait_times = []
+            
+            for key_index in range(len(self.api_keys)):
+                daily_left = self.MAX_REQUESTS_PER_DAY - self.daily_request_counts[key_index]
+                if daily_left <= 0:
+                    continue
+                blocked_for = self.key_blocked_until[key_index] - current_time
+                if blocked_for > 0:
+                    wait_times.append(blocked_for)
+                    continue
+                minute_left = self._minute_remaining(key_index, current_time)
+                if minute_left <= 0:
+                    oldest_request = self.request_timestamps[key_index][0]
+                    wait_times.append(self.MINUTE_WINDOW - (current_time - oldest_request))
+                    continue
+                candidates.append((key_index in exclude, -min(minute_left, daily_left), key_index))
+            
+            if candidates:
+                key_index = min(candidates)[2]
+                self.request_timestamps[key_index].append(current_time)
+                self.daily_request_counts[key_index] += 1
+                self.last_request_dates[key_index] = datetime.now()
+                self.current_key_index = key_index
+                return key_index
+            
+            if not wait_times:
+                raise AIUnavailableError("Дневной лимит запросов исчерпан для всех API ключей")
+            
+            wait_time = max(min(wait_times), 0.05)
+            logger.info(f"Нет свободных слотов у ключей OpenRouter, ожидание {wait_time:.1f} сек")
+            await asyncio.sleep(wait_time)
 
     def _reset_daily_counters_if_needed(self):
         """Сбрасывает дневные счетчики если нужно"""
@@ -176,37 +214,95 @@ class AIAspectAnalyzer:
                 self.last_request_dates[key_index] = None
 
     def get_rate_limit_status(self) -> Dict:
-        """Возвращает текущий статус лимитов API"""
+        """Возвращает текущий статус лимитов API с остатком бюджета по каждому ключу и по пулу"""
+        self._reset_daily_counters_if_needed()
         current_time = time.time()
-        requests_last_minute = len([ts for ts in self.request_timestamps 
-                                  if current_time - ts < self.MINUTE_WINDOW])
+        keys = {}
+        
+        for key_index in range(len(self.api_keys)):
+            minute_left = max(self._minute_remaining(key_index, current_time), 0)
+            daily_left = max(self.MAX_REQUESTS_PER_DAY - self.daily_request_counts[key_index], 0)
+            keys[f"key_{key_index + 1}"] = {
+                "requests_last_minute": len(self.request_timestamps[key_index]),
+                "minute_remaining": min(minute_left, daily_left),
+                "daily_count": self.daily_request_counts[key_index],
+                "daily_remaining": daily_left,
+                "blocked_for_sec": round(max(self.key_blocked_until[key_index] - current_time, 0.0), 1)
+            }
         
         return {
             "current_key": self.current_key_index + 1,
-            "requests_last_minute": requests_last_minute,
-            "max_requests_per_minute": self.MAX_REQUESTS_PER_MINUTE,
-            "daily_counts": {f"key_{i+1}": count for i, count in enumerate(self.daily_request_counts)},
-            "max_requests_per_day": self.MAX_REQUESTS_PER_DAY
+            "keys_total": len(self.api_keys),
+            "requests_last_minute": sum(key["requests_last_minute"] for key in keys.values()),
+            "max_requests_per_minute": self.MAX_REQUESTS_PER_MINUTE * len(self.api_keys),
+            "minute_remaining": sum(key["minute_remaining"] for key in keys.values() if not key["blocked_for_sec"]),
+            "daily_counts": {name: key["daily_count"] for name, key in keys.items()},
+            "daily_remaining": sum(key["daily_remaining"] for key in keys.values()),
+            "max_requests_per_day": self.MAX_REQUESTS_PER_DAY * len(self.api_keys),
+            "keys": keys
         }
 
+    async def analyze_batch(self, reviews: List[str], product_name: str = "") -> List[Optional[Dict]]:
+        """Анализ отзывов батчами, параллельно по всем ключам пула.
+
+        Возвращает список той же длины, что и reviews: {"aspects": {...}}; None, если отзыва
+        в ответе нет или запрос батча завершился постоянной ошибкой (is_transient_ai_error);
+        {"error": "..."}, если ИИ временно недоступен (сеть, таймаут, 5xx, исчерпанные лимиты
+        ключей) - такой отзыв не расходует попытку.
+        """
+        if not reviews:
+            return []
+        
+        results: List[Optional[Dict]] = [None] * len(reviews)
+        # Параллельность растет с числом ключей; слоты минутного окна распределяет _acquire_key
+        semaphore = asyncio.Semaphore(len(self.api_keys) * self.MAX_CONCURRENT_PER_KEY)
+        
+        async def run_batch(batch: List[Tuple[int, str]]):
+            # Нумеруем отзывы, чтобы review_index в ответе однозначно указывал на отзыв батча
+            numbered = [f"[{i}] {text}" for i, (_, text) in enumerate(batch)]
+            async with semaphore:
+                try:
+                    batch_results = await self._analyze_batch_with_dynamic_aspects(numbered, product_name, len(batch))
+                except Exception as e:
+                    logger.error(f"Ошибка анализа батча из {len(batch)} отзывов (с {batch[0][0]}): {e}")
+                    if is_transient_ai_error(e):
+                        for index, _ in batch:
+                            results[index] = {"error": str(e)}
+                    return
+            recovered = set()
+            for item in batch_results:
+                if not isinstance(item, dict):
+                    continue
+                review_index = item.get("review_index")
+                if isinstance(review_index, int) and 0 <= review_index < len(batch):
+                    results[batch[review_index][0]] = {"aspects": item.get("aspects") or {}}
+                    recovered.add(review_index)
+            self._packing_counters["reviews_expected"] += len(batch)
+            self._packing_counters["reviews_recovered"] += len(recovered)
+        
+        await asyncio.gather(*(run_batch(batch) for batch in self._pack_reviews(reviews)))
+        
+        analyzed = sum(1 for result in results if result and "aspects" in result)
+        logger.info(f"Проанализировано ИИ {analyzed}/{len(reviews)} отзывов, статус лимитов: "
+                    f"осталось {self.get_rate_limit_status()['daily_remaining']} запросов на сегодня")
+        return results
+
     async def analyze_reviews(self, reviews: List[str], product_name: str = "") -> Dict[str, List[str]]:
         """Анализ отзывов и формирование словарей аспектов с помощью ИИ"""
         try:
             # Разбиваем отзывы на оптимальные батчи
             review_batches = self._split_reviews_into_batches(reviews)
             
-            all_aspects = []
-            for batch in review_batches:
-                # Формируем адаптивный словарь для батча
-                reviews_text = "\n".join(batch)
-                batch_aspects = await self._generate_adaptive_dictionary(reviews_text, product_name, len(batch))
-                all_aspects.extend(batch_aspects)
-            
-            # Убираем дубли из всех аспектов
-            no_duplicates_dict = await self._remove_duplicates_ai(all_aspects, product_name)
+            # Формируем адаптивные словари батчей параллельно по ключам пула
+            batch_aspects = await asyncio.gather(*(
+                self._generate_adaptive_dictionary("\n".join(batch), product_name, len(batch))
+                for batch in review_batches
+            ))
+            all_aspects = [aspect for aspects in batch_aspects for aspect in aspects]
             
-            # Убираем синонимы
-            no_synonyms_dict = await self._remove_synonyms_ai(no_duplicates_dict, product_name)
+            # Дубли и синонимы объединяются локально, без запросов к модели
+            no_duplicates_dict = self._remove_duplicates(all_aspects)
+            no_synonyms_dict = self._remove_synonyms(no_duplicates_dict)
             
             return {
                 "general_dictionary": all_aspects,
@@ -224,17 +320,15 @@ class AIAspectAnalyzer:
             if not reviews:
                 return []
             
-            # Разбиваем на батчи
-            total_batches = (len(reviews) + self.MAX_REVIEWS_PER_PROMPT - 1) // self.MAX_REVIEWS_PER_PROMPT
+            # Разбиваем на батчи по бюджету токенов
+            review_batches = self._split_reviews_into_batches(reviews)
+            total_batches = len(review_batches)
             
             all_results = []
             batch_count = 0
             start_time = time.time()
             
-            for i in range(0, len(reviews), self.MAX_REVIEWS_PER_PROMPT):
-                batch = reviews[i:i + self.MAX_REVIEWS_PER_PROMPT]
-                batch_index = i // self.MAX_REVIEWS_PER_PROMPT + 1
-                
+            for batch_index, batch in enumerate(review_batches, start=1):
                 # Проверяем лимиты
                 if batch_count >= max_batches_per_hour:
                     wait_time = 3600  # Ждем час
@@ -264,80 +358,39 @@ class AIAspectAnalyzer:
     async def analyze_single_review(self, review_text: str, rating: int) -> Dict[str, List[str]]:
         """Анализ одного отзыва для определения аспектов с тональностью с помощью ИИ"""
         try:
-            prompt = self.prompts["single_review_enhanced"].format(
-                review_text=review_text,
+            prompt = self._render_prompt(
+                "single_review_enhanced",
+                review_text=self._truncate_to_tokens(review_text, self.MAX_TOKENS_PER_REVIEW),
                 rating=rating
             )
             
             response = await self._call_ai_model(prompt, "deepseek")
             
-            # Парсим JSON ответ
-            try:
-                import json
-                import re
-                
-                # Убираем markdown блоки кода если они есть
-                cleaned_response = response.strip()
-                
-                # Ищем JSON внутри markdown блоков кода
-                json_match = re.search(r'```(?:json)?\s*(\{.*?\})\s*```', cleaned_response, re.DOTALL)
-                if json_match:
-                    json_str = json_match.group(1)
-                else:
-                    # Если нет markdown блоков, пробуем найти JSON напрямую
-                    json_match = re.search(r'\{.*\}', cleaned_response, re.DOTALL)
-                    if json_match:
-                        json_str = json_match.group(0)
-                    else:
-                        json_str = cleaned_response
-                
-                # Пытаемся исправить неполный JSON
-                if not json_str.endswith('}'):
-                    # Ищем последнюю закрывающую скобку
-                    last_brace = json_str.rfind('}')
-                    if last_brace > 0:
-                        json_str = json_str[:last_brace + 1]
-                    else:
-                        # Если нет закрывающей скобки, добавляем базовую структуру
-                        json_str = json_str.rstrip(', \n\r\t') + '}'
-                
-                # Парсим JSON
-                try:
-                    result = json.loads(json_str)
-                except json.JSONDecodeError:
-                    # Если не удалось, пробуем исправить более агрессивно
-                    logger.warning(f"Пытаемся исправить неполный JSON: {json_str[:100]}...")
-                    
-                    # Ищем поле "aspects" и создаем базовую структуру
-                    if '"aspects"' in json_str:
-                        # Создаем минимальный валидный JSON
-                        fixed_json = '{"aspects": {}}'
-                        result = json.loads(fixed_json)
-                    else:
-                        # Создаем пустой результат
-                        result = {"aspects": {}}
-                
-                aspects = result.get("aspects", {})
-                
-                # Преобразуем в старый формат для совместимости
-                positive_aspects = []
-                negative_aspects = []
-                
-                for aspect_name, aspect_data in aspects.items():
-                    sentiment = aspect_data.get("sentiment", "neutral")
-                    if sentiment == "positive":
-                        positive_aspects.append(aspect_name)
-                    elif sentiment == "negative":
-                        negative_aspects.append(aspect_name)
-                
-                return {
-                    "positive": positive_aspects[:3],
-                    "negative": negative_aspects[:3]
-                }
-            except json.JSONDecodeError as e:
+            # Из обрезанного ответа берем целые аспекты
+            result, complete = salvage_json(response, "{")
+            if not isinstance(result, dict):
                 logger.error(f"Не удалось распарсить JSON ответ: {response[:200]}...")
-                logger.error(f"Ошибка JSON: {e}")
                 return {"positive": [], "negative": []}
+            if not complete:
+                logger.warning(f"JSON ответа по одному отзыву обрезан: {response[:100]}...")
+            
+            aspects = result.get("aspects") or {}
+            
+            # Преобразуем в старый формат для совместимости
+            positive_aspects = []
+            negative_aspects = []
+            
+            for aspect_name, aspect_data in aspects.items():
+                sentiment = aspect_data.get("sentiment", "neutral") if isinstance(aspect_data, dict) else "neutral"
+                if sentiment == "positive":
+                    positive_aspects.append(aspect_name)
+                elif sentiment == "negative":
+                    negative_aspects.append(aspect_name)
+            
+            return {
+                "positive": positive_aspects[:3],
+                "negative": negative_aspects[:3]
+            }
                 
         except Exception as e:
             logger.error(f"Ошибка при анализе одного отзыва с ИИ: {e}")
@@ -349,118 +402,117 @@ class AIAspectAnalyzer:
             if not synonym_journal:
                 return aspects
             
-            return await self._remove_synonyms_ai(aspects, "", synonym_journal)
+            return self._remove_synonyms(aspects, synonym_journal)
         except Exception as e:
             logger.error(f"Ошибка при генерации кастомного словаря с ИИ: {e}")
             return aspects
 
     async def _generate_adaptive_dictionary(self, reviews_text: str, product_name: str, batch_size: int) -> List[str]:
         """Генерация адаптивного словаря аспектов"""
-        prompt = self.prompts["creative_batch_analysis"].format(
-            product_name=product_name or "товар",
-            reviews=reviews_text,
-            batch_size=batch_size
-        )
+        prompt = self._render_prompt("creative_batch_analysis", reviews_batch=reviews_text)
         
         response = await self._call_ai_model(prompt, "deepseek")
         return self._parse_aspects_response(response)
 
     async def _analyze_batch_with_dynamic_aspects(self, reviews: List[str], product_name: str, batch_size: int) -> List[Dict]:
         """Анализ батча с созданием динамических аспектов"""
-        prompt = self.prompts["creative_batch_analysis"].format(
-            product_name=product_name or "товар",
-            reviews_batch="\n".join(reviews),
-            batch_size=batch_size
-        )
+        prompt = self._render_prompt("creative_batch_analysis", reviews_batch="\n".join(reviews))
         
-        response = await self._call_ai_model(prompt, "deepseek")
+        response = await self._call_ai_model(prompt, self.BATCH_MODEL)
         return self._parse_dynamic_aspects_response(response)
 
-    async def _remove_duplicates_ai(self, aspects: List[str], product_name: str) -> List[str]:
-        """Удаление дублирующихся аспектов с помощью ИИ"""
-        if not aspects:
-            return []
-        
-        aspects_text = "\n".join(aspects)
-        prompt = f"""Убери дубликаты из списка аспектов для товара "{product_name}".
-        
-        Аспекты: {aspects_text}
-        
-        Верни только уникальные аспекты, разделенные переносами строк."""
-        
-        response = await self._call_ai_model(prompt, "deepseek")
-        return self._parse_aspects_response(response)
+    def _remove_duplicates(self, aspects: List[str]) -> List[str]:
+        """Удаление дублирующихся аспектов: словоформы и близкие названия (TF-IDF триграмм основ)"""
+        return AspectMerger(preferred=aspect_analyzer.standard_aspects).merge(aspects, use_journal=False)
 
-    async def _remove_synonyms_ai(self, aspects: List[str], product_name: str, synonym_journal: List[str] = None) -> List[str]:
-        """Удаление синонимов с помощью ИИ"""
-        if not aspects:
-            return []
-        
-        if not synonym_journal:
-            return aspects
-        
-        aspects_text = "\n".join(aspects)
-        journal_text = "\n".join(synonym_journal)
-        
-        prompt = f"""Убери синонимы из списка аспектов для товара "{product_name}".
-        
-        Журнал синонимов: {journal_text}
-        Аспекты: {aspects_text}
-        
-        Верни только уникальные аспекты без синонимов."""
-        
-        response = await self._call_ai_model(prompt, "deepseek")
-        return self._parse_aspects_response(response)
+    def _remove_synonyms(self, aspects: List[str], synonym_journal: List[str] = None) -> List[str]:
+        """Удаление синонимов по журналу (по умолчанию - стандартный журнал AspectAnalyzer)"""
+        journal = synonym_journal or aspect_analyzer.synonym_journal
+        return AspectMerger(journal, preferred=aspect_analyzer.standard_aspects).merge(aspects)
 
-    async def _call_ai_model(self, prompt: str, model_name: str = "deepseek") -> str:
-        """Вызов ИИ модели через OpenRouter API с умным контролем лимитов и ротацией ключей"""
+    async def _call_ai_model(self, prompt: str, model_name: str = "deepseek", stream: bool = False,
+                             on_chunk: Optional[Callable[[str], None]] = None) -> str:
+        """Вызов ИИ модели через OpenRouter API с умным контролем лимитов и ротацией ключей.
+
+        Запрос не блокирует event loop и ограничен AI_REQUEST_TIMEOUT_SECONDS; отмена вызывающей
+        корутины прерывает запрос и закрывает соединение. При stream=True (или заданном on_chunk)
+        ответ читается SSE-чанками, каждый фрагмент текста передаётся в on_chunk.
+        """
         max_retries = len(self.api_keys)
+        failed_keys: Set[int] = set()
         
         for attempt in range(max_retries):
+            key_index = await self._acquire_key(exclude=failed_keys)
             try:
-                # Сбрасываем дневные счетчики если нужно
-                self._reset_daily_counters_if_needed()
-                
-                # Проверяем лимиты перед запросом
-                if not self._check_rate_limits():
-                    wait_time = self._wait_for_rate_limit()
-                    if wait_time > 0:
-                        await asyncio.sleep(wait_time)
-                        continue
-                
-                # Проверяем лимиты еще раз после ожидания
-                if not self._check_rate_limits():
-                    continue
-                
                 model = self.available_models.get(model_name, self.available_models["deepseek"])
+                client = self._get_client(key_index)
                 
-                response = self.client.chat.completions.create(
-                    model=model,
-                    messages=[{"role": "user", "content": prompt}],
-                    max_tokens=6000,  # Увеличиваем для предотвращения обрезания JSON
-                    temperature=0.7
+                # wait_for вместо asyncio.timeout: сервер работает и на Python 3.10
+                content = await asyncio.wait_for(
+                    self._request_completion(client, model, prompt, stream, on_chunk),
+                    timeout=settings.AI_REQUEST_TIMEOUT_SECONDS
                 )
+                return content.strip()
                 
-                # Обновляем счетчики после успешного запроса
-                self._update_request_counters()
-                
-                return response.choices[0].message.content.strip()
+            except (APIError, asyncio.TimeoutError) as e:
+                # CancelledError и ошибки нашего кода сюда не попадают и пробрасываются вызывающему
+                logger.warning(f"Ошибка запроса к ИИ (ключ {key_index + 1}): {type(e).__name__}: {e}")
                 
-            except Exception as e:
-                error_msg = str(e).lower()
-                
-                # Проверяем тип ошибки для ротации ключа
-                if any(keyword in error_msg for keyword in ['rate limit', '429', 'quota', 'limit', 'token']):
-                    self._init_client()  # Ротация ключа
-                else:
-                    # Для других ошибок тоже пробуем следующий ключ
-                    self._init_client()
+                # При ошибке API (лимит, таймаут, сеть, 5xx) следующая попытка идет через другой ключ
+                failed_keys.add(key_index)
+                if isinstance(e, RateLimitError):
+                    cooldown = retry_delay_from_headers(e.response) or self.KEY_COOLDOWN_SECONDS
+                    self.key_blocked_until[key_index] = time.time() + cooldown
                 
                 if attempt == max_retries - 1:
-                    raise Exception(f"Все API ключи исчерпаны. Последняя ошибка: {e}")
+                    if not is_transient_ai_error(e):
+                        # Ошибка запроса (400, 401, 404...) - ИИ доступен, повторять её бессмысленно
+                        raise
+                    raise AIUnavailableError(f"Все API ключи исчерпаны. Последняя ошибка: {e}") from e
         
         raise Exception("Не удалось выполнить запрос после всех попыток")
 
+    async def _request_completion(self, client: AsyncOpenAI, model: str, prompt: str, stream: bool,
+                                  on_chunk: Optional[Callable[[str], None]] = None) -> str:
+        """Один запрос к модели без ротации ключей: обычный или потоковый ответ"""
+        if stream or on_chunk:
+            return await self._stream_completion(client, model, prompt, on_chunk)
+        response = await client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=self.RESPONSE_MAX_TOKENS,
+            temperature=0.7
+        )
+        if response.choices[0].finish_reason == "length":
+            self._record_truncated_response(model)
+        return response.choices[0].message.content or ""
+
+    async def _stream_completion(self, client: AsyncOpenAI, model: str, prompt: str,
+                                 on_chunk: Optional[Callable[[str], None]] = None) -> str:
+        """Читает потоковый ответ; соединение закрывается и при отмене/таймауте"""
+        response = await client.chat.completions.create(
+            model=model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=self.RESPONSE_MAX_TOKENS,
+            temperature=0.7,
+            stream=True
+        )
+        parts = []
+        try:
+            async for chunk in response:
+                if not chunk.choices:
+                    continue
+                if chunk.choices[0].finish_reason == "length":
+                    self._record_truncated_response(model)
+                text = chunk.choices[0].delta.content
+                if text:
+                    parts.append(text)
+                    if on_chunk:
+                        on_chunk(text)
+        finally:
+            await response.response.aclose()
+        return "".join(parts)
+
     def _parse_aspects_response(self, response: str) -> List[str]:
         """Парсинг ответа ИИ в список аспектов"""
         try:
@@ -492,119 +544,132 @@ class AIAspectAnalyzer:
             return []
 
     def _parse_dynamic_aspects_response(self, response: str) -> List[Dict]:
-        """Парсинг ответа ИИ с динамическими аспектами"""
-        try:
-            import json
-            import re
-            
-            # Убираем markdown блоки кода если они есть
-            cleaned_response = response.strip()
-            
-            # Ищем JSON внутри markdown блоков кода
-            json_match = re.search(r'```(?:json)?\s*(\[.*?\])\s*```', cleaned_response, re.DOTALL)
-            if json_match:
-                json_str = json_match.group(1)
-            else:
-                # Если нет markdown блоков, пробуем найти JSON напрямую
-                json_match = re.search(r'\[.*\]', cleaned_response, re.DOTALL)
-                if json_match:
-                    json_str = json_match.group(0)
-                else:
-                    # Пробуем найти начало JSON массива
-                    start_match = re.search(r'\[', cleaned_response)
-                    if start_match:
-                        # Берем все что есть после открывающей скобки
-                        json_str = cleaned_response[start_match.start():]
-                        # Пытаемся найти закрывающую скобку
-                        bracket_count = 0
-                        for i, char in enumerate(json_str):
-                            if char == '[':
-                                bracket_count += 1
-                            elif char == ']':
-                                bracket_count -= 1
-                                if bracket_count == 0:
-                                    json_str = json_str[:i+1]
-                                    break
-                    else:
-                        json_str = cleaned_response
-            
-            # Парсим JSON
-            try:
-                result = json.loads(json_str)
-                return result
-            except json.JSONDecodeError:
-                # Если не удалось распарсить, пробуем исправить обрезанный JSON
-                logger.warning("JSON обрезан, пытаемся исправить...")
-                fixed_json = self._fix_truncated_json(json_str)
-                if fixed_json:
-                    return json.loads(fixed_json)
-                else:
-                    raise json.JSONDecodeError("Не удалось исправить обрезанный JSON", json_str, 0)
-            
-        except json.JSONDecodeError as e:
-            logger.error(f"Не удалось распарсить JSON ответ с динамическими аспектами: {response[:500]}...")
-            logger.error(f"Ошибка JSON: {e}")
-            return []
-        except Exception as e:
-            logger.error(f"Ошибка при парсинге ответа с динамическими аспектами: {e}")
+        """Парсинг ответа ИИ с динамическими аспектами.
+
+        Из оборванного ответа извлекаются все целые объекты отзывов; отзывы, которых нет
+        в ответе, analyze_batch возвращает как None, и они уходят обратно в очередь.
+        """
+        # Массив отзывов - массив объектов: "[0]" из пояснений модели ответом не считается
+        result, complete = salvage_json(
+            response, "[", accept=lambda value: any(isinstance(item, dict) for item in value)
+        )
+        counters = self._packing_counters
+        if not isinstance(result, list) or not result:
+            counters["responses_unparsed"] += 1
+            logger.error(f"Не удалось извлечь JSON с динамическими аспектами: {(response or '')[:500]}...")
             return []
+        if complete:
+            counters["responses_complete"] += 1
+        else:
+            counters["responses_salvaged"] += 1
+            logger.warning(f"JSON ответа обрезан, восстановлено целых объектов: {len(result)}")
+        return result
 
-    def _fix_truncated_json(self, json_str: str) -> Optional[str]:
-        """Пытается исправить обрезанный JSON"""
-        try:
-            # Убираем лишние символы в конце
-            json_str = json_str.rstrip(', \n\r\t')
-            
-            # Если JSON обрывается на объекте, закрываем его
-            if json_str.endswith('"'):
-                json_str += '}'
-            elif json_str.endswith('"}'):
-                pass  # уже закрыт
-            elif json_str.endswith('"}}'):
-                pass  # уже закрыт
-            elif json_str.endswith('"}},'):
-                json_str = json_str.rstrip(',') + '}'
-            elif json_str.endswith('"}}'):
-                pass  # уже закрыт
-            else:
-                # Пытаемся найти последний полный объект
-                last_complete = re.search(r'\{[^{}]*"}[^{}]*$', json_str)
-                if last_complete:
-                    json_str = json_str[:last_complete.end()]
-            
-            # Закрываем массив если нужно
-            if not json_str.endswith(']'):
-                json_str += ']'
-            
-            # Проверяем валидность
-            json.loads(json_str)
-            return json_str
-            
-        except:
-            return None
+    def _render_prompt(self, name: str, **values) -> str:
+        """Подставляет значения в шаблон промпта.
 
-    def _split_reviews_into_batches(self, reviews: List[str]) -> List[List[str]]:
-        """Разбивает отзывы на батчи оптимального размера"""
-        if not reviews:
-            return []
+        str.format не подходит: в шаблонах есть фигурные скобки примеров JSON.
+        """
+        prompt = self.prompts[name]
+        for key, value in values.items():
+            prompt = prompt.replace("{" + key + "}", str(value))
+        return prompt
+
+    def _estimate_tokens(self, text: str) -> int:
+        """Грубая оценка числа токенов без токенизатора модели"""
+        return max(1, math.ceil(len(text or "") / self.CHARS_PER_TOKEN))
+
+    def _truncate_to_tokens(self, text: str, max_tokens: int) -> str:
+        """Обрезает текст до бюджета токенов по границе слова"""
+        max_chars = int(max_tokens * self.CHARS_PER_TOKEN)
+        if len(text or "") <= max_chars:
+            return text
+        cut = text[:max_chars - 1]
+        if " " in cut:
+            cut = cut.rsplit(" ", 1)[0]
+        return cut + "…"
+
+    def _pack_reviews(self, reviews: List[str]) -> List[List[Tuple[int, str]]]:
+        """Жадно заполняет промпты отзывами до бюджета токенов.
+
+        Бюджет входа - MAX_TOTAL_TOKENS минус инструкция, число отзывов ограничено объемом
+        ответа (RESPONSE_MAX_TOKENS / OUTPUT_TOKENS_PER_REVIEW), чтобы JSON не обрезался.
+        Отзывы длиннее MAX_TOKENS_PER_REVIEW обрезаются. Возвращает батчи пар (индекс отзыва, текст).
+        """
+        budget = self.MAX_TOTAL_TOKENS - self._estimate_tokens(self.prompts["creative_batch_analysis"])
+        max_count = max(1, self.RESPONSE_MAX_TOKENS // self.OUTPUT_TOKENS_PER_REVIEW)
+        counters = self._packing_counters
         
         batches = []
-        for i in range(0, len(reviews), self.MAX_REVIEWS_PER_PROMPT):
-            batch = reviews[i:i + self.MAX_REVIEWS_PER_PROMPT]
-            batches.append(batch)
-        
+        current = []
+        used = 0
+        for index, text in enumerate(reviews):
+            text = text or ""
+            tokens = self._estimate_tokens(text)
+            if tokens > self.MAX_TOKENS_PER_REVIEW:
+                text = self._truncate_to_tokens(text, self.MAX_TOKENS_PER_REVIEW)
+                counters["reviews_truncated"] += 1
+                counters["tokens_truncated"] += tokens - self.MAX_TOKENS_PER_REVIEW
+                tokens = self._estimate_tokens(text)
+            tokens += self.REVIEW_OVERHEAD_TOKENS
+            
+            if current and (used + tokens > budget or len(current) >= max_count):
+                counters["closed_by_tokens" if used + tokens > budget else "closed_by_count"] += 1
+                batches.append(current)
+                current = []
+                used = 0
+            current.append((index, text))
+            used += tokens
+            counters["tokens_packed"] += tokens
+        
+        if current:
+            batches.append(current)
+        counters["prompts"] += len(batches)
+        counters["reviews_packed"] += len(reviews)
+        counters["token_budget"] += budget * len(batches)
         return batches
 
-    def _init_client(self):
-        """Инициализирует клиент OpenRouter с ротацией ключей"""
-        # Переключаемся на следующий ключ
-        self.current_key_index = (self.current_key_index + 1) % len(self.api_keys)
-        
-        # Создаем новый клиент с текущим ключом
-        api_key = self.api_keys[self.current_key_index]
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=api_key
+    def _split_reviews_into_batches(self, reviews: List[str]) -> List[List[str]]:
+        """Разбивает отзывы на батчи оптимального размера"""
+        return [[text for _, text in batch] for batch in self._pack_reviews(reviews)]
+
+    def _record_truncated_response(self, model: str):
+        """Ответ оборван по max_tokens: промпт содержал больше отзывов, чем помещается в ответ"""
+        self._packing_counters["responses_truncated"] += 1
+        logger.warning(f"Ответ модели {model} обрезан по max_tokens={self.RESPONSE_MAX_TOKENS}")
+
+    def get_packing_stats(self) -> Dict[str, float]:
+        """Счетчики упаковки промптов: отзывов на промпт, заполнение бюджета, обрезания, восстановление ответов"""
+        counters = self._packing_counters
+        stats = {name: float(value) for name, value in counters.items()}
+        if counters["prompts"]:
+            stats["reviews_per_prompt"] = counters["reviews_packed"] / counters["prompts"]
+            stats["budget_fill"] = counters["tokens_packed"] / max(counters["token_budget"], 1)
+            stats["truncated_response_rate"] = counters["responses_truncated"] / counters["prompts"]
+        parsed = counters["responses_complete"] + counters["responses_salvaged"] + counters["responses_unparsed"]
+        if parsed:
+            # Доля ответов, из которых отзывы восстановлены разбором оборванного JSON, и потерянных целиком
+            stats["salvaged_response_rate"] = counters["responses_salvaged"] / parsed
+            stats["unparsed_response_rate"] = counters["responses_unparsed"] / parsed
+        if counters["reviews_expected"]:
+            stats["review_recovery_rate"] = counters["reviews_recovered"] / counters["reviews_expected"]
+        return stats
+
+    def get_batch_cache_signature(self) -> tuple:
+        """(версия промпта, идентификатор модели) пакетного анализа для ключа кеша"""
+        return self.BATCH_PROMPT_VERSION, self.available_models[self.BATCH_MODEL]
+
+    def _get_client(self, key_index: int) -> AsyncOpenAI:
+        """AsyncOpenAI для ключа пула поверх общего пула соединений к OpenRouter.
+
+        Повторы SDK отключены: при ошибке запрос повторяется через другой ключ в _call_ai_model.
+        """
+        return AsyncOpenAI(
+            base_url=OPENROUTER_BASE_URL,
+            api_key=self.api_keys[key_index],
+            http_client=get_http_client(OPENROUTER_BASE_URL),
+            timeout=self.timeout,
+            max_retries=0
         )
 
 # Создаем глобальный экземпляр ИИ-анализатора
@@ -1,9 +1,11 @@
 import re
 import logging
-from typing import List, Dict, Set
+from typing import List, Dict, Set, Optional
 from collections import Counter
 import asyncio
 
+from utils.aspect_merger import AspectMerger
+
 logger = logging.getLogger(__name__)
 
 class AspectAnalyzer:
@@ -63,6 +65,85 @@ class AspectAnalyzer:
             "раздражение", "побочные эффекты", "дорого", "переплата"
         ]
 
+    # Каскадная разметка (AspectProcessor): какие отзывы локальный анализатор размечает сам
+    SHORT_REVIEW_WORDS = 4          # Короткий отзыв без конкретики: "Отлично", "Всё супер"
+    SINGLE_ASPECT_MAX_WORDS = 25    # Длиннее - отзыв почти всегда про несколько аспектов
+    CONTRAST_MARKERS = {"но", "однако", "хотя", "зато", "правда", "только", "минус", "минусы"}
+    NEGATION_WORDS = {"не", "нет", "ни", "без"}
+
+    def triage_review(self, review_text: str, rating: int) -> Optional[Dict]:
+        """Локальная разметка отзыва, в которой анализатор уверен; None - отзыв нужно отдать ИИ.
+
+        Размечаются короткие отзывы без конкретики и короткие отзывы про один аспект, если
+        тональность текста не противоречит рейтингу. Средний рейтинг, противопоставления
+        ("но", "зато") и отрицания в положительном отзыве считаются неоднозначными.
+        Возвращает {"aspects": {...} в формате ИИ-анализа, "confidence": 0..1, "reason": str}.
+        """
+        text_lower = (review_text or "").lower().replace('ё', 'е')
+        words = re.findall(r'\w+', text_lower)
+        if not words:
+            return None
+        
+        if rating >= 4:
+            sentiment = "positive"
+        elif rating <= 2:
+            sentiment = "negative"
+        else:
+            return None
+        
+        if self.CONTRAST_MARKERS.intersection(words):
+            return None
+        if sentiment == "positive" and self.NEGATION_WORDS.intersection(words):
+            return None
+        
+        has_positive = any(indicator in text_lower for indicator in self.positive_indicators)
+        has_negative = any(indicator in text_lower for indicator in self.negative_indicators)
+        if (sentiment == "positive" and has_negative) or (sentiment == "negative" and has_positive):
+            return None
+        
+        # Ключевые слова ищем по началу слова, а не подстрокой ("мл" не должно находиться в "млн")
+        matched = {}
+        for aspect, keywords in self.aspect_keywords.items():
+            evidence = [
+                keyword for keyword in keywords
+                if (' ' in keyword and keyword in text_lower) or any(word.startswith(keyword) for word in words)
+            ]
+            if evidence:
+                matched[aspect] = evidence
+        
+        if len(matched) > 1:
+            return None
+        
+        indicator_agrees = has_positive if sentiment == "positive" else has_negative
+        if not matched:
+            if len(words) > self.SHORT_REVIEW_WORDS:
+                return None
+            # Общая оценка без конкретики - эмоция покупателя
+            aspect, evidence, reason = "Эмоция", [review_text.strip()[:100]], "short"
+            confidence = 0.8 + (0.1 if indicator_agrees else 0.0)
+        else:
+            if len(words) > self.SINGLE_ASPECT_MAX_WORDS:
+                return None
+            aspect, evidence = next(iter(matched.items()))
+            reason = "single_aspect"
+            if self._determine_aspect_sentiment(aspect, review_text, rating) != sentiment:
+                return None
+            confidence = 0.7 + (0.15 if indicator_agrees else 0.0) + (0.05 if len(words) <= self.SHORT_REVIEW_WORDS else 0.0)
+        
+        return {
+            "aspects": {
+                aspect: {
+                    "sentiment": sentiment,
+                    "confidence": round(confidence, 2),
+                    "evidence": evidence,
+                    "category": aspect,
+                    "is_new_aspect": False
+                }
+            },
+            "confidence": round(confidence, 2),
+            "reason": reason
+        }
+
     async def analyze_reviews(self, reviews: List[str], product_name: str = "") -> Dict[str, List[str]]:
         """Анализ отзывов и формирование словарей аспектов"""
         try:
@@ -194,86 +275,22 @@ class AspectAnalyzer:
         return unique_aspects[:30]  # Ограничиваем до 30 аспектов
 
     async def _remove_duplicates(self, aspects: List[str]) -> List[str]:
-        """Удаление дублирующихся и похожих аспектов"""
+        """Удаление дублирующихся и похожих аспектов (словоформы, перестановки слов)"""
         if not aspects:
             return []
-        
-        # Группируем похожие аспекты
-        aspect_groups = []
-        used_aspects = set()
-        
-        for aspect in aspects:
-            if aspect in used_aspects:
-                continue
-                
-            group = [aspect]
-            used_aspects.add(aspect)
-            
-            # Ищем похожие аспекты
-            for other_aspect in aspects:
-                if other_aspect not in used_aspects and self._are_aspects_similar(aspect, other_aspect):
-                    group.append(other_aspect)
-                    used_aspects.add(other_aspect)
-            
-            if group:
-                aspect_groups.append(group)
-        
-        # Выбираем лучший аспект из каждой группы
-        result = []
-        for group in aspect_groups:
-            best_aspect = self._select_best_aspect(group)
-            result.append(best_aspect)
-        
-        return result[:30]  # Ограничиваем до 30 аспектов
+        merger = AspectMerger(preferred=self.standard_aspects)
+        return merger.merge(aspects, use_journal=False)[:30]  # Ограничиваем до 30 аспектов
 
     async def _remove_synonyms(self, aspects: List[str]) -> List[str]:
         """Удаление синонимов на основе журнала синонимов"""
         if not aspects:
             return []
-        
-        # Создаем словарь замен
-        synonym_map = {}
-        for synonym_entry in self.synonym_journal:
-            parts = synonym_entry.split("=")
-            if len(parts) >= 2:
-                main_aspect = parts[0].strip()
-                for synonym in parts[1:]:
-                    synonym_map[synonym.strip()] = main_aspect
-        
-        # Заменяем синонимы
-        result = []
-        for aspect in aspects:
-            if aspect in synonym_map:
-                main_aspect = synonym_map[aspect]
-                if main_aspect not in result:
-                    result.append(main_aspect)
-            else:
-                result.append(aspect)
-        
-        return result[:30]  # Ограничиваем до 30 аспектов
+        merger = AspectMerger(self.synonym_journal, preferred=self.standard_aspects)
+        return merger.merge(aspects)[:30]  # Ограничиваем до 30 аспектов
 
     def _are_aspects_similar(self, aspect1: str, aspect2: str) -> bool:
         """Проверка схожести аспектов"""
-        # Простая проверка на основе общих слов
-        words1 = set(aspect1.lower().split())
-        words2 = set(aspect2.lower().split())
-        
-        # Если есть общие слова, считаем аспекты похожими
-        common_words = words1.intersection(words2)
-        return len(common_words) > 0
-
-    def _select_best_aspect(self, aspects: List[str]) -> str:
-        """Выбор лучшего аспекта из группы похожих"""
-        if not aspects:
-            return ""
-        
-        # Приоритет стандартным аспектам
-        for aspect in aspects:
-            if aspect in self.standard_aspects:
-                return aspect
-        
-        # Возвращаем первый аспект
-        return aspects[0]
+        return AspectMerger(self.synonym_journal).are_similar(aspect1, aspect2)
 
     async def generate_custom_dictionary(self, aspects: List[str], synonym_journal: List[str] = None) -> List[str]:
         """Генерация кастомного словаря аспектов"""
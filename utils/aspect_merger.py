@@ -0,0 +1,288 @@
+"""
+Локальное объединение дублей и синонимов в словарях аспектов.
+
+Вместо двух запросов к ИИ: названия аспектов сводятся к основам (стеммер Snowball для русского),
+сравниваются по TF-IDF символьных триграмм и правилам журнала синонимов ("А = Б = В"),
+похожие названия объединяются в кластеры через union-find. Работает в процессе на CPU.
+"""
+import math
+import re
+from collections import Counter, defaultdict
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+_VOWELS = set("аеиоуыэюя")
+_WORD_RE = re.compile(r'\w+')
+
+
+def _sorted_endings(*groups: Iterable[str]) -> Tuple[str, ...]:
+    return tuple(sorted({e for group in groups for e in group}, key=len, reverse=True))
+
+
+# Окончания алгоритма Snowball (Russian); группа 1 - только после "а"/"я"
+_GERUND_1 = ("в", "вши", "вшись")
+_GERUND_2 = ("ив", "ивши", "ившись", "ыв", "ывши", "ывшись")
+_ADJECTIVE = ("ее", "ие", "ые", "ое", "ими", "ыми", "ей", "ий", "ый", "ой", "ем", "им", "ым", "ом",
+              "его", "ого", "ему", "ому", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею")
+_PARTICIPLE_1 = ("ем", "нн", "вш", "ющ", "щ")
+_PARTICIPLE_2 = ("ивш", "ывш", "ующ")
+_REFLEXIVE = ("ся", "сь")
+_VERB_1 = ("ла", "на", "ете", "йте", "ли", "й", "л", "ем", "н", "ло", "но", "ет", "ют", "ны", "ть", "ешь", "нно")
+_VERB_2 = ("ила", "ыла", "ена", "ейте", "уйте", "ите", "или", "ыли", "ей", "уй", "ил", "ыл", "им", "ым", "ен",
+           "ило", "ыло", "ено", "ят", "ует", "уют", "ит", "ыт", "ены", "ить", "ыть", "ишь", "ую", "ю")
+_NOUN = ("а", "ев", "ов", "ие", "ье", "е", "иями", "ями", "ами", "еи", "ии", "и", "ией", "ей", "ой", "ий", "й",
+         "иям", "ям", "ием", "ем", "ам", "ом", "о", "у", "ах", "иях", "ях", "ы", "ь", "ию", "ью", "ю", "ия", "ья", "я")
+
+_GERUND = _sorted_endings(_GERUND_1, _GERUND_2)
+_ADJECTIVE_ENDINGS = _sorted_endings(_ADJECTIVE)
+_PARTICIPLE = _sorted_endings(_PARTICIPLE_1, _PARTICIPLE_2)
+_REFLEXIVE_ENDINGS = _sorted_endings(_REFLEXIVE)
+_VERB = _sorted_endings(_VERB_1, _VERB_2)
+_NOUN_ENDINGS = _sorted_endings(_NOUN)
+# Остатки, которыми основы одного слова могут различаться (см. AspectMerger._canonical_stems)
+_INFLECTION_REMAINDERS = frozenset(_NOUN) | {""}
+
+
+def _regions(word: str) -> Tuple[int, int]:
+    """Начала областей RV и R2 алгоритма Snowball"""
+    rv = r1 = r2 = len(word)
+    for i, ch in enumerate(word):
+        if ch in _VOWELS:
+            rv = i + 1
+            break
+    for i in range(1, len(word)):
+        if word[i - 1] in _VOWELS and word[i] not in _VOWELS:
+            r1 = i + 1
+            break
+    for i in range(r1 + 1, len(word)):
+        if word[i - 1] in _VOWELS and word[i] not in _VOWELS:
+            r2 = i + 1
+            break
+    return rv, r2
+
+
+def _cut(word: str, start: int, endings: Tuple[str, ...], after_a: Iterable[str] = ()) -> Tuple[str, bool]:
+    """Удаляет самое длинное окончание внутри области start; окончания из after_a - только после "а"/"я" """
+    for ending in endings:
+        if word.endswith(ending) and len(word) - len(ending) >= start:
+            if ending in after_a:
+                pos = len(word) - len(ending) - 1
+                if pos < start or word[pos] not in "ая":
+                    return word, False
+            return word[:-len(ending)], True
+    return word, False
+
+
+@lru_cache(maxsize=65536)
+def stem_russian(word: str) -> str:
+    """Основа русского слова (Snowball Russian); слова без гласных возвращаются как есть"""
+    word = word.lower().replace('ё', 'е')
+    rv, r2 = _regions(word)
+
+    # Шаг 1: деепричастие, иначе возвратность + прилагательное/причастие, глагол или существительное
+    word, found = _cut(word, rv, _GERUND, _GERUND_1)
+    if not found:
+        word, _ = _cut(word, rv, _REFLEXIVE_ENDINGS)
+        word, found = _cut(word, rv, _ADJECTIVE_ENDINGS)
+        if found:
+            word, _ = _cut(word, rv, _PARTICIPLE, _PARTICIPLE_1)
+        else:
+            word, found = _cut(word, rv, _VERB, _VERB_1)
+            if not found:
+                word, _ = _cut(word, rv, _NOUN_ENDINGS)
+
+    # Шаги 2-4: "и", словообразовательное "ость", превосходная степень, "нн", "ь"
+    word, _ = _cut(word, rv, ("и",))
+    word, _ = _cut(word, r2, ("ость", "ост"))
+    if word.endswith("нн") and len(word) - 2 >= rv:
+        return word[:-1]
+    word, found = _cut(word, rv, ("ейше", "ейш"))
+    if found:
+        return word[:-1] if word.endswith("нн") else word
+    word, _ = _cut(word, rv, ("ь",))
+    return word
+
+
+class _UnionFind:
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+
+    def find(self, i: int) -> int:
+        while self.parent[i] != i:
+            self.parent[i] = self.parent[self.parent[i]]
+            i = self.parent[i]
+        return i
+
+    def union(self, a: int, b: int) -> None:
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            # Корень - меньший индекс: кластер остается на месте первого вхождения
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+
+class AspectMerger:
+    """Объединение дублей и синонимов аспектов: основы слов + TF-IDF триграмм + журнал синонимов.
+
+    Представитель кластера: главный аспект строки журнала, затем предпочтительный
+    (базовый) аспект, затем самый частый во входном списке, затем встретившийся первым.
+    """
+
+    SIMILARITY_THRESHOLD = 0.8  # Косинус TF-IDF триграмм, начиная с которого названия - дубли
+    NGRAM = 3
+    MIN_STEM_LENGTH = 3         # Основы короче не склеиваются по префиксу
+    MAX_INFLECTION_LENGTH = 2   # "зап" и "запах": Snowball по-разному режет формы одного слова
+
+    def __init__(self, synonym_journal: Optional[List[str]] = None, preferred: Optional[Iterable[str]] = None,
+                 threshold: Optional[float] = None):
+        self.threshold = self.SIMILARITY_THRESHOLD if threshold is None else threshold
+        self.preferred = list(preferred or [])
+        # (номер строки журнала, главный аспект строки, название)
+        self.journal: List[Tuple[int, str, str]] = []
+        for line_no, line in enumerate(synonym_journal or []):
+            parts = [part.strip() for part in line.split("=") if part.strip()]
+            if len(parts) >= 2:
+                self.journal.extend((line_no, parts[0], part) for part in parts)
+
+    @staticmethod
+    def stems(name: str) -> List[str]:
+        return [stem_russian(word) for word in _WORD_RE.findall(name.lower())]
+
+    def _canonical_stems(self, cut_endings: Dict[str, Set[str]]) -> Dict[str, str]:
+        """Основа -> самая короткая основа словаря, отличающаяся от нее окончанием-остатком.
+
+        cut_endings: основа -> что Snowball срезал со слов, давших эту основу.
+        Склеиваются только формы одного существительного, которые Snowball режет по-разному
+        ("запах" -> "зап", "запахи" -> "запах"): остаток - падежное окончание, а со слов длинной
+        основы срезано только падежное окончание. Иначе это другое слово: "рукав" -> "рука"
+        (срезано "в") и "рука" -> "рук", "ножки" -> "ножк" (остаток "к") и "нож".
+        """
+        canonical = {}
+        for stem in sorted(cut_endings, key=len):
+            target = stem
+            if cut_endings[stem] <= _INFLECTION_REMAINDERS:
+                for cut in range(self.MAX_INFLECTION_LENGTH, 0, -1):
+                    prefix = stem[:-cut]
+                    if (len(prefix) >= self.MIN_STEM_LENGTH and prefix in cut_endings
+                            and stem[-cut:] in _INFLECTION_REMAINDERS):
+                        target = canonical[prefix]
+                        break
+            canonical[stem] = target
+        return canonical
+
+    def _context(self, names: List[str]):
+        """Подписи названий с учетом словоформ входного списка, журнала и предпочтительных аспектов"""
+        stems = {}
+        cut_endings: Dict[str, Set[str]] = defaultdict(set)
+        for name in [*names, *self.preferred, *(entry[2] for entry in self.journal)]:
+            words = _WORD_RE.findall(name.lower().replace('ё', 'е'))
+            stems[name] = [stem_russian(word) for word in words]
+            for word, stem in zip(words, stems[name]):
+                cut_endings[stem].add(word[len(stem):])
+        canonical = self._canonical_stems(cut_endings)
+        signatures = {name: " ".join(sorted(canonical[stem] for stem in name_stems)) for name, name_stems in stems.items()}
+        journal = {}
+        for line_no, head, name in self.journal:
+            journal.setdefault(signatures[name], (line_no, head))
+        preferred = {signatures[name] for name in self.preferred}
+        return signatures, journal, preferred
+
+    def _similar_pairs(self, documents: List[str]) -> Iterable[Tuple[int, int]]:
+        """Пары документов с косинусом TF-IDF триграмм не ниже порога.
+
+        Префиксная фильтрация: косинус >= порога возможен, только если у пары есть общая
+        триграмма среди самых редких триграмм документа (норма остальных меньше порога).
+        """
+        counts = [
+            Counter(text[i:i + self.NGRAM] for i in range(max(len(text) - self.NGRAM + 1, 1)))
+            for text in (f" {document} " for document in documents)
+        ]
+        document_frequency = Counter(gram for grams in counts for gram in grams)
+        total = len(documents)
+        vectors = []
+        postings: Dict[str, List[int]] = defaultdict(list)
+        for index, grams in enumerate(counts):
+            vector = {
+                gram: tf * (math.log((1 + total) / (1 + document_frequency[gram])) + 1.0)
+                for gram, tf in grams.items()
+            }
+            norm = math.sqrt(sum(weight * weight for weight in vector.values())) or 1.0
+            vectors.append({gram: weight / norm for gram, weight in vector.items()})
+            for gram in vector:
+                postings[gram].append(index)
+
+        threshold_sq = self.threshold * self.threshold
+        for i, vector in enumerate(vectors):
+            rest = 1.0
+            candidates = set()
+            for gram in sorted(vector, key=lambda g: (document_frequency[g], g)):
+                if rest < threshold_sq:
+                    break
+                candidates.update(j for j in postings[gram] if j > i)
+                rest -= vector[gram] * vector[gram]
+            for j in candidates:
+                other = vectors[j]
+                if sum(weight * other.get(gram, 0.0) for gram, weight in vector.items()) >= self.threshold:
+                    yield i, j
+
+    def cluster(self, aspects: List[str], use_journal: bool = True) -> List[List[str]]:
+        """Кластеры похожих аспектов в порядке первого вхождения (повторы названий схлопываются)"""
+        return self._cluster(aspects, use_journal)[0]
+
+    def _cluster(self, aspects: List[str], use_journal: bool):
+        names = list(dict.fromkeys(name.strip() for name in aspects if name and name.strip()))
+        if not names:
+            return [], None
+        context = self._context(names)
+        signatures, journal, _ = context
+        union_find = _UnionFind(len(names))
+
+        by_key: Dict[Tuple, int] = {}
+        for index, name in enumerate(names):
+            keys = [("signature", signatures[name])]
+            if use_journal and signatures[name] in journal:
+                keys.append(("journal", journal[signatures[name]][0]))
+            for key in keys:
+                if key in by_key:
+                    union_find.union(by_key[key], index)
+                else:
+                    by_key[key] = index
+
+        for i, j in self._similar_pairs([signatures[name] for name in names]):
+            union_find.union(i, j)
+
+        clusters: Dict[int, List[str]] = defaultdict(list)
+        for index, name in enumerate(names):
+            clusters[union_find.find(index)].append(name)
+        return [clusters[root] for root in sorted(clusters)], context
+
+    def merge(self, aspects: List[str], use_journal: bool = True) -> List[str]:
+        """Список аспектов без дублей (и синонимов журнала при use_journal)"""
+        clusters, context = self._cluster(aspects, use_journal)
+        if not clusters:
+            return []
+        signatures, journal, preferred = context
+        frequency = Counter(name.strip() for name in aspects if name)
+
+        merged = []
+        for cluster in clusters:
+            heads = [journal[signatures[name]][1] for name in cluster if use_journal and signatures[name] in journal]
+            if heads:
+                name = heads[0]
+            else:
+                name = next((name for name in cluster if signatures[name] in preferred), None)
+                name = name or max(cluster, key=lambda candidate: frequency[candidate])
+            if name not in merged:
+                merged.append(name)
+        return merged
+
+    def are_similar(self, aspect1: str, aspect2: str, use_journal: bool = True) -> bool:
+        """Одинаковый ли это аспект.
+
+        >>> merger = AspectMerger()
+        >>> merger.are_similar("Запах", "Запахи"), merger.are_similar("Цена", "цены")
+        (True, True)
+        >>> [merger.are_similar(a, b) for a, b in [("Нож", "Ножки"), ("Рука", "Рукав"), ("Пол", "Полка"),
+        ...                                        ("Бок", "Бокал"), ("Кол", "Колесо")]]
+        [False, False, False, False, False]
+        """
+        return len(self.cluster([aspect1, aspect2], use_journal=use_journal)) == 1
@@ -2,18 +2,59 @@ import logging
 from typing import List, Dict, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update, func
+from sqlalchemy.exc import InterfaceError, OperationalError
 from models.feedback import Feedback
-from models.aspect import Aspect, FeedbackAspect
+from models.aspect import Aspect
 from utils.ai_aspect_analyzer import ai_aspect_analyzer
+from crud.aspect_registry import AspectRegistry
+from crud.aspect_cache import make_cache_key, get_cached_analyses, store_analyses
+from crud.aspect_queue import (
+    claim_feedbacks_for_aspects, release_feedbacks,
+    ASPECT_STATUS_PENDING, ASPECT_STATUS_DONE, ASPECT_STATUS_FAILED, ASPECT_STATUS_SKIPPED
+)
+from utils.aspect_analyzer import aspect_analyzer
+from config import settings
+from collections import defaultdict
 import json
+import random
 
 logger = logging.getLogger(__name__)
 
+# aspect_prompt_version отзывов, размеченных локальным анализатором (каскад)
+LOCAL_PROMPT_VERSION = "local"
+
+# Счетчики конвейера анализа аспектов текущего процесса (см. get_aspect_pipeline_stats)
+_pipeline_counters: Dict[str, int] = defaultdict(int)
+
+
+def get_aspect_pipeline_stats() -> Dict[str, float]:
+    """Счетчики и доли этапов каскада: кеш, локальная разметка, ИИ, согласие локальной разметки с ИИ"""
+    stats = {name: float(value) for name, value in _pipeline_counters.items()}
+    reviews = _pipeline_counters["reviews"]
+    checked = _pipeline_counters["triage_checked"]
+    compared = _pipeline_counters["audit_compared"]
+    if reviews:
+        stats["cache_hit_rate"] = _pipeline_counters["cache_hits"] / reviews
+        stats["llm_rate"] = _pipeline_counters["llm_sent"] / reviews
+    if checked:
+        stats["triage_hit_rate"] = _pipeline_counters["triage_labeled"] / checked
+    if compared:
+        stats["audit_aspect_agreement"] = _pipeline_counters["audit_aspect_match"] / compared
+        stats["audit_sentiment_agreement"] = _pipeline_counters["audit_sentiment_match"] / compared
+    if ai_aspect_analyzer:
+        stats.update({f"packing_{name}": value for name, value in ai_aspect_analyzer.get_packing_stats().items()})
+    return stats
+
+
 class AspectProcessor:
     """Обработчик аспектов для отзывов"""
     
-    def __init__(self, db_session: AsyncSession):
+    def __init__(self, db_session: AsyncSession, cascade: Optional[bool] = None):
         self.db = db_session
+        # Каскадный режим: локальный AspectAnalyzer перед ИИ (по умолчанию из настроек)
+        self.cascade = settings.ASPECT_TRIAGE_ENABLED if cascade is None else cascade
+        # Справочник аспектов загружается один раз на прогон
+        self.registry = AspectRegistry()
     
     async def process_feedbacks_batch(self, feedbacks: List[Feedback], product_name: str = "") -> Dict:
         """Обрабатывает батч отзывов и создает аспекты"""
@@ -21,6 +62,9 @@ class AspectProcessor:
         if not feedbacks:
             return {"processed": 0, "new_aspects": 0, "errors": []}
         
+        # После rollback атрибуты ORM недоступны - id нужны для возврата отзывов в очередь
+        feedback_ids = [feedback.id for feedback in feedbacks]
+        
         try:
             # Фильтруем отзывы - оставляем только те, где есть текст для анализа
             # И НЕ анализируем уже проанализированные отзывы
@@ -56,6 +100,7 @@ class AspectProcessor:
                                 has_real_aspects = bool(feedback.aspects.strip())
                         
                         if has_real_aspects:
+                            feedback.aspect_status = ASPECT_STATUS_DONE
                             skipped_already_analyzed += 1
                             continue
                 
@@ -71,8 +116,11 @@ class AspectProcessor:
                 
                 if has_text:
                     feedbacks_with_text.append(feedback)
+                else:
+                    feedback.aspect_status = ASPECT_STATUS_SKIPPED
             
             if not feedbacks_with_text:
+                await self.db.commit()
                 return {
                     "processed": 0, 
                     "new_aspects": 0, 
@@ -100,105 +148,206 @@ class AspectProcessor:
                 else:
                     reviews_texts.append("")
             
-            # 2. Анализируем тексты через ИИ
-            logger.info(f"Анализируем {len(reviews_texts)} отзывов через ИИ...")
-            analysis_results = await ai_aspect_analyzer.analyze_batch(reviews_texts)
+            # 2. Берем готовые результаты из кеша, одинаковые тексты анализируем один раз
+            prompt_version, model = ai_aspect_analyzer.get_batch_cache_signature()
+            cache_keys = [
+                make_cache_key(text, feedback.rating, prompt_version, model)
+                for feedback, text in zip(feedbacks_with_text, reviews_texts)
+            ]
+            cached = await get_cached_analyses(self.db, cache_keys)
+            cache_hits = sum(1 for cache_key in cache_keys if cache_key in cached)
             
-            if not analysis_results:
-                return {
-                    "processed": 0, 
-                    "new_aspects": 0, 
-                    "errors": ["Ошибка анализа через ИИ"]
-                }
+            uncached = {}
+            for cache_key, feedback, text in zip(cache_keys, feedbacks_with_text, reviews_texts):
+                if cache_key not in cached and cache_key not in uncached:
+                    uncached[cache_key] = (text, feedback.rating)
+            
+            # 3. Каскад: уверенные отзывы размечает локальный анализатор, в ИИ уходит остаток
+            local, audited = self._triage(uncached)
+            llm_texts = {
+                cache_key: text for cache_key, (text, rating) in uncached.items()
+                if cache_key not in local or cache_key in audited
+            }
+            
+            fresh = {}
+            # Тексты, батч которых упал на временной ошибке ИИ: отзывы вернутся в очередь без траты попытки
+            unavailable = set()
+            if llm_texts:
+                logger.info(
+                    f"Анализируем {len(llm_texts)} уникальных текстов через ИИ "
+                    f"(из кеша: {cache_hits}, локально: {len(local) - len(audited)}, отзывов: {len(reviews_texts)})"
+                )
+                llm_results = await ai_aspect_analyzer.analyze_batch(list(llm_texts.values()))
+                if not llm_results:
+                    return {
+                        "processed": 0, 
+                        "new_aspects": 0, 
+                        "errors": ["Ошибка анализа через ИИ"]
+                    }
+                for cache_key, llm_result in zip(llm_texts, llm_results):
+                    if llm_result and "aspects" in llm_result:
+                        fresh[cache_key] = llm_result["aspects"]
+                    elif llm_result and "error" in llm_result:
+                        unavailable.add(cache_key)
+                # Неудавшиеся анализы не кешируем: отзыв будет проанализирован повторно
+                await store_analyses(self.db, fresh, prompt_version, model)
+                self._record_audit(local, audited, fresh)
+            
+            analysis_results = []
+            for cache_key in cache_keys:
+                if cache_key in cached or cache_key in fresh:
+                    aspects = cached.get(cache_key, fresh.get(cache_key))
+                    analysis_results.append({"aspects": aspects, "prompt_version": prompt_version})
+                elif cache_key in local:
+                    analysis_results.append({"aspects": local[cache_key], "prompt_version": LOCAL_PROMPT_VERSION})
+                elif cache_key in unavailable:
+                    analysis_results.append({"error": "ИИ недоступен"})
+                else:
+                    analysis_results.append(None)
             
-            # 3. Обрабатываем результаты анализа
+            cache_stats = {
+                "cache_hits": cache_hits,
+                "deduplicated": len(cache_keys) - cache_hits - len(uncached),
+                "triage_labeled": len(local) - len(audited),
+                "llm_reviews": len(llm_texts)
+            }
+            _pipeline_counters["reviews"] += len(cache_keys)
+            _pipeline_counters["cache_hits"] += cache_hits
+            _pipeline_counters["deduplicated"] += cache_stats["deduplicated"]
+            _pipeline_counters["llm_sent"] += len(llm_texts)
+            
+            # 4. Обрабатываем результаты анализа
             processed_count = 0
             new_aspects_count = 0
+            requeued_count = 0
+            released_count = 0
+            failed_count = 0
             errors = []
             
+            await self.registry.load(self.db)
+            
             for i, (feedback, analysis_result) in enumerate(zip(feedbacks_with_text, analysis_results)):
                 try:
                     if analysis_result and "aspects" in analysis_result:
+                        # Связи проверяются до записи: некорректный аспект не попадает в буфер
+                        links = [
+                            self.registry.build_link(feedback.id, aspect_name, aspect_data)
+                            for aspect_name, aspect_data in analysis_result["aspects"].items()
+                        ]
+                        
                         # Сохраняем аспекты в отзыв
                         feedback.aspects = analysis_result["aspects"]
+                        feedback.aspect_status = ASPECT_STATUS_DONE
+                        feedback.aspect_prompt_version = analysis_result["prompt_version"]
                         
-                        # Создаем новые аспекты в базе
+                        # Счетчики аспектов и связи копятся в справочнике и пишутся одним запросом
                         for aspect_name, aspect_data in analysis_result["aspects"].items():
-                            await self._create_or_update_aspect(aspect_name, aspect_data)
-                            await self._save_feedback_aspect_relation(feedback.id, aspect_name, aspect_data)
+                            self.registry.add_usage(aspect_name, aspect_data)
+                        self.registry.add_links(links)
                         
                         processed_count += 1
                         new_aspects_count += len(analysis_result["aspects"])
                         
                         logger.info(f"Обработан отзыв {feedback.id}: {len(analysis_result['aspects'])} аспектов")
+                    elif analysis_result and "error" in analysis_result:
+                        self._release(feedback)
+                        released_count += 1
+                    elif self._requeue(feedback):
+                        requeued_count += 1
                     else:
-                        # Если анализ не удался, помечаем как пустой массив
+                        # Попытки исчерпаны: помечаем как пустой массив
                         feedback.aspects = []
-                        processed_count += 1
+                        failed_count += 1
                         
                 except Exception as e:
                     error_msg = f"Ошибка при обработке отзыва {feedback.id}: {str(e)}"
                     logger.error(error_msg)
                     errors.append(error_msg)
+                    if not self._requeue(feedback):
+                        failed_count += 1
             
-            # 4. Сохраняем изменения в БД
+            # 5. Сохраняем изменения в БД
+            await self.registry.flush(self.db)
             await self.db.commit()
             
-            logger.info(f"Обработано отзывов: {processed_count}, новых аспектов: {new_aspects_count}")
+            logger.info(f"Обработано отзывов: {processed_count}, новых аспектов: {new_aspects_count}, кеш: {cache_stats}")
             
             return {
                 "processed": processed_count,
                 "new_aspects": new_aspects_count,
                 "errors": errors,
-                "skipped_already_analyzed": skipped_already_analyzed
+                "skipped_already_analyzed": skipped_already_analyzed,
+                "requeued": requeued_count,
+                "released": released_count,
+                "failed": failed_count,
+                **cache_stats
             }
             
         except Exception as e:
             logger.error(f"Ошибка при обработке батча отзывов: {e}")
             await self.db.rollback()
+            # Несохраненные счетчики и связи относятся к откаченной транзакции
+            self.registry = AspectRegistry()
+            # Попытку возвращаем только при сбое соединения с БД: ошибка в данных отзыва
+            # повторялась бы на каждом проходе, и отзывы в голове очереди не давали бы ей двигаться
+            await release_feedbacks(
+                self.db, feedback_ids, refund_attempt=isinstance(e, (OperationalError, InterfaceError))
+            )
             raise
     
-    async def _create_or_update_aspect(self, name: str, aspect_data: Dict) -> Aspect:
-        """Создает новый аспект или обновляет существующий"""
-        
-        # Проверяем, существует ли уже аспект
-        existing_query = select(Aspect).where(Aspect.name == name)
-        existing_result = await self.db.execute(existing_query)
-        existing_aspect = existing_result.scalars().first()
-        
-        if existing_aspect:
-            # Обновляем существующий аспект
-            existing_aspect.usage_count += 1
-            existing_aspect.description = aspect_data.get("description", existing_aspect.description)
-            return existing_aspect
-        
-        # Создаем новый аспект
-        new_aspect = Aspect(
-            name=name,
-            category=aspect_data.get("category", "Общие"),
-            description=aspect_data.get("description", ""),
-            is_base_aspect=False,
-            is_new_aspect=aspect_data.get("is_new_aspect", False),
-            usage_count=1
-        )
-        
-        self.db.add(new_aspect)
-        logger.info(f"Создан новый аспект: {name} в категории {aspect_data.get('category', 'Общие')}")
-        return new_aspect
+    def _requeue(self, feedback: Feedback) -> bool:
+        """Возвращает в очередь отзыв, которого нет в ответе модели; False - попытки исчерпаны, отзыв помечен failed"""
+        feedback.aspect_claimed_at = None
+        if (feedback.aspect_attempts or 0) >= settings.ASPECT_MAX_ATTEMPTS:
+            feedback.aspect_status = ASPECT_STATUS_FAILED
+            return False
+        feedback.aspect_status = ASPECT_STATUS_PENDING
+        return True
     
-    async def _save_feedback_aspect_relation(self, feedback_id: int, aspect_name: str, aspect_data: Dict):
-        """Сохраняет связь аспекта с отзывом"""
+    def _release(self, feedback: Feedback):
+        """Возвращает отзыв в очередь без траты попытки: ИИ временно недоступен (сеть, таймаут, 5xx, лимиты ключей)"""
+        feedback.aspect_claimed_at = None
+        feedback.aspect_status = ASPECT_STATUS_PENDING
+        # Попытку засчитал claim_feedbacks_for_aspects - возвращаем её
+        feedback.aspect_attempts = max((feedback.aspect_attempts or 1) - 1, 0)
+    
+    def _triage(self, uncached: Dict[str, tuple]) -> tuple:
+        """Локальная разметка уникальных текстов: (cache_key -> аспекты, ключи для проверки через ИИ)"""
+        local = {}
+        audited = set()
+        if not self.cascade:
+            return local, audited
         
-        # Создаем связь в таблице feedback_aspects
-        relation = FeedbackAspect(
-            feedback_id=feedback_id,
-            aspect_name=aspect_name,
-            sentiment=aspect_data["sentiment"],
-            confidence=int(aspect_data["confidence"] * 100),  # Конвертируем в 0-100
-            evidence_words=json.dumps(aspect_data["evidence"], ensure_ascii=False)
-        )
+        for cache_key, (text, rating) in uncached.items():
+            triage = aspect_analyzer.triage_review(text, rating)
+            _pipeline_counters["triage_checked"] += 1
+            if not triage or triage["confidence"] < settings.ASPECT_TRIAGE_MIN_CONFIDENCE:
+                continue
+            local[cache_key] = triage["aspects"]
+            _pipeline_counters[f"triage_{triage['reason']}"] += 1
+            # Часть уверенных отзывов всё равно уходит в ИИ: по ним считается согласие каскада
+            if random.random() < settings.ASPECT_TRIAGE_AUDIT_RATE:
+                audited.add(cache_key)
         
-        self.db.add(relation)
+        _pipeline_counters["triage_labeled"] += len(local) - len(audited)
+        return local, audited
+    
+    def _record_audit(self, local: Dict[str, Dict], audited: set, fresh: Dict[str, Dict]):
+        """Сравнивает локальную разметку с ответом ИИ: совпадение аспектов и их тональности"""
+        for cache_key in audited:
+            llm_aspects = fresh.get(cache_key)
+            if llm_aspects is None:
+                continue
+            local_aspects = local[cache_key]
+            _pipeline_counters["audit_compared"] += 1
+            common = set(local_aspects).intersection(llm_aspects)
+            if common:
+                _pipeline_counters["audit_aspect_match"] += 1
+            if common and all(
+                isinstance(llm_aspects[name], dict) and llm_aspects[name].get("sentiment") == local_aspects[name]["sentiment"]
+                for name in common
+            ):
+                _pipeline_counters["audit_sentiment_match"] += 1
     
     async def get_aspect_statistics(self) -> Dict:
         """Возвращает статистику по аспектам"""
@@ -243,29 +392,20 @@ class AspectProcessor:
             return {}
     
     async def process_existing_feedbacks(self, brand: str = None, limit: int = 100) -> Dict:
-        """Обрабатывает существующие отзывы без аспектов"""
+        """Обрабатывает отзывы из очереди анализа аспектов (aspect_status = 'pending')"""
         
         try:
-            # Получаем отзывы без аспектов (только те, которые еще не анализировались)
-            # Используем правильные PostgreSQL JSON функции
-            query = select(Feedback).where(
-                (Feedback.aspects.is_(None)) |      # NULL значения
-                (func.json_typeof(Feedback.aspects) == 'null') |  # JSON null
-                (func.json_typeof(Feedback.aspects) == 'array' & func.json_array_length(Feedback.aspects) == 0) |  # Пустые массивы
-                (func.json_typeof(Feedback.aspects) == 'object' & func.json_object_keys(Feedback.aspects).is_(None))  # Пустые объекты
+            # Забираем отзывы из очереди: параллельные воркеры получают разные отзывы
+            feedback_ids = await claim_feedbacks_for_aspects(
+                self.db, limit, brand=brand, lease_minutes=settings.ASPECT_LEASE_MINUTES
             )
             
-            if brand:
-                query = query.where(Feedback.brand == brand)
-            
-            query = query.limit(limit)
+            if not feedback_ids:
+                return {"processed": 0, "new_aspects": 0, "errors": ["Нет отзывов для анализа"]}
             
-            result = await self.db.execute(query)
+            result = await self.db.execute(select(Feedback).where(Feedback.id.in_(feedback_ids)).order_by(Feedback.id))
             feedbacks = result.scalars().all()
             
-            if not feedbacks:
-                return {"processed": 0, "new_aspects": 0, "errors": ["Нет отзывов для анализа"]}
-            
             # Обрабатываем отзывы батчем
             return await self.process_feedbacks_batch(feedbacks)
             
@@ -0,0 +1,85 @@
+"""
+Контентно-адресуемое хранилище медиафайлов для запланированных загрузок.
+
+Файл лежит в BLOB_STORE_DIR/<первые 2 символа>/<sha256>, задача хранит только хеш.
+Одинаковые файлы хранятся один раз; учёт ссылок и сборка мусора - в crud/media_blob.
+"""
+import hashlib
+import os
+import tempfile
+from typing import Tuple
+
+from config import settings
+
+# Размер блока при потоковом чтении загрузки
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+
+def blob_path(sha256: str) -> str:
+    return os.path.join(settings.BLOB_STORE_DIR, sha256[:2], sha256)
+
+
+def blob_exists(sha256: str) -> bool:
+    return os.path.exists(blob_path(sha256))
+
+
+async def stage_upload(upload) -> Tuple[str, int, str]:
+    """Потоково пишет UploadFile во временный файл хранилища, считая sha256; возвращает (sha256, размер, путь).
+
+    Путь по хешу файл получает в place_upload - после того, как на него взята ссылка (acquire_blob).
+    """
+    os.makedirs(settings.BLOB_STORE_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=settings.BLOB_STORE_DIR, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            while True:
+                chunk = await upload.read(BLOB_CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size, tmp_path
+    except Exception:
+        discard_upload(tmp_path)
+        raise
+
+
+def place_upload(tmp_path: str, sha256: str) -> None:
+    """Атомарно переименовывает временный файл в путь по хешу.
+
+    Существующий файл всегда заменяется: его могла удалять сборка мусора, а свежий mtime
+    защищает новый файл от удаления как сироты до коммита записи в media_blobs.
+    """
+    target = blob_path(sha256)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(tmp_path, target)
+
+
+def discard_upload(tmp_path: str) -> None:
+    try:
+        os.remove(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+def remove_blob(sha256: str) -> None:
+    try:
+        os.remove(blob_path(sha256))
+    except FileNotFoundError:
+        pass
+
+
+def iter_blob_files():
+    """(sha256, путь, mtime) всех файлов хранилища - для поиска сирот при сборке мусора"""
+    if not os.path.isdir(settings.BLOB_STORE_DIR):
+        return
+    for prefix in os.listdir(settings.BLOB_STORE_DIR):
+        directory = os.path.join(settings.BLOB_STORE_DIR, prefix)
+        if len(prefix) != 2 or not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            yield name, path, os.path.getmtime(path)
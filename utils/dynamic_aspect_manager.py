@@ -5,6 +5,10 @@ from sqlalchemy import select, update
 from sqlalchemy.orm import joinedload
 import json
 
+from crud.aspect_registry import AspectRegistry
+from utils.aspect_analyzer import aspect_analyzer
+from utils.aspect_merger import AspectMerger
+
 logger = logging.getLogger(__name__)
 
 class Aspect:
@@ -29,6 +33,8 @@ class DynamicAspectManager:
     
     def __init__(self, db_session: AsyncSession):
         self.db = db_session
+        # Справочник аспектов из БД: поиск без запроса на каждый аспект, счетчики пишутся пачкой
+        self.registry = AspectRegistry()
         self.base_aspects = self._get_base_aspects()
         self.aspect_categories = self._get_aspect_categories()
     
@@ -55,7 +61,10 @@ class DynamicAspectManager:
         ]
     
     async def process_ai_response(self, ai_response: List[Dict]) -> Dict:
-        """Обрабатывает ответ ИИ и создает новые аспекты"""
+        """Обрабатывает ответ ИИ и создает новые аспекты.
+
+        Аспекты записываются в транзакции сессии менеджера; commit - на стороне вызывающего кода.
+        """
         processed_results = []
         new_aspects_created = []
         
@@ -73,6 +82,8 @@ class DynamicAspectManager:
                     )
                     new_aspects_created.append(new_aspect)
         
+        await self.registry.flush(self.db)
+        
         return {
             "processed_reviews": processed_results,
             "new_aspects": new_aspects_created
@@ -93,36 +104,47 @@ class DynamicAspectManager:
         return processed_review
     
     async def _create_or_get_aspect(self, name: str, category: str, description: str) -> Aspect:
-        """Создает новый аспект или возвращает существующий"""
-        # В реальной реализации здесь был бы запрос к БД
-        # Пока создаем объект в памяти
+        """Создает новый аспект или возвращает существующий (запись в БД - при flush справочника)"""
+        await self.registry.load(self.db)
         
         # Проверяем, существует ли уже такой аспект
         existing_aspect = self._find_existing_aspect(name)
         
+        entry = self.registry.add_usage(name, {
+            "category": category,
+            "description": description,
+            "is_new_aspect": existing_aspect is None
+        })
+        
         if existing_aspect:
             # Обновляем счетчик использования
-            existing_aspect.usage_count += 1
+            existing_aspect.usage_count = entry["usage_count"]
             logger.info(f"Обновлен счетчик использования для аспекта: {name}")
             return existing_aspect
         
         # Создаем новый аспект
         new_aspect = Aspect(
             name=name,
-            category=category,
+            category=entry["category"],
             description=description,
             is_new_aspect=True,
-            usage_count=1
+            usage_count=entry["usage_count"]
         )
         
         logger.info(f"Создан новый аспект: {name} в категории {category}")
         return new_aspect
     
     def _find_existing_aspect(self, name: str) -> Optional[Aspect]:
-        """Ищет существующий аспект по имени"""
-        # В реальной реализации здесь был бы запрос к БД
-        # Пока возвращаем None для демонстрации
-        return None
+        """Ищет существующий аспект по имени в справочнике"""
+        entry = self.registry.get(name)
+        if entry is None:
+            return None
+        return Aspect(
+            name=name,
+            category=entry["category"],
+            is_base_aspect=name in self.base_aspects,
+            usage_count=entry["usage_count"]
+        )
     
     async def _normalize_aspect(self, aspect_name: str, aspect_data: Dict) -> Dict:
         """Нормализует данные аспекта"""
@@ -191,50 +213,12 @@ class DynamicAspectManager:
         return best_category
     
     async def merge_similar_aspects(self, aspects: List[str]) -> List[str]:
-        """Объединяет похожие аспекты"""
-        # Простая логика объединения похожих аспектов
-        merged = []
-        used = set()
-        
-        for aspect in aspects:
-            if aspect in used:
-                continue
-            
-            # Ищем похожие аспекты
-            similar = [aspect]
-            for other in aspects:
-                if other not in used and self._are_aspects_similar(aspect, other):
-                    similar.append(other)
-                    used.add(other)
-            
-            # Выбираем лучший аспект из группы
-            best_aspect = self._select_best_aspect(similar)
-            merged.append(best_aspect)
-            used.add(aspect)
-        
-        return merged
+        """Объединяет похожие аспекты: словоформы, перестановки слов и синонимы журнала"""
+        return AspectMerger(aspect_analyzer.synonym_journal, preferred=self.base_aspects).merge(aspects)
     
     def _are_aspects_similar(self, aspect1: str, aspect2: str) -> bool:
         """Проверяет схожесть аспектов"""
-        words1 = set(aspect1.lower().split())
-        words2 = set(aspect2.lower().split())
-        
-        # Если есть общие слова, считаем аспекты похожими
-        common_words = words1.intersection(words2)
-        return len(common_words) > 0
-    
-    def _select_best_aspect(self, aspects: List[str]) -> str:
-        """Выбирает лучший аспект из группы"""
-        if not aspects:
-            return ""
-        
-        # Приоритет базовым аспектам
-        for aspect in aspects:
-            if aspect in self.base_aspects:
-                return aspect
-        
-        # Возвращаем первый аспект
-        return aspects[0]
+        return AspectMerger(aspect_analyzer.synonym_journal).are_similar(aspect1, aspect2)
 
 # Создаем глобальный экземпляр менеджера
 dynamic_aspect_manager = None
@@ -0,0 +1,46 @@
+"""
+Общие httpx.AsyncClient для внешних API.
+
+Один долгоживущий клиент (пул keep-alive соединений) на базовый URL и event loop,
+чтобы запросы не платили за новый TCP+TLS handshake. Закрываются через close_http_clients()
+при остановке приложения/планировщика.
+"""
+import asyncio
+from typing import Dict, Tuple
+
+import httpx
+
+try:
+    import h2  # noqa: F401  (httpx[http2])
+    HAS_HTTP2 = True
+except ImportError:
+    HAS_HTTP2 = False
+
+DEFAULT_TIMEOUT = httpx.Timeout(30.0, connect=10.0)
+DEFAULT_LIMITS = httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=90.0)
+
+# (base_url, id(event loop)) -> клиент; клиент httpx привязан к loop, в котором открыты соединения
+_clients: Dict[Tuple[str, int], httpx.AsyncClient] = {}
+
+
+def get_http_client(base_url: str) -> httpx.AsyncClient:
+    """Возвращает общий клиент для base_url, создавая его при первом обращении"""
+    key = (base_url.rstrip('/'), id(asyncio.get_running_loop()))
+    client = _clients.get(key)
+    if client is None or client.is_closed:
+        client = httpx.AsyncClient(
+            base_url=key[0],
+            http2=HAS_HTTP2,
+            timeout=DEFAULT_TIMEOUT,
+            limits=DEFAULT_LIMITS,
+        )
+        _clients[key] = client
+    return client
+
+
+async def close_http_clients() -> None:
+    """Закрывает клиенты текущего event loop (shutdown FastAPI / планировщика)"""
+    loop_id = id(asyncio.get_running_loop())
+    keys = [key for key in _clients if key[1] == loop_id]
+    clients = [_clients.pop(key) for key in keys]
+    await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
@@ -0,0 +1,113 @@
+"""
+Разбор JSON из ответов ИИ, в том числе оборванных по max_tokens.
+
+Ответ разбирается по элементам: каждый целый элемент разбирается json.JSONDecoder.raw_decode,
+первый незавершённый элемент прерывает разбор. Из обрезанного массива отзывов так извлекаются
+все целые объекты отзывов (недостающие отзывы возвращаются в очередь вызывающим кодом),
+вместо прежней подгонки окончания строки, при неудаче терявшей весь батч.
+"""
+import json
+import re
+from typing import Any, Callable, Iterator, Optional, Tuple
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = " \t\n\r"
+_CLOSING = {"[": "]", "{": "}"}
+# Блок кода markdown; закрывающей ``` может не быть, если ответ оборван
+_FENCE = re.compile(r"```[\w-]*[ \t]*\n?(.*?)(?:```|\Z)", re.DOTALL)
+
+
+def _skip(text: str, pos: int) -> int:
+    while pos < len(text) and text[pos] in _WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _parse_value(text: str, pos: int) -> Tuple[Any, int, bool]:
+    """(значение, позиция после него, завершено ли); незавершённое скалярное значение - None"""
+    try:
+        value, end = _decoder.raw_decode(text, pos)
+        return value, end, True
+    except json.JSONDecodeError:
+        pass
+    if pos < len(text) and text[pos] in _CLOSING:
+        return _parse_container(text, pos)
+    return None, len(text), False
+
+
+def _parse_container(text: str, pos: int) -> Tuple[Any, int, bool]:
+    """Разбор массива или объекта до первого незавершённого элемента.
+
+    В массив попадают только целые элементы (частичный отзыв хуже отсутствующего: он был бы
+    сохранен как проанализированный). В объект - целые поля и частично разобранные вложенные
+    контейнеры, в которых есть хотя бы один целый элемент.
+    """
+    is_object = text[pos] == "{"
+    result: Any = {} if is_object else []
+    closing = _CLOSING[text[pos]]
+    pos += 1
+    while True:
+        pos = _skip(text, pos)
+        if pos >= len(text):
+            return result, pos, False
+        if text[pos] == closing:
+            return result, pos + 1, True
+        if text[pos] == ",":
+            # Лишние запятые (в том числе висячая перед закрывающей скобкой) пропускаем
+            pos += 1
+            continue
+
+        if is_object:
+            try:
+                key, pos = _decoder.raw_decode(text, pos)
+            except json.JSONDecodeError:
+                return result, len(text), False
+            pos = _skip(text, pos)
+            if not isinstance(key, str) or pos >= len(text) or text[pos] != ":":
+                return result, len(text), False
+            pos = _skip(text, pos + 1)
+
+        value, pos, complete = _parse_value(text, pos)
+        if not complete:
+            if is_object and isinstance(value, (dict, list)) and value:
+                result[key] = value
+            return result, pos, False
+        if is_object:
+            result[key] = value
+        else:
+            result.append(value)
+
+
+def _root_positions(text: str, root: str) -> Iterator[int]:
+    """Позиции открывающих скобок: сначала внутри блоков ```json, затем по всему тексту"""
+    seen = set()
+    fenced = [(m.start(1), m.end(1)) for m in _FENCE.finditer(text)]
+    for start, end in fenced + [(0, len(text))]:
+        pos = text.find(root, start, end)
+        while pos >= 0:
+            if pos not in seen:
+                seen.add(pos)
+                yield pos
+            pos = text.find(root, pos + 1, end)
+
+
+def salvage_json(text: str, root: str = "[",
+                 accept: Optional[Callable[[Any], bool]] = None) -> Tuple[Optional[Any], bool]:
+    """Извлекает из ответа модели JSON-массив (root="[") или объект (root="{").
+
+    Скобка в пояснениях до JSON ("отзыв [1] ...") не должна подменять ответ, поэтому кандидаты
+    перебираются по порядку: сначала тело блока ```json, затем каждая следующая скобка текста.
+    Берётся первый кандидат, для которого accept(значение) истинно (по умолчанию - непустой);
+    если таких нет - первый разобранный (например, честный пустой массив).
+    Возвращает (значение, завершён ли JSON); (None, False), если скобка не найдена.
+    """
+    text = text or ""
+    accept = accept or bool
+    fallback: Tuple[Optional[Any], bool] = (None, False)
+    for start in _root_positions(text, root):
+        value, _, complete = _parse_container(text, start)
+        if accept(value):
+            return value, complete
+        if fallback[0] is None:
+            fallback = (value, complete)
+    return fallback
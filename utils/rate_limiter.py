@@ -0,0 +1,130 @@
+"""
+Ограничение частоты запросов к API Wildberries.
+
+Token bucket на пару (API-токен, семейство эндпоинтов), общий для всех экземпляров WBAPIClient
+в процессе: лимиты WB считаются на продавца и категорию API, а не на соединение.
+Заголовки Retry-After / X-Ratelimit-* приостанавливают bucket, счётчики доступны через get_wb_api_counters().
+"""
+import asyncio
+import hashlib
+import random
+import time
+from collections import defaultdict
+from typing import Dict, Optional, Tuple
+
+import httpx
+
+# семейство -> (запросов в секунду, burst); по лимитам категорий в документации WB
+WB_RATE_LIMITS: Dict[str, Tuple[float, int]] = {
+    'content': (100 / 60, 5),
+    'analytics': (3 / 60, 3),
+    'common': (1.0, 10),
+}
+
+# Повторы: сколько раз и экспоненциальная задержка с полным джиттером
+WB_API_MAX_RETRIES = 3
+WB_API_BACKOFF_BASE = 1.0
+WB_API_BACKOFF_MAX = 30.0
+
+
+def endpoint_family(base_url: str, endpoint: str) -> str:
+    """Семейство эндпоинтов для лимита: категория API WB определяется хостом"""
+    if 'seller-analytics-api' in base_url:
+        return 'analytics'
+    if 'common-api' in base_url:
+        return 'common'
+    return 'content'
+
+
+def backoff_delay(attempt: int) -> float:
+    return random.uniform(0, min(WB_API_BACKOFF_MAX, WB_API_BACKOFF_BASE * (2 ** attempt)))
+
+
+def retry_delay_from_headers(response: httpx.Response) -> Optional[float]:
+    """Сколько ждать по ответу WB: Retry-After или X-Ratelimit-Retry (секунды)"""
+    for name in ('Retry-After', 'X-Ratelimit-Retry'):
+        value = response.headers.get(name)
+        if value:
+            try:
+                return max(float(value), 0.0)
+            except ValueError:
+                continue
+    return None
+
+
+class TokenBucket:
+    """Token bucket с резервированием: очередь ожидающих не превышает rate даже при всплеске корутин"""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _reserve(self) -> float:
+        now = time.monotonic()
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+        self.tokens -= 1
+        wait = (self.updated - now) + (max(0.0, -self.tokens) / self.rate)
+        return max(wait, self.blocked_until - now)
+
+    async def acquire(self) -> float:
+        """Ждёт токен; возвращает фактическое время ожидания"""
+        started = time.monotonic()
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        # Пауза по заголовкам WB могла начаться, пока мы ждали
+        while True:
+            delay = self.blocked_until - time.monotonic()
+            if delay <= 0:
+                return time.monotonic() - started
+            await asyncio.sleep(delay)
+
+    def pause(self, delay: float) -> None:
+        """Приостанавливает выдачу токенов; пополнение начнётся после паузы"""
+        until = time.monotonic() + delay
+        if until > self.blocked_until:
+            self.blocked_until = until
+        if until > self.updated:
+            self.updated = until
+            self.tokens = min(self.tokens, 0.0)
+
+    def observe(self, response: httpx.Response) -> None:
+        """Учитывает X-Ratelimit-Remaining/Reset: исчерпанный лимит ставит bucket на паузу"""
+        remaining = response.headers.get('X-Ratelimit-Remaining')
+        reset = response.headers.get('X-Ratelimit-Reset')
+        if remaining is None or reset is None:
+            return
+        try:
+            if int(remaining) <= 0:
+                self.pause(float(reset))
+        except ValueError:
+            pass
+
+
+_buckets: Dict[Tuple[str, str], TokenBucket] = {}
+_counters: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+
+def get_bucket(api_key: str, family: str) -> TokenBucket:
+    # Ключ - хеш токена, чтобы не держать сами токены в реестре
+    key = (hashlib.sha256(api_key.encode()).hexdigest()[:16], family)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        rate, capacity = WB_RATE_LIMITS.get(family, WB_RATE_LIMITS['content'])
+        bucket = TokenBucket(rate, capacity)
+        _buckets[key] = bucket
+    return bucket
+
+
+def record(family: str, event: str, value: float = 1) -> None:
+    _counters[family][event] += value
+
+
+def get_wb_api_counters() -> Dict[str, Dict[str, float]]:
+    """Счётчики по семействам: requests, throttled, throttle_wait_sec, rate_limited, retries, failures"""
+    return {family: dict(events) for family, events in _counters.items()}
@@ -12,15 +12,20 @@ logging.getLogger('apscheduler').setLevel(logging.WARNING)
 logging.getLogger('apscheduler.executors.default').setLevel(logging.WARNING)
 logging.getLogger('apscheduler.schedulers').setLevel(logging.WARNING)
 
-from crud import task as task_crud
-from crud.history import update_history_status
-from utils.wb_api import WBAPIClient, WBApiResponse
-from crud.user import get_all_users, get_decrypted_wb_key
+from utils.http_clients import close_http_clients
+from utils.task_worker import task_pool, run_task_dispatcher
+from crud.user import get_all_users
 from crud.analytics import parse_shop_feedbacks_crud
+from crud.shops_summary import refresh_feedback_daily_rollups
+from crud.feedback_archive import archive_feedbacks
+from crud.media_blob import gc_media_blobs
+from crud.sentiment import score_pending_sentiment
 from utils.aspect_processor import AspectProcessor
 from database import AsyncSessionLocal
+from config import settings
 
 scheduler = AsyncIOScheduler(executors={'default': AsyncIOExecutor()})
+_dispatcher_task = None
 logger = logging.getLogger(__name__)
 
 
@@ -29,84 +34,6 @@ async def get_db_session() -> AsyncSession:
     return AsyncSessionLocal()
 
 
-async def _get_wb_api_key_for_task(db: AsyncSession, task_id: int) -> str:
-    task = await task_crud.get_task_by_id(db, task_id)
-    if not task or not task.owner:
-        raise ValueError("Task or user not found")
-
-    if not task.brand:
-        raise ValueError("Brand not specified in task")
-
-    # Используем get_decrypted_wb_key напрямую вместо get_wb_api_key с Depends
-    wb_api_key = await get_decrypted_wb_key(db, task.owner, task.brand)
-    return wb_api_key
-
-
-async def process_scheduled_tasks():
-    # Одна сессия на тик планировщика; изменения выполняем по одной задаче за транзакцию
-    async with AsyncSessionLocal() as db:
-        tasks = await task_crud.get_pending_tasks(db)
-        for task in tasks:
-            try:
-                wb_api_key = await _get_wb_api_key_for_task(db, task.id)
-
-                async with db.begin():
-                    task.status = 'processing'
-
-                wb_client = WBAPIClient(api_key=wb_api_key)
-
-                # Выполняем действие вне транзакции, т.к. это внешние вызовы
-                if task.action == 'update_content':
-                    result = await wb_client.update_card_content(task.nm_id, task.payload)
-                elif task.action == 'update_media':
-                    result = await wb_client.upload_meda(task.nm_id, task.payload.get("media"))
-                elif task.action == 'upload_media_file':
-                    if task.payload.get("immediate"):
-                        result = WBApiResponse(success=True, data={"info": "already uploaded"})
-                    else:
-                        file_path = task.payload.get("file_path")
-                        if not file_path or not os.path.exists(file_path):
-                            result = WBApiResponse(success=False, error="Файл для загрузки не найден")
-                        else:
-                            with open(file_path, "rb") as f:
-                                file_data = f.read()
-                            result = await wb_client.upload_mediaFile(
-                                nm_id=task.nm_id,
-                                file_data=file_data,
-                                photo_number=task.payload["photo_number"],
-                                media_type=task.payload.get("media_type", "image")
-                            )
-                            if result.success:
-                                try:
-                                    os.remove(file_path)
-                                except Exception:
-                                    pass
-                                async with db.begin():
-                                    await db.delete(task)
-
-                # Фиксируем результат статуса и истории в отдельной транзакции
-                async with db.begin():
-                    if result.success:
-                        task.status = 'completed'
-                        await update_history_status(db, status='completed', user_id=task.user_id, created_at=task.created_at)
-                    else:
-                        task.status = 'pending'
-                        task.scheduled_at = datetime.now() + timedelta(minutes=5)
-                        if hasattr(result, 'error'):
-                            task.error = result.error
-                        elif isinstance(result.wb_response, dict) and 'error' in result.wb_response:
-                            task.error = result.wb_response['error']
-                        else:
-                            task.error = "Unknown error"
-                    task.wb_response = result.wb_response
-
-            except Exception as e:
-                async with db.begin():
-                    task.status = 'pending'
-                    task.scheduled_at = datetime.now() + timedelta(minutes=5)
-                    task.error = str(e)
-
-
 async def parse_all_shops_feedbacks():
     async with AsyncSessionLocal() as db:
         users = await get_all_users(db)
@@ -128,6 +55,19 @@ async def parse_all_shops_feedbacks():
                             await asyncio.sleep(backoff_base_sec * attempt)
                         else:
                             logger.error(f"[SCHEDULER] Бренд '{brand}' пропущен после {max_attempts} неудачных попыток")
+                # Тональность новых отзывов бренда - локальной моделью, сразу после синхронизации
+                try:
+                    # Лимит на цикл: большой бэклог не задерживает агрегаты и следующие бренды
+                    await score_pending_sentiment(db, brand, limit=settings.SENTIMENT_CYCLE_LIMIT)
+                except Exception as e:
+                    await db.rollback()
+                    logger.error(f"[SCHEDULER] Ошибка оценки тональности бренда '{brand}': {e}")
+                # Дневные агрегаты для графиков сводки - после синхронизации отзывов бренда
+                try:
+                    await refresh_feedback_daily_rollups(db, brand)
+                except Exception as e:
+                    await db.rollback()
+                    logger.error(f"[SCHEDULER] Ошибка пересчёта дневных агрегатов бренда '{brand}': {e}")
 
 
 async def analyze_all_new_feedbacks():
@@ -149,6 +89,28 @@ async def analyze_all_new_feedbacks():
         print(f"[AI] Ошибка при анализе аспектов: {e}")
 
 
+async def archive_stale_feedbacks():
+    """Перенос удалённых и устаревших отзывов в feedbacks_archive"""
+    try:
+        async with AsyncSessionLocal() as db:
+            result = await archive_feedbacks(db)
+            if result.get('archived', 0) > 0:
+                logger.info(f"[ARCHIVE] Перенесено в архив: {result['archived']} отзывов за {result['batches']} пачек")
+    except Exception as e:
+        logger.error(f"[ARCHIVE] Ошибка архивации отзывов: {e}")
+
+
+async def collect_media_blobs():
+    """Удаляет медиафайлы, на которые больше не ссылается ни одна задача"""
+    try:
+        async with AsyncSessionLocal() as db:
+            result = await gc_media_blobs(db)
+            if result['removed'] or result['orphans']:
+                logger.info(f"[BLOBS] Удалено файлов: {result['removed']}, сирот: {result['orphans']}")
+    except Exception as e:
+        logger.error(f"[BLOBS] Ошибка сборки мусора хранилища: {e}")
+
+
 def start_scheduler():
     # Отключаем все логи APScheduler
     logging.getLogger('apscheduler').setLevel(logging.ERROR)
@@ -156,14 +118,10 @@ def start_scheduler():
     logging.getLogger('apscheduler.schedulers').setLevel(logging.ERROR)
     logging.getLogger('apscheduler.triggers').setLevel(logging.ERROR)
     
-    # Задача обработки запланированных задач (каждые 5 секунд)
-    scheduler.add_job(
-        process_scheduled_tasks,
-        'interval',
-        seconds=5,
-        max_instances=1,
-        timezone='Europe/Moscow'
-    )
+    # Запланированные задачи: диспетчер спит до ближайшего scheduled_at или NOTIFY, без опроса каждые 5 секунд
+    global _dispatcher_task
+    if _dispatcher_task is None or _dispatcher_task.done():
+        _dispatcher_task = asyncio.get_running_loop().create_task(run_task_dispatcher())
     
     # Задача парсинга отзывов всех магазинов (каждые 30 минут)
     scheduler.add_job(
@@ -183,4 +141,39 @@ def start_scheduler():
         timezone='Europe/Moscow'
     )
     
-    scheduler.start()
\ No newline at end of file
+    # Сборка мусора хранилища медиафайлов (каждые 6 часов)
+    scheduler.add_job(
+        collect_media_blobs,
+        'interval',
+        hours=6,
+        max_instances=1,
+        timezone='Europe/Moscow'
+    )
+    
+    # Задача архивации отзывов (раз в сутки)
+    scheduler.add_job(
+        archive_stale_feedbacks,
+        'interval',
+        hours=24,
+        max_instances=1,
+        timezone='Europe/Moscow'
+    )
+    
+    scheduler.start()
+
+
+async def stop_scheduler():
+    """Останавливает планировщик и закрывает общие HTTP-клиенты"""
+    global _dispatcher_task
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    if _dispatcher_task is not None:
+        _dispatcher_task.cancel()
+        try:
+            await _dispatcher_task
+        except (asyncio.CancelledError, Exception):
+            pass
+        _dispatcher_task = None
+    # Даём взятым задачам завершиться, иначе они вернутся в очередь только по истечении аренды
+    await task_pool.drain()
+    await close_http_clients()
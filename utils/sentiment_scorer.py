@@ -0,0 +1,163 @@
+"""
+Локальная оценка тональности отзывов (Feedback.sentiment_score) трансформером на CPU.
+
+Модель (по умолчанию rubert-tiny2, дообученная на русских отзывах) загружается один раз на процесс,
+при SENTIMENT_QUANTIZE линейные слои квантуются в int8 (torch dynamic quantization).
+Тексты сортируются по длине в токенах и режутся на батчи по бюджету токенов: паддинг внутри батча
+минимален. Инференс идёт в torch.inference_mode в отдельном потоке, не блокируя event loop.
+Оценка: P(positive) - P(negative), от -1 до 1.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from config import settings
+
+try:
+    import torch
+    HAS_TORCH = True
+except ImportError:
+    HAS_TORCH = False
+
+try:
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+    HAS_TRANSFORMERS = True
+except ImportError:
+    HAS_TRANSFORMERS = False
+
+logger = logging.getLogger(__name__)
+
+# Счетчики оценки тональности текущего процесса (см. get_sentiment_stats)
+_sentiment_counters: Dict[str, float] = defaultdict(float)
+
+
+def get_sentiment_stats() -> Dict[str, float]:
+    """Тексты, батчи, время инференса, доля паддинга и скорость (текстов в секунду)"""
+    stats = dict(_sentiment_counters)
+    if _sentiment_counters["seconds"]:
+        stats["texts_per_second"] = _sentiment_counters["texts"] / _sentiment_counters["seconds"]
+    if _sentiment_counters["padded_tokens"]:
+        stats["padding_ratio"] = 1 - _sentiment_counters["tokens"] / _sentiment_counters["padded_tokens"]
+    return stats
+
+
+class SentimentScorer:
+    """Оценка тональности батчами с группировкой по длине"""
+
+    def __init__(self, model_name: Optional[str] = None):
+        self.model_name = model_name or settings.SENTIMENT_MODEL_NAME
+        self.max_length = settings.SENTIMENT_MAX_LENGTH
+        self.batch_size = settings.SENTIMENT_BATCH_SIZE
+        self.batch_tokens = settings.SENTIMENT_BATCH_TOKENS
+        self.tokenizer = None
+        self.model = None
+        self.positive_index = None
+        self.negative_index = None
+        # Неудачная загрузка запоминается: без этого каждый цикл заново качал бы и грузил модель
+        self._load_failed_at: Optional[float] = None
+        # Загрузка и инференс из потоков asyncio.to_thread: torch сам распараллеливает батч
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return HAS_TORCH and HAS_TRANSFORMERS and settings.SENTIMENT_ENABLED and not self._load_backoff()
+
+    def _load_backoff(self) -> bool:
+        """Модель не загрузилась и пауза SENTIMENT_LOAD_RETRY_MINUTES ещё не истекла"""
+        if self._load_failed_at is None:
+            return False
+        retry_seconds = settings.SENTIMENT_LOAD_RETRY_MINUTES * 60
+        return retry_seconds <= 0 or time.monotonic() - self._load_failed_at < retry_seconds
+
+    def _load(self) -> None:
+        if self.model is not None:
+            return
+        if self._load_backoff():
+            raise RuntimeError(f"Модель {self.model_name} недоступна: загрузка не удалась")
+        try:
+            self._load_model()
+        except Exception as e:
+            self._load_failed_at = time.monotonic()
+            retry = (f"повтор через {settings.SENTIMENT_LOAD_RETRY_MINUTES} мин"
+                     if settings.SENTIMENT_LOAD_RETRY_MINUTES > 0 else "до перезапуска")
+            logger.error(f"[SENTIMENT] Не удалось загрузить модель {self.model_name}, оценка отключена ({retry}): {e}")
+            raise
+        self._load_failed_at = None
+
+    def _load_model(self) -> None:
+        if settings.SENTIMENT_NUM_THREADS > 0:
+            torch.set_num_threads(settings.SENTIMENT_NUM_THREADS)
+
+        started = time.monotonic()
+        tokenizer = AutoTokenizer.from_pretrained(self.model_name)
+        model = AutoModelForSequenceClassification.from_pretrained(self.model_name)
+        model.eval()
+        if settings.SENTIMENT_QUANTIZE:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        labels = {index: str(label).lower() for index, label in model.config.id2label.items()}
+        positive = [index for index, label in labels.items() if label.startswith("pos")]
+        negative = [index for index, label in labels.items() if label.startswith("neg")]
+        if not positive or not negative:
+            raise ValueError(f"Модель {self.model_name} не содержит меток positive/negative: {labels}")
+
+        self.tokenizer = tokenizer
+        self.positive_index = positive[0]
+        self.negative_index = negative[0]
+        self.model = model
+        logger.info(f"[SENTIMENT] Модель {self.model_name} загружена за {time.monotonic() - started:.1f}с "
+                    f"(int8: {settings.SENTIMENT_QUANTIZE}, потоков: {torch.get_num_threads()})")
+
+    def _batches(self, lengths: List[int]) -> List[List[int]]:
+        """Индексы текстов по возрастанию длины, нарезанные по размеру батча и бюджету токенов"""
+        batches = []
+        current: List[int] = []
+        for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+            # Тексты отсортированы: длина текущего - максимальная в батче, батч паддится до неё
+            if current and (len(current) >= self.batch_size or (len(current) + 1) * lengths[index] > self.batch_tokens):
+                batches.append(current)
+                current = []
+            current.append(index)
+        if current:
+            batches.append(current)
+        return batches
+
+    def score_texts(self, texts: List[str]) -> List[float]:
+        """Синхронная оценка: по числу на текст, в исходном порядке"""
+        if not texts:
+            return []
+        with self._lock:
+            self._load()
+            started = time.monotonic()
+            encoded = self.tokenizer(texts, truncation=True, max_length=self.max_length)
+            lengths = [len(ids) for ids in encoded["input_ids"]]
+            scores = [0.0] * len(texts)
+
+            with torch.inference_mode():
+                for batch in self._batches(lengths):
+                    features = self.tokenizer.pad(
+                        [{key: encoded[key][index] for key in encoded.keys()} for index in batch],
+                        return_tensors="pt"
+                    )
+                    probabilities = torch.softmax(self.model(**features).logits, dim=-1)
+                    batch_scores = probabilities[:, self.positive_index] - probabilities[:, self.negative_index]
+                    for index, score in zip(batch, batch_scores.tolist()):
+                        scores[index] = round(score, 4)
+                    _sentiment_counters["batches"] += 1
+                    _sentiment_counters["tokens"] += sum(lengths[index] for index in batch)
+                    _sentiment_counters["padded_tokens"] += len(batch) * max(lengths[index] for index in batch)
+
+            _sentiment_counters["texts"] += len(texts)
+            _sentiment_counters["seconds"] += time.monotonic() - started
+        return scores
+
+    async def score(self, texts: List[str]) -> List[float]:
+        """Оценка в отдельном потоке, чтобы инференс не блокировал event loop"""
+        return await asyncio.to_thread(self.score_texts, texts)
+
+
+# Глобальный экземпляр: модель загружается при первой оценке
+sentiment_scorer = SentimentScorer()
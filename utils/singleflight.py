@@ -0,0 +1,50 @@
+"""
+Схлопывание одновременных одинаковых запросов (singleflight).
+
+Пока запрос по ключу выполняется, остальные вызывающие ждут его результат, а не запускают свой.
+Успешный результат дополнительно живёт ttl секунд.
+"""
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+
+class SingleFlight:
+    def __init__(self, ttl: float = 0.0):
+        self.ttl = ttl
+        self._inflight: Dict[Tuple[Hashable, int], asyncio.Future] = {}
+        self._results: Dict[Tuple[Hashable, int], Tuple[float, Any]] = {}
+
+    async def do(
+        self,
+        key: Hashable,
+        fn: Callable[[], Awaitable[Any]],
+        cache_if: Optional[Callable[[Any], bool]] = None
+    ) -> Any:
+        # Future привязан к event loop, поэтому ключ включает loop
+        full_key = (key, id(asyncio.get_running_loop()))
+        cached = self._results.get(full_key)
+        if cached is not None:
+            if cached[0] > time.monotonic():
+                return cached[1]
+            self._results.pop(full_key, None)
+
+        future = self._inflight.get(full_key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self._inflight[full_key] = future
+
+            def _done(f: asyncio.Future):
+                self._inflight.pop(full_key, None)
+                if self.ttl > 0 and not f.cancelled() and f.exception() is None:
+                    if cache_if is None or cache_if(f.result()):
+                        self._results[full_key] = (time.monotonic() + self.ttl, f.result())
+
+            future.add_done_callback(_done)
+        # shield: отмена одного ожидающего не отменяет общий запрос для остальных
+        return await asyncio.shield(future)
+
+    def forget(self, predicate: Callable[[Hashable], bool]) -> None:
+        """Сбрасывает закешированные результаты, ключ которых удовлетворяет predicate"""
+        for full_key in [k for k in self._results if predicate(k[0])]:
+            self._results.pop(full_key, None)
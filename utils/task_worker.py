@@ -0,0 +1,410 @@
+"""
+Пул воркеров запланированных задач (scheduled_tasks).
+
+Задачи забираются crud.task.claim_due_tasks (FOR UPDATE SKIP LOCKED), поэтому пул можно запускать
+в нескольких процессах одновременно. Внутри процесса задачи выполняются параллельно: общий лимит
+TASK_WORKER_CONCURRENCY и лимит на бренд TASK_WORKER_BRAND_CONCURRENCY, чтобы долгая загрузка медиа
+одного бренда не задерживала остальные. Каждая задача работает в своей сессии БД.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import settings
+from crud import task as task_crud
+from crud.card_index import CardIndex
+from crud.history import update_history_status
+from crud.media_blob import release_blob
+from crud.user import get_decrypted_wb_key
+from database import AsyncSessionLocal, engine
+from models.task import ScheduledTask, SCHEDULED_TASKS_CHANNEL
+from utils.wb_api import WBAPIClient, WBApiResponse
+from utils import blob_store
+
+logger = logging.getLogger(__name__)
+
+
+async def _get_wb_api_key_for_task(db: AsyncSession, task_id: int) -> str:
+    task = await task_crud.get_task_by_id(db, task_id)
+    if not task or not task.owner:
+        raise ValueError("Task or user not found")
+
+    if not task.brand:
+        raise ValueError("Brand not specified in task")
+
+    # Используем get_decrypted_wb_key напрямую вместо get_wb_api_key с Depends
+    wb_api_key = await get_decrypted_wb_key(db, task.owner, task.brand)
+    return wb_api_key
+
+
+def _reschedule(task: ScheduledTask, error: str) -> None:
+    task.status = 'pending'
+    task.scheduled_at = datetime.now() + timedelta(minutes=5)
+    task.error = error
+
+
+async def _apply_task_result(db: AsyncSession, task: ScheduledTask, result: WBApiResponse,
+                             duration_ms: int, permanent_failure: bool = False) -> None:
+    """Фиксирует результат задачи и истории"""
+    task.duration_ms = duration_ms
+    task.wb_response = result.wb_response
+    if result.success:
+        task.status = 'completed'
+        await db.commit()
+        await update_history_status(db, status='completed', user_id=task.user_id, created_at=task.created_at)
+    elif permanent_failure:
+        # Ошибка валидации конкретной карточки: повтор через 5 минут её не исправит
+        task.status = 'failed'
+        task.error = result.error
+        await db.commit()
+        await update_history_status(db, status='failed', user_id=task.user_id, created_at=task.created_at)
+    else:
+        if result.error:
+            error = result.error
+        elif isinstance(result.wb_response, dict) and 'error' in result.wb_response:
+            error = result.wb_response['error']
+        else:
+            error = "Unknown error"
+        _reschedule(task, error)
+        await db.commit()
+
+
+async def _execute_task(db: AsyncSession, task: ScheduledTask, wb_client: WBAPIClient) -> WBApiResponse:
+    # Внешние вызовы выполняются вне транзакции
+    if task.action == 'update_content':
+        return await wb_client.update_card_content(task.nm_id, task.payload)
+    if task.action == 'update_media':
+        return await wb_client.upload_media(task.nm_id, task.payload.get("media"))
+    if task.action == 'upload_media_file':
+        if task.payload.get("immediate"):
+            return WBApiResponse(success=True, data={"info": "already uploaded"})
+        blob_sha256 = task.payload.get("blob_sha256")
+        if blob_sha256:
+            if not blob_store.blob_exists(blob_sha256):
+                return WBApiResponse(success=False, error="Файл для загрузки не найден")
+            # Файл не читается в память целиком: httpx отправляет multipart с диска блоками
+            with open(blob_store.blob_path(blob_sha256), "rb") as f:
+                result = await wb_client.upload_mediaFile(
+                    nm_id=task.nm_id,
+                    file_data=f,
+                    photo_number=task.payload["photo_number"],
+                    media_type=task.payload.get("media_type", "image")
+                )
+            if result.success:
+                await release_blob(db, blob_sha256)
+            return result
+        file_path = task.payload.get("file_path")
+        if not file_path or not os.path.exists(file_path):
+            return WBApiResponse(success=False, error="Файл для загрузки не найден")
+        with open(file_path, "rb") as f:
+            file_data = f.read()
+        result = await wb_client.upload_mediaFile(
+            nm_id=task.nm_id,
+            file_data=file_data,
+            photo_number=task.payload["photo_number"],
+            media_type=task.payload.get("media_type", "image")
+        )
+        if result.success:
+            try:
+                os.remove(file_path)
+            except Exception:
+                pass
+        return result
+    return WBApiResponse(success=False, error=f"Неизвестное действие: {task.action}")
+
+
+async def run_single_task(task_id: int, claimed_at: datetime) -> None:
+    async with AsyncSessionLocal() as db:
+        if not await task_crud.start_claimed_tasks(db, [task_id], claimed_at):
+            logger.info(f"[TASKS] task_id={task_id} забрана другим воркером, пока ждала слота бренда")
+            return
+        task = await task_crud.get_task_by_id(db, task_id)
+        if not task:
+            return
+        action, brand = task.action, task.brand
+        started = time.monotonic()
+        try:
+            wb_api_key = await _get_wb_api_key_for_task(db, task.id)
+            await db.commit()
+            wb_client = WBAPIClient(api_key=wb_api_key, card_index=CardIndex(task.user_id, brand))
+            result = await _execute_task(db, task, wb_client)
+            duration_ms = int((time.monotonic() - started) * 1000)
+            remove_task = result.success and action == 'upload_media_file' and not task.payload.get("immediate")
+            await _apply_task_result(db, task, result, duration_ms)
+            # Загруженный файл больше не нужен - задача удаляется, как и раньше
+            if remove_task:
+                await db.delete(task)
+                await db.commit()
+        except Exception as e:
+            await db.rollback()
+            duration_ms = int((time.monotonic() - started) * 1000)
+            task = await db.get(ScheduledTask, task_id)
+            if task is not None:
+                task.duration_ms = duration_ms
+                _reschedule(task, str(e))
+                await db.commit()
+            result = WBApiResponse(success=False, error=str(e))
+        _record_latency(task_id, action, brand, result.success, duration_ms)
+
+
+async def run_content_update_batch(task_ids: List[int], claimed_at: datetime) -> None:
+    """Один пакетный /cards/update на наступившие update_content задачи пары (user, brand)"""
+    async with AsyncSessionLocal() as db:
+        started_ids = await task_crud.start_claimed_tasks(db, task_ids, claimed_at)
+        if len(started_ids) < len(task_ids):
+            logger.info(f"[TASKS] {len(task_ids) - len(started_ids)} задач пакета забраны другим воркером, пока ждали слота бренда")
+        task_ids = started_ids
+        tasks = [t for t in [await task_crud.get_task_by_id(db, task_id) for task_id in task_ids] if t]
+        if not tasks:
+            return
+        # Одна карточка - одна задача за пакет, остальные изменения той же карточки уйдут позже
+        batch: Dict[str, ScheduledTask] = {}
+        deferred = []
+        for task in tasks:
+            if str(task.nm_id) in batch:
+                deferred.append(task)
+            else:
+                batch[str(task.nm_id)] = task
+        # Отложенные задачи остаются в processing до фиксации результата пакета:
+        # иначе другой диспетчер сразу заберёт их и отправит второй /cards/update той же карточки
+        deferred_ids = [task.id for task in deferred]
+
+        first = next(iter(batch.values()))
+        batch_ids = {nm_id: task.id for nm_id, task in batch.items()}
+        brand = first.brand
+        started = time.monotonic()
+        try:
+            wb_api_key = await _get_wb_api_key_for_task(db, first.id)
+            await db.commit()
+            wb_client = WBAPIClient(api_key=wb_api_key, card_index=CardIndex(first.user_id, brand))
+            results = await wb_client.update_cards_content({nm_id: task.payload for nm_id, task in batch.items()})
+        except Exception as e:
+            await db.rollback()
+            duration_ms = int((time.monotonic() - started) * 1000)
+            for task_id in batch_ids.values():
+                task = await db.get(ScheduledTask, task_id)
+                if task is not None:
+                    task.duration_ms = duration_ms
+                    _reschedule(task, str(e))
+                _record_latency(task_id, 'update_content', brand, False, duration_ms)
+            await db.commit()
+            await _release_deferred(db, deferred_ids)
+            return
+        duration_ms = int((time.monotonic() - started) * 1000)
+
+        for nm_id, task in batch.items():
+            result = results.get(nm_id) or WBApiResponse(success=False, error="Нет ответа WB по карточке")
+            # Ошибка данных конкретной карточки (а не сети/лимита) возвращается в её задачу и историю
+            permanent_failure = not result.success and bool((result.data or {}).get("card_error"))
+            try:
+                await _apply_task_result(db, task, result, duration_ms, permanent_failure=permanent_failure)
+            except Exception as e:
+                await db.rollback()
+                logger.error(f"[TASKS] Не удалось сохранить результат задачи {batch_ids[nm_id]}: {e}")
+            _record_latency(batch_ids[nm_id], 'update_content', brand, result.success, duration_ms)
+        await _release_deferred(db, deferred_ids)
+
+
+async def _release_deferred(db: AsyncSession, task_ids: List[int]) -> None:
+    """Возвращает в очередь задачи карточек, уже отправленных в пакете (scheduled_at не меняется)"""
+    for task_id in task_ids:
+        task = await db.get(ScheduledTask, task_id)
+        if task is not None and task.status == 'processing':
+            task.status = 'pending'
+            task.claimed_at = None
+    await db.commit()
+
+
+_stats: Dict[str, float] = defaultdict(float)
+
+
+def _record_latency(task_id: int, action: str, brand: str, success: bool, duration_ms: int) -> None:
+    _stats['tasks'] += 1
+    _stats['succeeded' if success else 'failed'] += 1
+    _stats['duration_ms_total'] += duration_ms
+    _stats['duration_ms_max'] = max(_stats['duration_ms_max'], duration_ms)
+    logger.info(f"[TASKS] task_id={task_id} action={action} brand={brand} success={success} duration_ms={duration_ms}")
+
+
+def get_task_worker_stats() -> Dict[str, float]:
+    stats = dict(_stats)
+    stats['duration_ms_avg'] = stats['duration_ms_total'] / stats['tasks'] if stats.get('tasks') else 0.0
+    stats['in_flight'] = len(task_pool.running)
+    return stats
+
+
+class TaskWorkerPool:
+    """Забирает задачи по числу свободных слотов и выполняет их параллельно с лимитом на бренд"""
+
+    def __init__(self, concurrency: int, brand_concurrency: int):
+        self.concurrency = concurrency
+        self.brand_concurrency = brand_concurrency
+        self.running = set()
+        self._brand_slots: Dict[str, asyncio.Semaphore] = {}
+        self.wake: Optional[asyncio.Event] = None
+
+    def _brand_semaphore(self, brand: str) -> asyncio.Semaphore:
+        if brand not in self._brand_slots:
+            self._brand_slots[brand] = asyncio.Semaphore(self.brand_concurrency)
+        return self._brand_slots[brand]
+
+    def _spawn(self, brand: str, job) -> None:
+        async def runner():
+            async with self._brand_semaphore(brand):
+                try:
+                    await job
+                except Exception as e:
+                    logger.error(f"[TASKS] Ошибка воркера бренда '{brand}': {e}")
+
+        worker = asyncio.create_task(runner())
+        self.running.add(worker)
+        worker.add_done_callback(self._worker_done)
+
+    def _worker_done(self, worker: asyncio.Task) -> None:
+        self.running.discard(worker)
+        # Освободился слот - диспетчер может забрать следующие задачи
+        if self.wake is not None:
+            self.wake.set()
+
+    @property
+    def is_full(self) -> bool:
+        return len(self.running) >= self.concurrency
+
+    async def dispatch(self) -> int:
+        """Забирает наступившие задачи под свободные слоты; возвращает число запущенных задач"""
+        free = self.concurrency - len(self.running)
+        if free <= 0:
+            return 0
+        async with AsyncSessionLocal() as db:
+            claimed = await task_crud.claim_due_tasks(db, free, settings.TASK_LEASE_MINUTES)
+        if not claimed:
+            return 0
+
+        # update_content одного бренда/токена, забранные вместе, отправляются пакетом.
+        # claimed_at у всех строк одной выборки общий: по нему задача подтверждается при старте
+        claimed_at = claimed[0].claimed_at
+        content_batches: Dict[tuple, List[int]] = defaultdict(list)
+        for row in claimed:
+            if row.action == 'update_content':
+                content_batches[(row.user_id, row.brand)].append(row.id)
+            else:
+                self._spawn(row.brand, run_single_task(row.id, claimed_at))
+        for (user_id, brand), task_ids in content_batches.items():
+            self._spawn(brand, run_content_update_batch(task_ids, claimed_at))
+        return len(claimed)
+
+    async def drain(self) -> None:
+        """Дожидается выполняющихся задач (остановка процесса)"""
+        if self.running:
+            await asyncio.gather(*list(self.running), return_exceptions=True)
+
+
+task_pool = TaskWorkerPool(settings.TASK_WORKER_CONCURRENCY, settings.TASK_WORKER_BRAND_CONCURRENCY)
+
+# Диспетчер: максимальный сон без уведомлений, минимальный сон и интервал опроса без LISTEN
+TASK_DISPATCH_MAX_SLEEP_SECONDS = 60
+TASK_DISPATCH_MIN_SLEEP_SECONDS = 0.2
+TASK_DISPATCH_POLL_SECONDS = 5
+
+
+async def _wait_for_wake(wake: asyncio.Event, timeout: float) -> None:
+    try:
+        await asyncio.wait_for(wake.wait(), timeout=max(timeout, 0))
+    except asyncio.TimeoutError:
+        pass
+    wake.clear()
+
+
+async def _close_listen_conn(listen_conn, driver_conn, on_notify, on_terminated) -> None:
+    """Снимает слушателей и возвращает соединение LISTEN в пул (оборванное - выбрасывает)"""
+    try:
+        driver_conn.remove_termination_listener(on_terminated)
+        if driver_conn.is_closed():
+            await listen_conn.invalidate()
+        else:
+            # Иначе соединение вернётся в пул с подпиской на канал и чужим callback
+            await driver_conn.remove_listener(SCHEDULED_TASKS_CHANNEL, on_notify)
+    except Exception as e:
+        logger.warning(f"[TASKS] Не удалось снять LISTEN {SCHEDULED_TASKS_CHANNEL}: {e}")
+    try:
+        await listen_conn.close()
+    except Exception:
+        pass
+
+
+async def run_task_dispatcher() -> None:
+    """Диспетчер задач: спит до ближайшего scheduled_at или до NOTIFY из триггера scheduled_tasks.
+
+    LISTEN держится на отдельном соединении из пула engine (asyncpg). Обрыв соединения будит
+    диспетчер (termination listener), и LISTEN поднимается на новом соединении. Если LISTEN
+    недоступен, диспетчер переходит на опрос раз в TASK_DISPATCH_POLL_SECONDS.
+    """
+    wake = asyncio.Event()
+    task_pool.wake = wake
+    listen_failed = False
+
+    def on_notify(*args) -> None:
+        wake.set()
+
+    def on_terminated(*args) -> None:
+        wake.set()
+
+    while True:
+        listen_conn = None
+        driver_conn = None
+        try:
+            listen_conn = await engine.connect()
+            raw = await listen_conn.get_raw_connection()
+            driver_conn = raw.driver_connection
+            driver_conn.add_termination_listener(on_terminated)
+            await driver_conn.add_listener(SCHEDULED_TASKS_CHANNEL, on_notify)
+            max_sleep = TASK_DISPATCH_MAX_SLEEP_SECONDS
+            listen_failed = False
+        except Exception as e:
+            if not listen_failed:
+                logger.warning(f"[TASKS] LISTEN {SCHEDULED_TASKS_CHANNEL} недоступен ({e}), опрос каждые {TASK_DISPATCH_POLL_SECONDS} с")
+            listen_failed = True
+            if listen_conn is not None:
+                if driver_conn is not None:
+                    await _close_listen_conn(listen_conn, driver_conn, on_notify, on_terminated)
+                else:
+                    await listen_conn.close()
+            listen_conn = None
+            max_sleep = TASK_DISPATCH_POLL_SECONDS
+
+        try:
+            while True:
+                # listen_conn.closed - состояние обёртки SQLAlchemy, обрыв со стороны сервера виден только драйверу
+                if listen_conn is not None and driver_conn.is_closed():
+                    logger.warning(f"[TASKS] Соединение LISTEN {SCHEDULED_TASKS_CHANNEL} оборвано, переподключение")
+                    break
+                if task_pool.is_full:
+                    await _wait_for_wake(wake, max_sleep)
+                    continue
+                try:
+                    if await task_pool.dispatch():
+                        # Могли остаться ещё наступившие задачи - пробуем сразу
+                        continue
+                    async with AsyncSessionLocal() as db:
+                        delay = await task_crud.get_next_task_delay(db, settings.TASK_LEASE_MINUTES)
+                except Exception as e:
+                    logger.error(f"[TASKS] Ошибка диспетчера: {e}")
+                    delay = TASK_DISPATCH_POLL_SECONDS
+                # Нижняя граница защищает от холостого цикла при расхождении часов
+                timeout = max_sleep if delay is None else min(max(delay, TASK_DISPATCH_MIN_SLEEP_SECONDS), max_sleep)
+                await _wait_for_wake(wake, timeout)
+                if listen_conn is None:
+                    # Без LISTEN периодически пробуем подключиться снова
+                    break
+        except asyncio.CancelledError:
+            if listen_conn is not None:
+                await _close_listen_conn(listen_conn, driver_conn, on_notify, on_terminated)
+            raise
+        if listen_conn is not None:
+            await _close_listen_conn(listen_conn, driver_conn, on_notify, on_terminated)
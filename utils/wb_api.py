@@ -2,10 +2,32 @@ import httpx
 from config import settings
 from schemas import WBApiResponse
 from utils.validate_image import validate_images
+from utils.http_clients import get_http_client
+from utils import rate_limiter
+from utils.singleflight import SingleFlight
+import hashlib
+import asyncio
 import json
+import os
 import logging
 logger = logging.getLogger("wb_api")
 
+WB_COMMON_API_URL = "https://common-api.wildberries.ru"
+WB_ANALYTICS_API_URL = "https://seller-analytics-api.wildberries.ru"
+# Загрузка медиафайлов заметно дольше обычных запросов
+MEDIA_UPLOAD_TIMEOUT = httpx.Timeout(120.0, connect=10.0)
+# Лимиты /content/v2/cards/update: карточек в запросе и размер тела
+CARD_UPDATE_MAX_CARDS = 3000
+CARD_UPDATE_MAX_BYTES = 10 * 1024 * 1024
+# Полная выгрузка каталога: одновременные вызовы с одним ключом ждут один проход, результат живёт несколько секунд
+CATALOG_CACHE_TTL_SECONDS = 30
+_catalog_flight = SingleFlight(ttl=CATALOG_CACHE_TTL_SECONDS)
+# Отчёт остатков: nmID в запросе, параллельные запросы, время жизни карты остатков (цикл парсинга - 30 минут)
+STOCKS_REPORT_LIMIT = 1000
+STOCKS_REPORT_CONCURRENCY = 3
+STOCK_MAP_TTL_SECONDS = 30 * 60
+_stock_map_flight = SingleFlight(ttl=STOCK_MAP_TTL_SECONDS)
+
 def merge_card_data(old_data: dict, new_data: dict) -> dict:
     result = old_data.copy()
 
@@ -22,69 +44,125 @@ def merge_card_data(old_data: dict, new_data: dict) -> dict:
     return result
 
 class WBAPIClient:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, card_index=None):
         self.api_key = api_key
         self.base_url = settings.WB_API_BASE_URL
-    async def _make_request(self, method: str, endpoint: str, **kwargs) -> WBApiResponse:
-        headers = kwargs.pop('headers', {})
-        headers.update({"Authorization": self.api_key})
+        # crud.card_index.CardIndex для (user, brand); без него поиск карточки идёт по всему каталогу
+        self.card_index = card_index
 
-        async with httpx.AsyncClient() as client:
+    async def _send(self, method: str, endpoint: str, base_url: str = None, idempotent: bool = None, **kwargs) -> httpx.Response:
+        """HTTP-запрос под общим лимитером (токен + семейство эндпоинтов) с повторами.
+
+        429 повторяется для любых вызовов (WB отклоняет запрос, не выполняя его) с паузой по Retry-After /
+        X-Ratelimit-Retry; сетевые ошибки и 5xx - только для идемпотентных, с экспоненциальной задержкой и джиттером.
+        """
+        base_url = base_url or self.base_url
+        if idempotent is None:
+            idempotent = method.upper() == "GET"
+        family = rate_limiter.endpoint_family(base_url, endpoint)
+        bucket = rate_limiter.get_bucket(self.api_key, family)
+        client = get_http_client(base_url)
+
+        attempt = 0
+        while True:
+            waited = await bucket.acquire()
+            if waited > 0:
+                rate_limiter.record(family, 'throttled')
+                rate_limiter.record(family, 'throttle_wait_sec', waited)
+            rate_limiter.record(family, 'requests')
             try:
-                response = await client.request(
-                    method,
-                    f"{self.base_url}{endpoint}",
-                    headers=headers,
-                    **kwargs
-                )
+                response = await client.request(method, endpoint, **kwargs)
+            except httpx.RequestError:
+                if not idempotent or attempt >= rate_limiter.WB_API_MAX_RETRIES:
+                    rate_limiter.record(family, 'failures')
+                    raise
+                attempt += 1
+                rate_limiter.record(family, 'retries')
+                await asyncio.sleep(rate_limiter.backoff_delay(attempt))
+                continue
+
+            bucket.observe(response)
+            if response.status_code == 429:
+                rate_limiter.record(family, 'rate_limited')
+                if attempt < rate_limiter.WB_API_MAX_RETRIES:
+                    attempt += 1
+                    rate_limiter.record(family, 'retries')
+                    delay = rate_limiter.retry_delay_from_headers(response)
+                    bucket.pause(delay if delay is not None else rate_limiter.backoff_delay(attempt))
+                    logger.warning(f"[WB_API] 429 {endpoint}, повтор {attempt}/{rate_limiter.WB_API_MAX_RETRIES}")
+                    continue
+            elif response.status_code >= 500 and idempotent and attempt < rate_limiter.WB_API_MAX_RETRIES:
+                attempt += 1
+                rate_limiter.record(family, 'retries')
+                await asyncio.sleep(rate_limiter.backoff_delay(attempt))
+                continue
+
+            if not response.is_success:
+                rate_limiter.record(family, 'failures')
+            return response
 
-                # Попытка распарсить JSON
-                try:
-                    json_data = response.json()
-                except json.JSONDecodeError:
-                    json_data = None
+    async def _make_request(self, method: str, endpoint: str, base_url: str = None, idempotent: bool = None, **kwargs) -> WBApiResponse:
+        headers = kwargs.pop('headers', {})
+        headers.update({"Authorization": self.api_key})
 
-                # Если всё ок — возвращаем данные
-                if response.is_success:
-                    return WBApiResponse(
-                        success=True,
-                        data=json_data,
-                        wb_response=json_data
-                    )
-                print(WBApiResponse)
+        try:
+            response = await self._send(
+                method,
+                endpoint,
+                base_url=base_url,
+                idempotent=idempotent,
+                headers=headers,
+                **kwargs
+            )
 
-                if json_data:
-                    return WBApiResponse(
-                        success=False,
-                        error=f"HTTP {response.status_code}",
-                        wb_response=json_data
-                    )
+            # Попытка распарсить JSON
+            try:
+                json_data = response.json()
+            except json.JSONDecodeError:
+                json_data = None
 
+            # Если всё ок — возвращаем данные
+            if response.is_success:
                 return WBApiResponse(
-                    success=False,
-                    data=None,
-                    error=f"HTTP {response.status_code} — Invalid JSON",
-                    wb_response={"raw_response": response.text}
+                    success=True,
+                    data=json_data,
+                    wb_response=json_data
                 )
+            print(WBApiResponse)
 
-            except httpx.RequestError as e:
-                # Обработка сетевых ошибок
-                print("Request Error:", str(e))
-                return WBApiResponse(
-                    success=False,
-                    error=f"Network error: {str(e)}"
-                )
-            except Exception as e:
-                print("Unexpected Error:", str(e))
+            if json_data:
                 return WBApiResponse(
                     success=False,
-                    error=str(e)
+                    error=f"HTTP {response.status_code}",
+                    wb_response=json_data
                 )
 
+            return WBApiResponse(
+                success=False,
+                data=None,
+                error=f"HTTP {response.status_code} — Invalid JSON",
+                wb_response={"raw_response": response.text}
+            )
+
+        except httpx.RequestError as e:
+            # Обработка сетевых ошибок
+            print("Request Error:", str(e))
+            return WBApiResponse(
+                success=False,
+                error=f"Network error: {str(e)}"
+            )
+        except Exception as e:
+            print("Unexpected Error:", str(e))
+            return WBApiResponse(
+                success=False,
+                error=str(e)
+            )
+
     async def get_cards_list(self, payload: dict = None):
         response = await self._make_request(
             method="POST",
             endpoint="/content/v2/get/cards/list",
+            idempotent=True,
             json=payload or {
                 "settings": {
                     "cursor": {},
@@ -94,8 +172,30 @@ class WBAPIClient:
         )
         return response
 
+    def _token_key(self) -> str:
+        return hashlib.sha256(self.api_key.encode()).hexdigest()[:16]
+
     async def get_all_cards_with_pagination(self, brand: str = None, limit: int = 1000):
-        """Получает все товары бренда с пагинацией"""
+        """Получает все товары бренда с пагинацией.
+
+        Одновременные вызовы с тем же (токен, бренд, фильтр) разделяют одну пагинацию,
+        успешный результат переиспользуется CATALOG_CACHE_TTL_SECONDS секунд.
+        """
+        key = (self._token_key(), brand, json.dumps({"withPhoto": 1, "limit": limit}, sort_keys=True))
+        response = await _catalog_flight.do(
+            key,
+            lambda: self._fetch_all_cards(brand, limit),
+            cache_if=lambda r: r.success
+        )
+        # Список копируем, чтобы вызывающий код не менял общий результат
+        return WBApiResponse(
+            success=response.success,
+            data={**response.data, "cards": list(response.data.get("cards", []))} if response.data else response.data,
+            error=response.error,
+            wb_response=response.wb_response
+        )
+
+    async def _fetch_all_cards(self, brand: str = None, limit: int = 1000):
         all_cards = []
         cursor = {}
         page = 1
@@ -117,6 +217,7 @@ class WBAPIClient:
             response = await self._make_request(
                 method="POST",
                 endpoint="/content/v2/get/cards/list",
+                idempotent=True,
                 json=payload
             )
             
@@ -159,74 +260,20 @@ class WBAPIClient:
 
     async def get_seller_info(self) -> WBApiResponse:
         """Получение информации о продавце через API WB"""
-        # Костыль: используем конкретный URL для seller-info, а не базовый из конфига
-        seller_info_url = "https://common-api.wildberries.ru/api/v1/seller-info"
-        
-        headers = {"Authorization": self.api_key, "Content-Type": "application/json"}
-        
-        async with httpx.AsyncClient() as client:
-            try:
-                response = await client.request(
-                    "GET",
-                    seller_info_url,
-                    headers=headers
-                )
-
-                # Попытка распарсить JSON
-                try:
-                    json_data = response.json()
-                except json.JSONDecodeError:
-                    json_data = None
-
-                # Если всё ок — возвращаем данные
-                if response.is_success:
-                    return WBApiResponse(
-                        success=True,
-                        data=json_data,
-                        wb_response=json_data
-                    )
-
-                if json_data:
-                    return WBApiResponse(
-                        success=False,
-                        error=f"HTTP {response.status_code}",
-                        wb_response=json_data
-                    )
-
-                return WBApiResponse(
-                    success=False,
-                    data=None,
-                    error=f"HTTP {response.status_code} — Invalid JSON",
-                    wb_response={"raw_response": response.text}
-                )
-
-            except httpx.RequestError as e:
-                # Обработка сетевых ошибок
-                print("Request Error:", str(e))
-                return WBApiResponse(
-                    success=False,
-                    error=f"Network error: {str(e)}"
-                )
-            except Exception as e:
-                print("Unexpected Error:", str(e))
-                return WBApiResponse(
-                    success=False,
-                    error=str(e)
-                )
-
-    async def update_card_content(self, nm_id: int, content: dict) -> WBApiResponse:
-        nm_id = str(nm_id)
-        current_card = await self.get_card_by_nm(nm_id)
-        if not current_card.success:
-            print(f"❌ Не удалось получить карточку nm_id={nm_id}: {current_card.error}")
-            return WBApiResponse(success=False, error="Карточка не найдена")
-
-        old_data = current_card.data
-        vendor_code = old_data.get("vendorCode")
+        # seller-info живёт на common-api, а не на базовом content-api из конфига
+        return await self._make_request(
+            "GET",
+            "/api/v1/seller-info",
+            base_url=WB_COMMON_API_URL,
+            headers={"Content-Type": "application/json"}
+        )
 
-        payload = [{
+    @staticmethod
+    def _build_card_update(nm_id: str, content: dict, old_data: dict) -> dict:
+        """Элемент массива /content/v2/cards/update: изменения поверх текущей карточки"""
+        return {
             "nmID": nm_id,
-            "vendorCode": vendor_code,
+            "vendorCode": old_data.get("vendorCode"),
             "brand": content.get("brand", old_data.get("brand", "")),
             "title": content.get("title", old_data.get("title")),
             "description": content.get("description", old_data.get("description")),
@@ -244,18 +291,114 @@ class WBAPIClient:
                 for ch in content.get("characteristics", [])
             ],
             "sizes": old_data.get("sizes", [])
-        }]
-
-        print("📦 Payload для /cards/update:")
-        print(json.dumps(payload, indent=2, ensure_ascii=False))
+        }
 
-        response = await self._make_request(
-            "POST",
-            "/content/v2/cards/update",
-            json=payload
+    @staticmethod
+    def _chunk_card_updates(items: list) -> list:
+        """Делит карточки на запросы в пределах лимитов WB (число карточек и размер тела)"""
+        chunks, chunk, chunk_size = [], [], 2
+        for item in items:
+            # Так же, как тело сериализует httpx (json=): ensure_ascii, кириллица - \uXXXX по 6 байт;
+            # +2 - разделитель ", " между элементами
+            item_size = len(json.dumps(item)) + 2
+            if chunk and (len(chunk) >= CARD_UPDATE_MAX_CARDS or chunk_size + item_size > CARD_UPDATE_MAX_BYTES):
+                chunks.append(chunk)
+                chunk, chunk_size = [], 2
+            chunk.append(item)
+            chunk_size += item_size
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    @staticmethod
+    def _card_error(response: WBApiResponse, item: dict):
+        """Ошибка конкретной карточки из additionalErrors успешного ответа (ключ - nmID или vendorCode)"""
+        wb_data = response.wb_response if isinstance(response.wb_response, dict) else {}
+        errors = wb_data.get("additionalErrors")
+        if not isinstance(errors, dict):
+            return None
+        for key in (str(item.get("nmID")), str(item.get("vendorCode"))):
+            if key in errors:
+                return errors[key]
+        return None
+
+    @staticmethod
+    def _is_rejected(response: WBApiResponse) -> bool:
+        """WB отклонил данные (4xx, кроме лимита 429, который уже повторён в _send)"""
+        error = response.error or ""
+        return not response.success and error.startswith("HTTP 4") and not error.startswith("HTTP 429")
+
+    @staticmethod
+    def _mark_card_error(response: WBApiResponse, item: dict, error: str) -> WBApiResponse:
+        """Ответ с ошибкой данных конкретной карточки: data.card_error отличает её от сетевых сбоев"""
+        return WBApiResponse(
+            success=False,
+            data={"nmID": item.get("nmID"), "card_error": True},
+            error=error,
+            wb_response=response.wb_response
         )
-        print("📬 Ответ от /cards/update:", response)
-        return response
+
+    async def update_cards_content(self, updates: dict) -> dict:
+        """Пакетное обновление карточек: {nm_id: content} -> {nm_id: WBApiResponse}.
+
+        Карточки уходят массивами в один /content/v2/cards/update (с учётом лимитов WB). Если WB отклонил
+        весь пакет с 4xx, карточки отправляются по одной, чтобы ошибка досталась только виновной.
+        """
+        results = {}
+        items = []
+        catalog = None
+        refresh = True
+        for nm_id, content in updates.items():
+            nm_id = str(nm_id)
+            if self.card_index is not None:
+                # Индекс досинхронизируется один раз на пакет
+                current_card = await self.get_card_by_nm(nm_id, refresh=refresh)
+                refresh = False
+                old_data = current_card.data if current_card.success else None
+            else:
+                if catalog is None:
+                    response = await self.get_all_cards_with_pagination()
+                    catalog = {str(c.get("nmID")): c for c in (response.data or {}).get("cards", [])}
+                old_data = catalog.get(nm_id)
+            if not old_data:
+                print(f"❌ Не удалось получить карточку nm_id={nm_id}")
+                results[nm_id] = WBApiResponse(success=False, error="Карточка не найдена")
+                continue
+            items.append(self._build_card_update(nm_id, content, old_data))
+
+        for chunk in self._chunk_card_updates(items):
+            logger.info(f"[WB_API] cards/update: карточек в запросе {len(chunk)}")
+            response = await self._make_request(
+                "POST",
+                "/content/v2/cards/update",
+                json=chunk
+            )
+            print("📬 Ответ от /cards/update:", response)
+            if self._is_rejected(response) and len(chunk) > 1:
+                for item in chunk:
+                    single = await self._make_request(
+                        "POST",
+                        "/content/v2/cards/update",
+                        json=[item]
+                    )
+                    results[item["nmID"]] = self._mark_card_error(single, item, single.error) if self._is_rejected(single) else single
+                continue
+            for item in chunk:
+                card_error = self._card_error(response, item) if response.success else None
+                if card_error:
+                    results[item["nmID"]] = self._mark_card_error(response, item, str(card_error))
+                elif self._is_rejected(response):
+                    results[item["nmID"]] = self._mark_card_error(response, item, response.error)
+                else:
+                    results[item["nmID"]] = response
+
+        if any(r.success for r in results.values()):
+            await self._invalidate_card_index()
+        return results
+
+    async def update_card_content(self, nm_id: int, content: dict) -> WBApiResponse:
+        results = await self.update_cards_content({nm_id: content})
+        return results[str(nm_id)]
 
     async def upload_media(self, nm_id: int, media_urls: list[str]) -> WBApiResponse:
         nm_id = str(nm_id)
@@ -290,12 +433,15 @@ class WBAPIClient:
             )
             print("--------------------------------------------------------------------")
             print(response)
+            if response.success:
+                await self._invalidate_card_index()
             return response
         except Exception as e:
             return WBApiResponse(success=False, error=str(e))
 
-    async def upload_mediaFile(self, nm_id: int, file_data: bytes, photo_number: int,
+    async def upload_mediaFile(self, nm_id: int, file_data, photo_number: int,
                                media_type: str = 'image') -> WBApiResponse:
+        """Загрузка файла в карточку. file_data - bytes или открытый бинарный файл (отправляется потоком с диска)"""
         nm_id = str(nm_id)
         if media_type == 'video' and photo_number != 1:
             logger.error("[upload_mediaFile] Попытка загрузить видео не в позицию 1 (photo_number=%s)", photo_number)
@@ -310,16 +456,17 @@ class WBAPIClient:
             "X-Photo-Number": str(1 if media_type == "video" else photo_number),
         }
 
-        logger.info("[upload_mediaFile] Параметры запроса: nm_id=%s, filename=%s, content_type=%s, file_size=%d, headers=%s, url=%s", nm_id, filename, content_type, len(file_data), headers, f"{self.base_url}/content/v3/media/file")
+        file_size = len(file_data) if isinstance(file_data, (bytes, bytearray)) else os.fstat(file_data.fileno()).st_size
+        logger.info("[upload_mediaFile] Параметры запроса: nm_id=%s, filename=%s, content_type=%s, file_size=%d, headers=%s, url=%s", nm_id, filename, content_type, file_size, headers, f"{self.base_url}/content/v3/media/file")
 
-        timeout = httpx.Timeout(30.0)
         try:
-            async with httpx.AsyncClient(timeout=timeout) as client:
-                response = await client.post(
-                    f"{self.base_url}/content/v3/media/file",
-                    headers=headers,
-                    files={"uploadfile": (filename, file_data, content_type)}
-                )
+            response = await self._send(
+                "POST",
+                "/content/v3/media/file",
+                headers=headers,
+                files={"uploadfile": (filename, file_data, content_type)},
+                timeout=MEDIA_UPLOAD_TIMEOUT
+            )
 
             logger.info("[upload_mediaFile] Статус ответа: %s", response.status_code)
             logger.info("[upload_mediaFile] Текст ответа: %s", response.text)
@@ -330,6 +477,7 @@ class WBAPIClient:
 
             if response.is_success:
                 logger.info("[upload_mediaFile] Загрузка прошла успешно!")
+                await self._invalidate_card_index()
                 return WBApiResponse(
                     success=True,
                     data=response.json(),
@@ -347,8 +495,26 @@ class WBAPIClient:
             logger.error("[upload_mediaFile] Исключение: %s", e, exc_info=True)
             return WBApiResponse(success=False, error=str(e))
 
-    async def get_card_by_nm(self, nm_id: int):
+    async def _invalidate_card_index(self):
+        """После записи в WB кеш каталога сбрасывается, а индекс карточек досинхронизируется при следующем чтении"""
+        token_key = self._token_key()
+        _catalog_flight.forget(lambda key: key[0] == token_key)
+        if self.card_index is None:
+            return
+        try:
+            await self.card_index.invalidate()
+        except Exception as e:
+            logger.error(f"[WB_API] Не удалось пометить индекс карточек устаревшим: {e}")
+
+    async def get_card_by_nm(self, nm_id: int, refresh: bool = False):
         nm_id = str(nm_id)
+        if self.card_index is not None:
+            card = await self.card_index.get_card(self, nm_id=int(nm_id), refresh=refresh)
+            if card is None:
+                print(f"⚠️ Карточка с nmID={nm_id} не найдена в индексе")
+                return WBApiResponse(success=False, error="Карточка не найдена")
+            return WBApiResponse(success=True, data=card)
+
         response = await self.get_all_cards_with_pagination()
 
         if not response.success:
@@ -376,6 +542,15 @@ class WBAPIClient:
 
     async def get_card_by_vendor(self, vendorCode: str) -> WBApiResponse:
         try:
+            if self.card_index is not None:
+                card = await self.card_index.get_card(self, vendor_code=vendorCode)
+                if card is None:
+                    return WBApiResponse(
+                        success=False,
+                        error=f"Карточка с vendorCode '{vendorCode}' не найдена"
+                    )
+                return WBApiResponse(success=True, data=card)
+
             # Используем новую функцию с пагинацией для поиска по vendorCode
             response = await self.get_all_cards_with_pagination()
 
@@ -414,21 +589,11 @@ class WBAPIClient:
 
     # Функция get_all_cards удалена - используйте get_all_cards_with_pagination
 
-    async def get_stocks_report_products(self, nm_ids: list, start_date: str, end_date: str) -> WBApiResponse:
-        """Вызов отчёта истории остатков по товарам (isDeleted и др.)
-
-        Документация: Аналитика и данные → История остатков → Данные по товарам.
-        POST https://seller-analytics-api.wildberries.ru/api/v2/stocks-report/products/products
-
-        Параметры:
-        - nm_ids: список nmID
-        - start_date, end_date: YYYY-MM-DD
-        """
-        url = "https://seller-analytics-api.wildberries.ru/api/v2/stocks-report/products/products"
+    async def _get_stocks_report_page(self, nm_list: list, start_date: str, end_date: str, offset: int = 0) -> WBApiResponse:
+        """Одна страница отчёта истории остатков (не больше STOCKS_REPORT_LIMIT товаров)"""
+        endpoint = "/api/v2/stocks-report/products/products"
         headers = {"Authorization": self.api_key, "Content-Type": "application/json"}
 
-        # Минимальный валидный payload: nmIDs + даты. Добавляем таймзону по умолчанию
-        nm_list = [int(x) for x in nm_ids if str(x).isdigit()]
         payload = {
             "nmIDs": nm_list,
             "currentPeriod": {
@@ -444,40 +609,116 @@ class WBAPIClient:
             "availabilityFilters": [
                 "deficient", "actual", "balanced", "nonActual", "nonLiquid", "invalidData"
             ],
-            "limit": 1000,
-            "offset": 0  # начало выборки (offset пагинации), при переданных nmIDs должен быть 0
+            "limit": STOCKS_REPORT_LIMIT,
+            "offset": offset  # при переданных nmIDs должен быть 0, поэтому список nmID режется на части
         }
 
         try:
-            logger.info(f"[WB_API] stocks-report: products={len(payload['nmIDs'])}, period={start_date}..{end_date}")
-            async with httpx.AsyncClient() as client:
-                resp = await client.post(url, headers=headers, json=payload)
-                logger.info(f"[WB_API] stocks-report status={resp.status_code}")
-                body_text = resp.text
-                try:
-                    data = resp.json()
-                except json.JSONDecodeError:
-                    data = None
-
-                # Успех с первой попытки
-                if resp.is_success:
-                    # Диагностика: сохраняем последний ответ и короткую сводку
-                    try:
-                        import os, json as _json
-                        os.makedirs('logs', exist_ok=True)
-                        with open('logs/stocks_report_last.json', 'w', encoding='utf-8') as f:
-                            _json.dump(data, f, ensure_ascii=False, indent=2)
-                        # Короткая сводка
-                        data_obj = data.get('data') if isinstance(data, dict) else None
-                        items_arr = (data_obj or {}).get('items') if data_obj else None
-                        cnt = len(items_arr) if isinstance(items_arr, list) else 0
-                        logger.info(f"[WB_API] stocks-report items={cnt}")
-                    except Exception:
-                        pass
-                    return WBApiResponse(success=True, data=data, wb_response=data)
-
-                logger.warning(f"[WB_API] stocks-report 1st attempt failed: status={resp.status_code}, body={body_text}")
-                return WBApiResponse(success=False, error=f"HTTP {resp.status_code}", wb_response=data or {"raw": body_text})
+            resp = await self._send(
+                "POST", endpoint, base_url=WB_ANALYTICS_API_URL, idempotent=True, headers=headers, json=payload
+            )
+            try:
+                data = resp.json()
+            except json.JSONDecodeError:
+                data = None
+            if resp.is_success:
+                return WBApiResponse(success=True, data=data, wb_response=data)
+            logger.warning(f"[WB_API] stocks-report failed: status={resp.status_code}, body={resp.text}")
+            return WBApiResponse(success=False, error=f"HTTP {resp.status_code}", wb_response=data or {"raw": resp.text})
         except Exception as e:
             return WBApiResponse(success=False, error=str(e))
 
+    @staticmethod
+    def _stocks_report_items(response: WBApiResponse) -> list:
+        data_obj = response.data.get('data') if isinstance(response.data, dict) else None
+        items = (data_obj or {}).get('items') if isinstance(data_obj, dict) else None
+        return items if isinstance(items, list) else []
+
+    async def get_stocks_report_products(self, nm_ids: list, start_date: str, end_date: str) -> WBApiResponse:
+        """Вызов отчёта истории остатков по товарам (isDeleted и др.)
+
+        Документация: Аналитика и данные → История остатков → Данные по товарам.
+        POST https://seller-analytics-api.wildberries.ru/api/v2/stocks-report/products/products
+
+        Параметры:
+        - nm_ids: список nmID (пустой - все товары продавца, постранично через offset)
+        - start_date, end_date: YYYY-MM-DD
+
+        nmID режутся на части по STOCKS_REPORT_LIMIT, части запрашиваются параллельно под лимитером;
+        ответ собирается в прежнем формате {"data": {"items": [...]}}. Ошибка любой части - ошибка всего отчёта,
+        иначе фильтр по остаткам молча отбросил бы товары.
+        """
+        nm_list = [int(x) for x in nm_ids if str(x).isdigit()]
+        semaphore = asyncio.Semaphore(STOCKS_REPORT_CONCURRENCY)
+
+        async def fetch_chunk(chunk: list) -> WBApiResponse:
+            async with semaphore:
+                return await self._get_stocks_report_page(chunk, start_date, end_date)
+
+        async def fetch_all_pages() -> list:
+            pages = []
+            offset = 0
+            while True:
+                async with semaphore:
+                    page = await self._get_stocks_report_page([], start_date, end_date, offset)
+                pages.append(page)
+                if not page.success or len(self._stocks_report_items(page)) < STOCKS_REPORT_LIMIT:
+                    return pages
+                offset += STOCKS_REPORT_LIMIT
+
+        logger.info(f"[WB_API] stocks-report: products={len(nm_list)}, period={start_date}..{end_date}")
+        if nm_list:
+            chunks = [nm_list[i:i + STOCKS_REPORT_LIMIT] for i in range(0, len(nm_list), STOCKS_REPORT_LIMIT)]
+            responses = await asyncio.gather(*(fetch_chunk(chunk) for chunk in chunks))
+        else:
+            responses = await fetch_all_pages()
+
+        failed = [r for r in responses if not r.success]
+        if failed:
+            logger.warning(f"[WB_API] stocks-report: {len(failed)} из {len(responses)} запросов с ошибкой")
+            return WBApiResponse(success=False, error=failed[0].error, wb_response=failed[0].wb_response)
+
+        items = []
+        for response in responses:
+            items.extend(self._stocks_report_items(response))
+        data = {"data": {"items": items}}
+        logger.info(f"[WB_API] stocks-report items={len(items)}, запросов={len(responses)}")
+        # Диагностика: сохраняем последний ответ
+        try:
+            import os
+            os.makedirs('logs', exist_ok=True)
+            with open('logs/stocks_report_last.json', 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+        except Exception:
+            pass
+        return WBApiResponse(success=True, data=data, wb_response=data)
+
+    async def get_stock_map(self, nm_ids: list, start_date: str, end_date: str):
+        """nmID -> stockCount по отчёту остатков; None, если отчёт получить не удалось.
+
+        Карта кешируется на цикл парсинга (STOCK_MAP_TTL_SECONDS) по (токен, период, набор nmID),
+        одновременные запросы той же карты ждут один отчёт.
+        """
+        nm_key = hashlib.sha256(",".join(str(n) for n in sorted(int(x) for x in nm_ids if str(x).isdigit())).encode()).hexdigest()
+
+        async def build():
+            response = await self.get_stocks_report_products(nm_ids, start_date, end_date)
+            if not response.success:
+                return None
+            stock_map = {}
+            for item in self._stocks_report_items(response):
+                nm = item.get('nmID')
+                if nm is None:
+                    continue
+                try:
+                    stock_map[int(nm)] = int((item.get('metrics') or {}).get('stockCount', 0) or 0)
+                except (TypeError, ValueError):
+                    stock_map[int(nm)] = 0
+            return stock_map
+
+        return await _stock_map_flight.do(
+            (self._token_key(), start_date, end_date, nm_key),
+            build,
+            cache_if=lambda m: m is not None
+        )
+